@@ -31,7 +31,16 @@ _add_path(_parent)
 _add_path(_hooks)
 
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+)
+from charmhelpers.core.profiling import (
+    format_summary,
+    read_profiles,
+    summarize_profiles,
+)
 
 from glance_utils import (
     pause_unit_helper,
@@ -56,9 +65,22 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def hook_profile(args):
+    """Summarize the recorded hook profiles.
+
+    @raises Exception if no hook profiles have been recorded
+    """
+    profiles = read_profiles(limit=action_get('profiles'))
+    if not profiles:
+        raise Exception('No hook profiles recorded, enable the '
+                        'profile-hooks config option to record them')
+    action_set({'report': format_summary(
+        summarize_profiles(profiles, top=action_get('top')))})
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "hook-profile": hook_profile}
 
 
 def main(args):
@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import collections
+import contextlib
 import copy
 import enum
+import functools
 import glob
 import hashlib
 import json
@@ -25,17 +27,11 @@ import socket
 import time
 
 from base64 import b64decode
-try:
-    from distutils.version import LooseVersion
-except ImportError:
-    from looseversion import LooseVersion
 from subprocess import (
     check_call,
     check_output,
     CalledProcessError)
 
-import charmhelpers.contrib.storage.linux.ceph as ch_ceph
-
 from charmhelpers.contrib.openstack.audits.openstack_security_guide import (
     _config_ini as config_ini
 )
@@ -48,6 +44,7 @@ from charmhelpers.fetch import (
 from charmhelpers.core.hookenv import (
     NoNetworkBinding,
     config,
+    data_generation,
     is_relation_made,
     local_unit,
     log,
@@ -67,6 +64,7 @@ from charmhelpers.core.hookenv import (
     remote_service_name,
 )
 
+from charmhelpers.core.profiling import profile_span
 from charmhelpers.core.sysctl import create as sysctl_create
 from charmhelpers.core.strutils import bool_from_string
 from charmhelpers.contrib.openstack.exceptions import OSContextError
@@ -124,13 +122,9 @@ from charmhelpers.contrib.openstack.utils import (
 )
 from charmhelpers.core.unitdata import kv
 
-from charmhelpers.contrib.hardware import pci
-
-try:
-    import psutil
-except ImportError:
-    apt_install('python3-psutil', fatal=True)
-    import psutil
+# NOTE: charmhelpers.contrib.storage.linux.ceph, charmhelpers.contrib.hardware
+# and psutil are imported where they are used; they are slow to import and
+# most hooks don't need them.
 
 CA_CERT_PATH = '/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt'
 ADDRESS_TYPES = ['admin', 'internal', 'public']
@@ -156,6 +150,102 @@ def context_complete(ctxt):
     return True
 
 
+# Context generator results memoized within context_memo_scope(), keyed by
+# the __call__ implementation and the generator's class and constructor
+# arguments.
+_context_memo = {}
+_context_memo_generation = None
+# Depth of the context_memo_scope() blocks being executed.
+_context_memo_depth = 0
+
+
+@contextlib.contextmanager
+def context_memo_scope():
+    """Memoize context generator results within the with block.
+
+    OSConfigRenderer uses this around each pass over its templates, e.g.
+    write_all() or complete_contexts(), so that generators shared by several
+    templates are evaluated once per pass while state changed between
+    passes, e.g. certificates, mounts or the pause state, is always seen.
+    Nested blocks share the memo of the outermost one, which is dropped when
+    it exits.
+    """
+    global _context_memo_depth
+    _context_memo_depth += 1
+    try:
+        yield
+    finally:
+        _context_memo_depth -= 1
+        if not _context_memo_depth:
+            _context_memo.clear()
+
+
+def flush_context_memo():
+    """Drop the memoized context generator results.
+
+    The memo is dropped automatically when the charm changes relation,
+    leader or config data; call this after changing other state that
+    context generators inspect within a context_memo_scope() block.
+    """
+    _context_memo.clear()
+
+
+def _memoize_context(call):
+    """Memoize the results of a context generator's __call__ within
+    context_memo_scope().
+
+    Generators of the same class constructed with the same arguments share
+    results, so that contexts registered for several config files, or
+    instantiated within other contexts, are only evaluated once per pass.
+    The generator's attributes, e.g. missing_data, are restored along with
+    the result.
+    """
+    span = call.__qualname__.rsplit('.', 1)[0]
+
+    @functools.wraps(call)
+    def wrapper(self):
+        with profile_span('context', span):
+            return memoized(self)
+
+    def memoized(self):
+        global _context_memo_generation
+        if not _context_memo_depth or '_memo_args' not in self.__dict__:
+            return call(self)
+        if data_generation() != _context_memo_generation:
+            _context_memo.clear()
+            _context_memo_generation = data_generation()
+        key = (call, _memo_key(self))
+        try:
+            ctxt, state = _context_memo[key]
+        except KeyError:
+            pass
+        else:
+            self.__dict__.update(copy.deepcopy(state))
+            return copy.deepcopy(ctxt)
+        ctxt = call(self)
+        try:
+            _context_memo[key] = (
+                copy.deepcopy(ctxt),
+                copy.deepcopy({k: v for k, v in self.__dict__.items()
+                               if not k.startswith('_memo')}))
+        except Exception:
+            # Not copyable, so not safe to share.
+            _context_memo.pop(key, None)
+        return ctxt
+    return wrapper
+
+
+def _memo_key(generator):
+    key = generator.__dict__.get('_memo_key')
+    if key is None:
+        cls = type(generator)
+        args, kwargs = generator._memo_args
+        key = generator._memo_key = json.dumps(
+            (cls.__module__, cls.__qualname__, args, kwargs),
+            sort_keys=True, default=str)
+    return key
+
+
 class OSContextGenerator(object):
     """Base class for all context generators."""
     interfaces = []
@@ -163,6 +253,17 @@ class OSContextGenerator(object):
     complete = False
     missing_data = []
 
+    def __new__(cls, *args, **kwargs):
+        self = super(OSContextGenerator, cls).__new__(cls)
+        # The memo key is only built when memoizing, see _memo_key().
+        self._memo_args = (args, kwargs)
+        return self
+
+    def __init_subclass__(cls, **kwargs):
+        super(OSContextGenerator, cls).__init_subclass__(**kwargs)
+        if '__call__' in cls.__dict__:
+            cls.__call__ = _memoize_context(cls.__dict__['__call__'])
+
     def __call__(self):
         raise NotImplementedError
 
@@ -1059,6 +1160,10 @@ class HAProxyContext(OSContextGenerator):
         #                 will be used for path /metrics. At the same time,
         #                 prometheus-exporter avoids using auth.
         haproxy_version = get_installed_version("haproxy")
+        try:
+            from distutils.version import LooseVersion
+        except ImportError:
+            from looseversion import LooseVersion
         if (haproxy_version and
                 haproxy_version.ver_str >= LooseVersion("2.0.0") and
                 is_relation_made("haproxy-exporter")):
@@ -1736,6 +1841,11 @@ def _num_cpus():
 
     @returns: int: number of CPU cores detected
     '''
+    try:
+        import psutil
+    except ImportError:
+        apt_install('python3-psutil', fatal=True)
+        import psutil
     try:
         return psutil.cpu_count()
     except AttributeError:
@@ -2595,6 +2705,7 @@ def resolve_pci_from_mapping_config(config_key):
     :returns: PCI device address to Tuple(entity, mac) map
     :rtype: collections.OrderedDict[str,Tuple[str,str]]
     """
+    from charmhelpers.contrib.hardware import pci
     devices = pci.PCINetDevices()
     resolved_devices = collections.OrderedDict()
     db = kv()
@@ -3314,6 +3425,7 @@ class SRIOVContext(OSContextGenerator):
         numvfs_key = numvfs_key or 'sriov-numvfs'
         device_mappings_key = device_mappings_key or 'sriov-device-mappings'
 
+        from charmhelpers.contrib.hardware import pci
         devices = pci.PCINetDevices()
         charm_config = config()
         sriov_numvfs = charm_config.get(numvfs_key) or ''
@@ -3466,5 +3578,6 @@ class CephBlueStoreCompressionContext(OSContextGenerator):
         # dictionary comprehension in the call to the initializer.
         dummy_op = {'name': 'dummy-name'}
         dummy_op.update(self.op)
+        import charmhelpers.contrib.storage.linux.ceph as ch_ceph
         pool = ch_ceph.BasePool('dummy-service', op=dummy_op)
         pool.validate()
@@ -12,29 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+from collections import OrderedDict
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    charm_dir,
+    data_changed,
     log,
+    DEBUG,
     ERROR,
     INFO,
     TRACE
 )
+from charmhelpers.core.profiling import profile_span
+from charmhelpers.core.unitdata import kv
+from charmhelpers.contrib.openstack.context import context_memo_scope
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
-try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
-except ImportError:
-    apt_update(fatal=True)
-    apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+# Directory within the charm in which compiled templates are cached.
+JINJA_CACHE_DIR = '.jinja-cache'
 
 
 class OSConfigException(Exception):
     pass
 
 
+def _jinja2():
+    """
+    Import jinja2 on first use, installing it if necessary; hooks which
+    render nothing don't pay for importing it.
+    """
+    try:
+        import jinja2
+    except ImportError:
+        apt_update(fatal=True)
+        apt_install('python3-jinja2', fatal=True)
+        import jinja2
+    return jinja2
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -56,6 +77,7 @@ def get_loader(templates_dir, os_release):
         jinja2.FilesystemLoaders, ordered in descending
         order by OpenStack release.
     """
+    jinja2 = _jinja2()
     tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
                  for rel in OPENSTACK_CODENAMES.values()]
 
@@ -66,21 +88,91 @@ def get_loader(templates_dir, os_release):
 
     # the bottom contains tempaltes_dir and possibly a common templates dir
     # shipped with the helper.
-    loaders = [FileSystemLoader(templates_dir)]
+    loaders = [jinja2.FileSystemLoader(templates_dir)]
     helper_templates = os.path.join(os.path.dirname(__file__), 'templates')
     if os.path.isdir(helper_templates):
-        loaders.append(FileSystemLoader(helper_templates))
+        loaders.append(jinja2.FileSystemLoader(helper_templates))
 
     for rel, tmpl_dir in tmpl_dirs:
         if os.path.isdir(tmpl_dir):
-            loaders.insert(0, FileSystemLoader(tmpl_dir))
+            loaders.insert(0, jinja2.FileSystemLoader(tmpl_dir))
         if rel == os_release:
             break
     # demote this log to the lowest level; we don't really need to see these
     # lots in production even when debugging.
     log('Creating choice loader with dirs: %s' %
         [l.searchpath for l in loaders], level=TRACE)
-    return ChoiceLoader(loaders)
+    return jinja2.ChoiceLoader(loaders)
+
+
+def get_bytecode_cache_dir(os_release):
+    """
+    Return the directory in which templates compiled for os_release are
+    cached, keyed by the charm revision, or None when not running in a charm.
+
+    :param os_release (str): OpenStack release codename.
+    :returns: str or None
+    """
+    if not charm_dir():
+        return None
+    try:
+        with open(os.path.join(charm_dir(), 'revision')) as f:
+            revision = f.read().strip()
+    except OSError:
+        revision = 'unknown'
+    return os.path.join(charm_dir(), JINJA_CACHE_DIR,
+                        '{}-{}'.format(revision, os_release))
+
+
+def flush_bytecode_cache():
+    """
+    Remove all cached compiled templates, e.g. on upgrade-charm.
+    """
+    if charm_dir():
+        shutil.rmtree(os.path.join(charm_dir(), JINJA_CACHE_DIR),
+                      ignore_errors=True)
+
+
+def prune_bytecode_cache(keep):
+    """
+    Remove the templates cached for other charm revisions or releases than
+    the cache directory keep, e.g. after an OpenStack upgrade.
+
+    :param keep (str): cache directory in use.
+    """
+    parent = os.path.dirname(keep)
+    try:
+        names = os.listdir(parent)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(parent, name)
+        if path != keep:
+            log('Removing stale compiled templates {}'.format(path),
+                level=DEBUG)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_bytecode_cache(directory):
+    """
+    Return a jinja2 bytecode cache storing compiled templates in directory,
+    which is created on demand.  Failures to store compiled templates are
+    treated as cache misses.
+
+    :param directory (str): cache directory
+    :returns: jinja2.FileSystemBytecodeCache
+    """
+    class CharmBytecodeCache(_jinja2().FileSystemBytecodeCache):
+
+        def dump_bytecode(self, bucket):
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                super(CharmBytecodeCache, self).dump_bytecode(bucket)
+            except OSError as e:
+                log('Unable to cache compiled template {}: {}'.format(
+                    bucket.key, e), level=DEBUG)
+
+    return CharmBytecodeCache(directory)
 
 
 class OSConfigTemplate(object):
@@ -215,12 +307,12 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
-
-        if None in [Environment, ChoiceLoader, FileSystemLoader]:
-            # if this code is running, the object is created pre-install hook.
-            # jinja2 shouldn't get touched until the module is reloaded on next
-            # hook execution, with proper jinja2 bits successfully imported.
-            apt_install('python3-jinja2')
+        self._templates_signature = None
+        # What write() did for each config file: 'skipped' when the
+        # context and templates are unchanged since the file was last
+        # written, 'unchanged' when rendering produced the same bytes as
+        # are on disk and 'written' otherwise.
+        self.write_decisions = OrderedDict()
 
     def register(self, config_file, contexts, config_template=None):
         """
@@ -243,7 +335,13 @@ class OSConfigRenderer(object):
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            bytecode_cache = None
+            cache_dir = get_bytecode_cache_dir(self.openstack_release)
+            if cache_dir:
+                prune_bytecode_cache(cache_dir)
+                bytecode_cache = get_bytecode_cache(cache_dir)
+            self._tmpl_env = _jinja2().Environment(
+                loader=loader, bytecode_cache=bytecode_cache)
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -269,9 +367,11 @@ class OSConfigRenderer(object):
             log('Config not registered: {}'.format(config_file), level=ERROR)
             raise OSConfigException
 
-        ostmpl = self.templates[config_file]
-        ctxt = ostmpl.context()
+        return self._render(config_file, self.templates[config_file].context())
 
+    def _render(self, config_file, ctxt):
+        exceptions = _jinja2().exceptions
+        ostmpl = self.templates[config_file]
         if ostmpl.is_string_template:
             template = self._get_template_from_string(ostmpl)
             log('Rendering from a string template: '
@@ -300,29 +400,161 @@ class OSConfigRenderer(object):
 
             log('Rendering from template: {}'.format(config_file),
                 level=INFO)
-        return template.render(ctxt)
+        with profile_span('template', config_file):
+            return template.render(ctxt)
+
+    def _get_templates_signature(self):
+        """Return a digest of the name, size and mtime of every file the
+        template loader can read templates from, so that a change to any
+        template, including included ones, changes the fingerprints."""
+        if self._templates_signature is None:
+            self._get_tmpl_env()
+            digest = hashlib.sha256(self.openstack_release.encode('UTF-8'))
+            for loader in self._tmpl_env.loader.loaders:
+                for path in loader.searchpath:
+                    for root, dirs, files in os.walk(path):
+                        dirs.sort()
+                        for name in sorted(files):
+                            st = os.stat(os.path.join(root, name))
+                            digest.update('{}:{}:{}\n'.format(
+                                os.path.join(root, name), st.st_size,
+                                st.st_mtime_ns).encode('UTF-8'))
+            self._templates_signature = digest.hexdigest()
+        return self._templates_signature
+
+    def _fingerprint(self, config_file, ctxt):
+        """Fingerprint the inputs of rendering config_file with ctxt.
+
+        :returns: the fingerprint, or None if ctxt can't be serialized, e.g.
+                  a dict with keys of mixed types, which can't be sorted.
+        :rtype: Optional[str]
+        """
+        ostmpl = self.templates[config_file]
+        try:
+            serialized = json.dumps(ctxt, sort_keys=True, default=str)
+        except TypeError as e:
+            log('Not fingerprinting %s: %s' % (config_file, e), level=DEBUG)
+            return None
+        digest = hashlib.sha256(serialized.encode('UTF-8'))
+        if ostmpl.is_string_template:
+            digest.update(ostmpl.config_template.encode('UTF-8'))
+        else:
+            digest.update(self._get_templates_signature().encode('UTF-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """Replace path with data, keeping the owner and mode of an existing
+        file, unless it already holds exactly data.
+
+        :returns: True if the file was written.
+        :rtype: bool
+        """
+        path = os.path.realpath(path)
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+            st = os.stat(path)
+        except (IOError, OSError):
+            st = None
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.{}.'.format(os.path.basename(path)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+            if st is not None:
+                os.chown(tmp, st.st_uid, st.st_gid)
+                os.chmod(tmp, st.st_mode & 0o7777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp, 0o666 & ~umask)
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return True
 
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        Rendering is skipped when the evaluated context and the templates are
+        unchanged since the file was last written and the file on disk still
+        has the content that was written; the file is only replaced when the
+        rendered bytes differ. See write_decisions.
+
+        The fingerprint is saved in unitdata but not flushed, it is committed
+        with the rest of the hook's unit state.
+        """
+        db = kv()
+        fingerprints = db.get('templating-fingerprints', {})
+        if self._write(config_file, fingerprints):
+            db.set('templating-fingerprints', fingerprints)
+
+    def _write(self, config_file, fingerprints):
+        """Write config_file, recording what was written in fingerprints.
+
+        :returns: True if fingerprints was updated.
+        :rtype: bool
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file).encode('UTF-8')
-
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        with context_memo_scope():
+            ctxt = self.templates[config_file].context()
+        fingerprint = self._fingerprint(config_file, ctxt)
+        last = fingerprints.get(config_file)
+        if fingerprint and last and last['fingerprint'] == fingerprint:
+            try:
+                with open(config_file, 'rb') as f:
+                    on_disk = hashlib.sha256(f.read()).hexdigest()
+            except (IOError, OSError):
+                on_disk = None
+            if on_disk == last['sha256']:
+                self.write_decisions[config_file] = 'skipped'
+                log('Skipped rendering %s, context and templates unchanged.'
+                    % config_file, level=DEBUG)
+                return False
+
+        _out = self._render(config_file, ctxt).encode('UTF-8')
+
+        if self._write_atomic(config_file, _out):
+            self.write_decisions[config_file] = 'written'
+            log('Wrote template %s.' % config_file, level=INFO)
+        else:
+            self.write_decisions[config_file] = 'unchanged'
+            log('Template %s unchanged.' % config_file, level=DEBUG)
 
-        log('Wrote template %s.' % config_file, level=INFO)
+        if fingerprint is None:
+            return fingerprints.pop(config_file, None) is not None
+        fingerprints[config_file] = {
+            'fingerprint': fingerprint,
+            'sha256': hashlib.sha256(_out).hexdigest(),
+        }
+        return True
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        The fingerprints of the files written are saved once, including
+        those written before a failure to write a later file, and committed
+        with the rest of the hook's unit state.
         """
-        for k in self.templates.keys():
-            self.write(k)
+        db = kv()
+        fingerprints = db.get('templating-fingerprints', {})
+        changed = False
+        try:
+            with context_memo_scope():
+                for k in self.templates.keys():
+                    changed = self._write(k, fingerprints) or changed
+        finally:
+            if changed:
+                db.set('templating-fingerprints', fingerprints)
 
     def set_release(self, openstack_release):
         """
@@ -330,16 +562,20 @@ class OSConfigRenderer(object):
         based on a the new openstack release.
         """
         self._tmpl_env = None
+        self._templates_signature = None
         self.openstack_release = openstack_release
         self._get_tmpl_env()
+        # Context generators may depend on the release.
+        data_changed()
 
     def complete_contexts(self):
         '''
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        for i in self.templates.values():
-            interfaces.extend(i.complete_contexts())
+        with context_memo_scope():
+            for i in self.templates.values():
+                interfaces.extend(i.complete_contexts())
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
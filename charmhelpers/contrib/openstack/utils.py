@@ -1837,7 +1837,8 @@ def pausable_restart_on_change(restart_map, stopstart=False,
                                restart_functions=None,
                                can_restart_now_f=None,
                                post_svc_restart_f=None,
-                               pre_restarts_wait_f=None):
+                               pre_restarts_wait_f=None,
+                               restart_dependencies=None):
     """A restart_on_change decorator that checks to see if the unit is
     paused. If it is paused then the decorated function doesn't fire.
 
@@ -1881,6 +1882,10 @@ def pausable_restart_on_change(restart_map, stopstart=False,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param restart_dependencies: services each service depends on, see
+                                 core.host.restart_on_change_helper().
+    :type restart_dependencies: Union[Callable[[],],
+                                      Dict[str, List[str]]]
     :returns: decorator to use a restart_on_change with pausability
     :rtype: decorator
 
@@ -1905,7 +1910,8 @@ def pausable_restart_on_change(restart_map, stopstart=False,
                 restart_functions,
                 can_restart_now_f,
                 post_svc_restart_f,
-                pre_restarts_wait_f)
+                pre_restarts_wait_f,
+                restart_dependencies)
         return wrapped_f
     return wrap
 
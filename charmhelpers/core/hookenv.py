@@ -18,10 +18,6 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 import copy
-try:
-    from distutils.version import LooseVersion
-except ImportError:
-    from looseversion import LooseVersion
 from enum import Enum
 from functools import wraps
 from collections import namedtuple, UserDict
@@ -61,7 +57,64 @@ class WORKLOAD_STATES(Enum):
     WAITING = 'waiting'
 
 
+# Incremented whenever the charm changes relation, leader or config data,
+# see data_generation().
+_data_generation = 0
+
+
+def data_generation():
+    """Return a counter which changes whenever relation, leader or config
+    data is changed by the charm, so that data derived from it within a hook
+    can be invalidated."""
+    return _data_generation
+
+
+def data_changed():
+    """Record that data hook code derives state from, e.g. relation, leader
+    or config data, has changed; see data_generation()."""
+    global _data_generation
+    _data_generation += 1
+
+
+# Results of @cached functions: {function: {argument key: result}}.
 cache = {}
+# The string arguments of cached calls (unit names, relation ids, ...)
+# mapped to the cache entries they were passed to, so that flush_unit() and
+# flush_relation() look them up rather than scanning the cache; and the
+# reverse, to keep the two consistent.
+_cache_index = {}
+_cache_entry_args = {}
+# Hits and misses of each @cached function, see cache_info().
+_cache_stats = {}
+
+
+def _cache_key(args, kwargs):
+    """Return a hashable cache key for a call's arguments."""
+    key = (args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        key = json.dumps((args, kwargs), sort_keys=True, default=str)
+    return key
+
+
+def _drop_cache_entry(entry):
+    """Drop a (function, argument key) cache entry and its index entries."""
+    func, key = entry
+    cache.get(func, {}).pop(key, None)
+    for arg in _cache_entry_args.pop(entry, ()):
+        entries = _cache_index.get(arg)
+        if entries is not None:
+            entries.discard(entry)
+            if not entries:
+                del _cache_index[arg]
+
+
+def _flush_cached(func):
+    """Drop all cached results of func."""
+    for key in list(cache.get(func, ())):
+        _drop_cache_entry((func, key))
+    cache.pop(func, None)
 
 
 def cached(func):
@@ -76,31 +129,94 @@ def cached(func):
         unit_get('test')
 
     will cache the result of unit_get + 'test' for future calls.
+
+    unit_get.flush() drops all cached results of unit_get.
     """
+    stats = _cache_stats.setdefault(
+        '{}.{}'.format(func.__module__, func.__name__), [0, 0])
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
+        key = _cache_key(args, kwargs)
+        results = cache.setdefault(func, {})
         try:
-            return cache[key]
+            res = results[key]
         except KeyError:
             pass  # Drop out of the exception handler scope.
+        else:
+            stats[0] += 1
+            return res
+        stats[1] += 1
         res = func(*args, **kwargs)
-        cache[key] = res
+        results[key] = res
+        entry = (func, key)
+        index_args = {arg for arg in args + tuple(kwargs.values())
+                      if isinstance(arg, str)}
+        if index_args:
+            _cache_entry_args[entry] = index_args
+            for arg in index_args:
+                _cache_index.setdefault(arg, set()).add(entry)
         return res
     wrapper._wrapped = func
+    wrapper.flush = lambda: _flush_cached(func)
     return wrapper
 
 
+def _flush_argument(value):
+    """Drop the cached results of calls which were passed value."""
+    for entry in list(_cache_index.get(value, ())):
+        _drop_cache_entry(entry)
+
+
+def flush_unit(unit):
+    """Flush the cached results of calls which were passed unit, e.g.
+    'glance/1', as an argument, along with its relation data snapshots."""
+    _flush_argument(unit)
+    flush_relation_snapshots(name=unit)
+    data_changed()
+
+
+def flush_relation(rid):
+    """Flush the cached results of calls which were passed the relation id
+    rid, e.g. 'cluster:1', as an argument, along with the relation data
+    snapshots of that relation."""
+    _flush_argument(rid)
+    flush_relation_snapshots(rid=rid)
+    data_changed()
+
+
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache which were called with an
+    argument containing key, along with any relation data snapshots of the
+    unit or relation key.
+
+    This scans every cached argument and also matches e.g. 'glance/10' for
+    'glance/1'; use flush_unit() or flush_relation() to flush a unit or
+    relation."""
+    for arg in [arg for arg in _cache_index if key in arg]:
+        _flush_argument(arg)
+    flush_relation_snapshots(rid=key)
+    flush_relation_snapshots(name=key)
+    data_changed()
+
+
+def cache_info():
+    """Return the cache hits and misses of each @cached function which has
+    been called.
+
+    :returns: {function name: {'hits': int, 'misses': int}}
+    :rtype: Dict[str, Dict[str, int]]
+    """
+    return {name: {'hits': hits, 'misses': misses}
+            for name, (hits, misses) in _cache_stats.items()
+            if hits or misses}
+
+
+def log_cache_info(level=None):
+    """Log the cache hits and misses of the @cached functions, e.g. at hook
+    exit."""
+    log('Function cache usage: {}'.format(
+        json.dumps(cache_info(), sort_keys=True)), level=level or DEBUG)
 
 
 def log(message, level=None):
@@ -359,6 +475,14 @@ class Config(dict):
             self.load_previous()
         atexit(self._implicit_save)
 
+    def __setitem__(self, key, value):
+        super(Config, self).__setitem__(key, value)
+        data_changed()
+
+    def __delitem__(self, key):
+        super(Config, self).__delitem__(key)
+        data_changed()
+
     def load_previous(self, path=None):
         """Load previous copy of config from disk.
 
@@ -456,9 +580,72 @@ def config(scope=None):
         return None
 
 
-@cached
+# Complete relation data of a unit or application, fetched with a single
+# 'relation-get -' call and keyed by (relation id, unit or application name,
+# is application data).
+_relation_snapshots = {}
+
+
+def flush_relation_snapshots(rid=None, name=None):
+    """Drop relation data snapshots so that they are re-read on next use.
+
+    :param rid: only drop snapshots for this relation id.
+    :type rid: Optional[str]
+    :param name: only drop snapshots of this unit or application.
+    :type name: Optional[str]
+    """
+    for key in list(_relation_snapshots):
+        _rid, _name, _ = key
+        if rid is not None and _rid != rid:
+            continue
+        if name is not None and _name != name:
+            continue
+        del _relation_snapshots[key]
+
+
+def _relation_snapshot(unit=None, rid=None, app=None):
+    """Return the complete relation data of unit or app on relation rid.
+
+    The data is read once with 'relation-get -' and served from memory until
+    invalidated by relation_set(), flush_unit(), flush_relation() or flush().
+
+    :returns: the relation data or None if it is not available.
+    :rtype: Optional[Dict[str, str]]
+    """
+    _rid = rid or relation_id()
+    name = app if app is not None else (unit or remote_unit())
+    if not _rid or not name:
+        # Nothing to key the snapshot on, let relation-get resolve it.
+        return _relation_get(unit=unit, rid=rid, app=app)
+    key = (_rid, name, app is not None)
+    try:
+        return _relation_snapshots[key]
+    except KeyError:
+        pass
+    data = _relation_get(unit=unit, rid=_rid, app=app)
+    _relation_snapshots[key] = data
+    return data
+
+
 def relation_get(attribute=None, unit=None, rid=None, app=None):
-    """Get relation information"""
+    """Get relation information
+
+    Lookups are served from a snapshot of the unit's (or application's)
+    complete relation data so that reading several attributes only runs
+    relation-get once per unit and relation.
+    """
+    if app is not None and unit is not None:
+        raise ValueError("Cannot use both 'unit' and 'app'")
+    data = _relation_snapshot(unit=unit, rid=rid, app=app)
+    if data is None:
+        return None
+    if attribute is None:
+        return dict(data)
+    return data.get(attribute)
+
+
+def _relation_get(attribute=None, unit=None, rid=None, app=None):
+    """Run relation-get"""
     _args = ['relation-get', '--format=json']
     if app is not None:
         if unit is not None:
@@ -529,8 +716,15 @@ def relation_set(relation_id=None, relation_settings=None, app=False, **kwargs):
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
         subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+    # Only the local unit's (or application's) data on this relation changed
+    flush_relation_snapshots(
+        rid=relation_id or os.environ.get('JUJU_RELATION_ID'),
+        name=application_name() if app else local_unit())
+    flush_unit(local_unit())
+    # Cached readers which aggregate relation data aren't keyed by the unit.
+    for reader in (relation_for_unit, relations_for_id, relations_of_type,
+                   relations):
+        reader.flush()
 
 
 def relation_clear(r_id=None):
@@ -958,9 +1152,14 @@ class Hooks(object):
         self._hooks[name] = function
 
     def execute(self, args):
-        """Execute a registered hook based on args[0]"""
-        _run_atstart()
+        """Execute a registered hook based on args[0]
+
+        The hook is profiled if profiling is enabled, see
+        charmhelpers.core.profiling."""
+        from charmhelpers.core import profiling
         hook_name = os.path.basename(args[0])
+        profiling.start_profiling(hook_name)
+        _run_atstart()
         if hook_name in self._hooks:
             try:
                 self._hooks[hook_name]()
@@ -1242,6 +1441,7 @@ def leader_set(settings=None, **kwargs):
         else:
             cmd.append('{}={}'.format(k, v))
     subprocess.check_call(cmd)
+    data_changed()
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1307,6 +1507,11 @@ def juju_version():
 
 def has_juju_version(minimum_version):
     """Return True if the Juju version is at least the provided version"""
+    # distutils is slow to import and only needed here.
+    try:
+        from distutils.version import LooseVersion
+    except ImportError:
+        from looseversion import LooseVersion
     return LooseVersion(juju_version()) >= LooseVersion(minimum_version)
 
 
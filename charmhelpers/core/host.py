@@ -31,11 +31,15 @@ import subprocess
 import hashlib
 import functools
 import itertools
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from collections import OrderedDict, defaultdict
 from .hookenv import log, INFO, DEBUG, local_unit, charm_name
 from .fstab import Fstab
+from . import unitdata
+from .profiling import profile_span
 from charmhelpers.osplatform import get_platform
 
 __platform__ = get_platform()
@@ -59,6 +63,14 @@ elif __platform__ == "centos":
     )  # flake8: noqa -- ignore F401 for this import
 
 UPDATEDB_PATH = '/etc/updatedb.conf'
+# unitdata key of the stats and digests of the files restart_on_change()
+# last hashed.
+RESTART_ON_CHANGE_STATS_KEY = 'restart-on-change-file-stats'
+# Files are hashed in chunks of this many bytes.
+HASH_CHUNK_SIZE = 64 * 1024
+# A file modified within this many seconds of being hashed may be modified
+# again without its stat changing, so its digest isn't reused.
+RACY_MTIME_WINDOW = 2
 CA_CERT_DIR = '/usr/local/share/ca-certificates'
 
 
@@ -688,7 +700,8 @@ def file_hash(path, hash_type='md5'):
     if os.path.exists(path):
         h = getattr(hashlib, hash_type)()
         with open(path, 'rb') as source:
-            h.update(source.read())
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
         return h.hexdigest()
     else:
         return None
@@ -728,6 +741,68 @@ class ChecksumError(ValueError):
     pass
 
 
+class _FileDigests(object):
+    """blake2b digests of files, reusing those recorded in unitdata for
+    files whose stat hasn't changed since they were hashed.
+
+    Only the files hashed through an instance are recorded by save(), so
+    the record doesn't outgrow the restart map.
+    """
+
+    def __init__(self):
+        self._stats = None
+        self._seen = {}
+
+    def path_hash(self, path):
+        """Like path_hash(path).
+
+        :param path: file path, may contain wildcards.
+        :type path: str
+        :returns: {filename: digest}
+        :rtype: Dict[str, Optional[str]]
+        """
+        return {
+            filename: self.file_hash(filename)
+            for filename in glob.iglob(path)
+        }
+
+    def file_hash(self, filename):
+        """Return the digest of filename, or None if it doesn't exist.
+
+        :param filename: file path
+        :type filename: str
+        :rtype: Optional[str]
+        """
+        if filename in self._seen:
+            return self._seen[filename]['digest']
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if self._stats is None:
+            self._stats = unitdata.kv().get(RESTART_ON_CHANGE_STATS_KEY) or {}
+        stat = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                st.st_ctime_ns]
+        entry = self._stats.get(filename)
+        if not entry or entry['stat'] != stat or entry['racy']:
+            now = time.time()
+            entry = {
+                'stat': stat,
+                'digest': file_hash(filename, hash_type='blake2b'),
+                'racy': (now - max(st.st_mtime_ns, st.st_ctime_ns) / 1e9 <
+                         RACY_MTIME_WINDOW),
+            }
+        self._seen[filename] = entry
+        return entry['digest']
+
+    def save(self):
+        """Record the stats and digests of the files hashed."""
+        if self._seen and self._seen != self._stats:
+            db = unitdata.kv()
+            db.set(RESTART_ON_CHANGE_STATS_KEY, self._seen)
+            db.flush()
+
+
 class restart_on_change(object):
     """Decorator and context manager to handle restarts.
 
@@ -746,7 +821,7 @@ class restart_on_change(object):
 
     def __init__(self, restart_map, stopstart=False, restart_functions=None,
                  can_restart_now_f=None, post_svc_restart_f=None,
-                 pre_restarts_wait_f=None):
+                 pre_restarts_wait_f=None, restart_dependencies=None):
         """
         :param restart_map: {file: [service, ...]}
         :type restart_map: Dict[str, List[str,]]
@@ -763,6 +838,10 @@ class restart_on_change(object):
         :type post_svc_restart_f: Callable[[str], None]
         :param pre_restarts_wait_f: A function called before any restarts.
         :type pre_restarts_wait_f: Callable[None, None]
+        :param restart_dependencies: services each service depends on, see
+                                     restart_on_change_helper().
+        :type restart_dependencies: Union[Callable[[], Dict[str, List[str]]],
+                                          Dict[str, List[str]]]
         """
         self.restart_map = restart_map
         self.stopstart = stopstart
@@ -770,6 +849,7 @@ class restart_on_change(object):
         self.can_restart_now_f = can_restart_now_f
         self.post_svc_restart_f = post_svc_restart_f
         self.pre_restarts_wait_f = pre_restarts_wait_f
+        self.restart_dependencies = restart_dependencies
 
     def __call__(self, f):
         """Work like a decorator.
@@ -790,7 +870,8 @@ class restart_on_change(object):
                 restart_functions=self.restart_functions,
                 can_restart_now_f=self.can_restart_now_f,
                 post_svc_restart_f=self.post_svc_restart_f,
-                pre_restarts_wait_f=self.pre_restarts_wait_f)
+                pre_restarts_wait_f=self.pre_restarts_wait_f,
+                restart_dependencies=self.restart_dependencies)
         return wrapped_f
 
     def __enter__(self):
@@ -812,7 +893,8 @@ class restart_on_change(object):
                 restart_functions=self.restart_functions,
                 can_restart_now_f=self.can_restart_now_f,
                 post_svc_restart_f=self.post_svc_restart_f,
-                pre_restarts_wait_f=self.pre_restarts_wait_f)
+                pre_restarts_wait_f=self.pre_restarts_wait_f,
+                restart_dependencies=self.restart_dependencies)
         # All is good, so return False; any exceptions will propagate.
         return False
 
@@ -821,7 +903,8 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
                              restart_functions=None,
                              can_restart_now_f=None,
                              post_svc_restart_f=None,
-                             pre_restarts_wait_f=None):
+                             pre_restarts_wait_f=None,
+                             restart_dependencies=None):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
@@ -847,6 +930,16 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     occur. The use case for this is an application which wants to try and
     stagger restarts between units.
 
+    `restart_dependencies` maps a service to the services it depends on, e.g.
+    `{'haproxy': ['glance-api']}`, or is a function returning such a map
+    which is only called when services need restarting.  When it is given,
+    services are restarted in dependency order and services which don't
+    depend on one another are restarted concurrently, so `restart_functions`
+    must be thread safe.  `post_svc_restart_f`, e.g. a readiness check, is
+    called for each service of a group before any service depending on them
+    is restarted.  Without it services are restarted one at a time in
+    restart_map order.
+
     :param lambda_f: function to call.
     :type lambda_f: Callable[[], ANY]
     :param restart_map: {file: [service, ...]}
@@ -864,6 +957,9 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param restart_dependencies: services each service depends on.
+    :type restart_dependencies: Union[Callable[[], Dict[str, List[str]]],
+                                      Dict[str, List[str]]]
     :returns: result of lambda_f()
     :rtype: ANY
     """
@@ -875,7 +971,8 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
                                    restart_functions,
                                    can_restart_now_f,
                                    post_svc_restart_f,
-                                   pre_restarts_wait_f)
+                                   pre_restarts_wait_f,
+                                   restart_dependencies)
     return r
 
 
@@ -887,7 +984,10 @@ def _pre_restart_on_change_helper(restart_map):
     :returns: Dictionary of file paths and the files checksum.
     :rtype: Dict[str, str]
     """
-    return {path: path_hash(path) for path in restart_map}
+    # The digests are recorded once, by _post_restart_on_change_helper(),
+    # which hashes the same files.
+    digests = _FileDigests()
+    return {path: digests.path_hash(path) for path in restart_map}
 
 
 def _post_restart_on_change_helper(checksums,
@@ -896,7 +996,8 @@ def _post_restart_on_change_helper(checksums,
                                    restart_functions=None,
                                    can_restart_now_f=None,
                                    post_svc_restart_f=None,
-                                   pre_restarts_wait_f=None):
+                                   pre_restarts_wait_f=None,
+                                   restart_dependencies=None):
     """Check whether files have changed.
 
     :param checksums: Dictionary of file paths and the files checksum.
@@ -916,35 +1017,101 @@ def _post_restart_on_change_helper(checksums,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param restart_dependencies: services each service depends on.
+    :type restart_dependencies: Union[Callable[[], Dict[str, List[str]]],
+                                      Dict[str, List[str]]]
     """
     if restart_functions is None:
         restart_functions = {}
     changed_files = defaultdict(list)
     restarts = []
+    digests = _FileDigests()
     # create a list of lists of the services to restart
     for path, services in restart_map.items():
-        if path_hash(path) != checksums[path]:
+        if digests.path_hash(path) != checksums[path]:
             restarts.append(services)
             for svc in services:
                 changed_files[svc].append(path)
+    digests.save()
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
         if pre_restarts_wait_f:
-            pre_restarts_wait_f()
+            with profile_span('restart-wait', 'pre-restarts'):
+                pre_restarts_wait_f()
         actions = ('stop', 'start') if stopstart else ('restart',)
-        for service_name in services_list:
-            if can_restart_now_f:
-                if not can_restart_now_f(service_name,
-                                         changed_files[service_name]):
-                    continue
-            if service_name in restart_functions:
-                restart_functions[service_name](service_name)
+
+        def _restart(service_name):
+            with profile_span('restart', service_name):
+                if service_name in restart_functions:
+                    restart_functions[service_name](service_name)
+                else:
+                    for action in actions:
+                        service(action, service_name)
+
+        def _post_restart(service_name):
+            with profile_span('restart-wait', service_name):
+                post_svc_restart_f(service_name)
+
+        if restart_dependencies is None:
+            for service_name in services_list:
+                if can_restart_now_f:
+                    if not can_restart_now_f(service_name,
+                                             changed_files[service_name]):
+                        continue
+                _restart(service_name)
+                if post_svc_restart_f:
+                    _post_restart(service_name)
+            return
+        if callable(restart_dependencies):
+            restart_dependencies = restart_dependencies()
+        if can_restart_now_f:
+            services_list = [
+                service_name for service_name in services_list
+                if can_restart_now_f(service_name,
+                                     changed_files[service_name])]
+        for group in _restart_groups(services_list, restart_dependencies):
+            if len(group) == 1:
+                _restart(group[0])
             else:
-                for action in actions:
-                    service(action, service_name)
+                log('Restarting {} concurrently'.format(', '.join(group)),
+                    level=DEBUG)
+                with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                    # list() re-raises the first failed restart.
+                    list(executor.map(_restart, group))
             if post_svc_restart_f:
-                post_svc_restart_f(service_name)
+                for service_name in group:
+                    _post_restart(service_name)
+
+
+def _restart_groups(services, dependencies):
+    """Split services into groups to restart in order.
+
+    Services in a group only depend on services in earlier groups. Services
+    left in a dependency cycle are restarted one at a time in their original
+    order.
+
+    :param services: services to restart, in order
+    :type services: List[str]
+    :param dependencies: {service: [service it depends on, ...]}
+    :type dependencies: Dict[str, List[str]]
+    :returns: groups of services
+    :rtype: List[List[str]]
+    """
+    groups = []
+    remaining = list(services)
+    while remaining:
+        group = [svc for svc in remaining
+                 if not any(dep != svc and dep in remaining
+                            for dep in dependencies.get(svc, []))]
+        if not group:
+            log('Dependency cycle between {}'.format(', '.join(remaining)),
+                level=DEBUG)
+            groups.extend([svc] for svc in remaining)
+            break
+        groups.append(group)
+        remaining = [svc for svc in remaining if svc not in group]
+    return groups
 
 
 def pwgen(length=None):
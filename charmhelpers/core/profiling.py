@@ -0,0 +1,344 @@
+# Copyright 2014-2021 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in profiling of where a hook's time goes.
+
+Profiling is enabled by setting the CHARM_HOOK_PROFILE environment variable
+or the charm's ``profile-hooks`` config option, and started by
+Hooks.execute().  While it is enabled the time spent in named spans is
+accumulated:
+
+    - ``subprocess``: commands run through the subprocess module, by command
+      name, e.g. relation-get, config-get, systemctl;
+    - ``context``: OSContextGenerator calls, by class (memo hits included);
+    - ``template``: rendering of templates, by target file;
+    - ``restart``: service restarts, by service;
+    - ``restart-wait``: waiting around restarts, e.g. readiness checks.
+
+Spans nest, e.g. a context's time includes the hook tools it runs.  When the
+process exits one JSON line per hook, which also holds the hits and misses
+of the @cached hook tool functions, is appended to ``.hook-profile.jsonl``
+in the charm directory, or to the file CHARM_HOOK_PROFILE_FILE names.
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from charmhelpers.core.hookenv import (
+    cache_info,
+    charm_dir,
+    config,
+    local_unit,
+    log,
+    DEBUG,
+    WARNING,
+)
+
+PROFILE_ENV = 'CHARM_HOOK_PROFILE'
+PROFILE_FILE_ENV = 'CHARM_HOOK_PROFILE_FILE'
+PROFILE_CONFIG_KEY = 'profile-hooks'
+PROFILE_FILE = '.hook-profile.jsonl'
+# The profile file is moved aside to <file>.1 when it grows beyond this.
+PROFILE_FILE_MAX_SIZE = 4 * 1024 * 1024
+
+# The profile of this process while profiling, see start_profiling().
+_profile = None
+# Restarts may run concurrently, see host.restart_on_change_helper().
+_profile_lock = threading.Lock()
+# subprocess functions replaced while profiling: {name: original}
+_subprocess_originals = {}
+
+
+def profiling():
+    """Return True if this process is profiling its hook."""
+    return _profile is not None
+
+
+@contextlib.contextmanager
+def profile_span(category, name):
+    """Add the time spent in the with block to the span name of category.
+
+    Does nothing unless profiling.
+
+    :param category: kind of span, e.g. 'template'
+    :type category: str
+    :param name: span within category, e.g. '/etc/glance/glance-api.conf'
+    :type name: str
+    """
+    if _profile is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _record_span(category, name, time.monotonic() - start)
+
+
+def _record_span(category, name, seconds):
+    with _profile_lock:
+        if _profile is None:
+            return
+        span = _profile['spans'].setdefault(category, {}).setdefault(
+            name, {'count': 0, 'seconds': 0.0})
+        span['count'] += 1
+        span['seconds'] += seconds
+
+
+def _command_name(args, shell=False):
+    if isinstance(args, (str, bytes)):
+        if isinstance(args, bytes):
+            args = args.decode('UTF-8', 'replace')
+        args = args.split() if shell else [args]
+    args = list(args or [''])
+    command = args[0]
+    if isinstance(command, bytes):
+        command = command.decode('UTF-8', 'replace')
+    return os.path.basename(str(command))
+
+
+def _timed_subprocess(f):
+    @functools.wraps(f)
+    def wrapper(*popenargs, **kwargs):
+        args = popenargs[0] if popenargs else kwargs.get('args')
+        name = _command_name(args, kwargs.get('shell', False))
+        with profile_span('subprocess', name):
+            return f(*popenargs, **kwargs)
+    return wrapper
+
+
+def profiling_requested():
+    """Check whether profiling is enabled by the environment or config.
+
+    :rtype: bool
+    """
+    requested = os.environ.get(PROFILE_ENV)
+    if requested is not None:
+        return requested.lower() not in ('', '0', 'false', 'no', 'off')
+    try:
+        return bool(config(PROFILE_CONFIG_KEY))
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def start_profiling(hook_name):
+    """Start profiling hook_name if profiling is enabled.
+
+    The profile is written when the process exits, so that work the charm
+    does after Hooks.execute(), e.g. assessing its status, is included.
+    Calling this again while profiling does nothing.
+
+    :param hook_name: name of the hook being run
+    :type hook_name: str
+    """
+    global _profile
+    if _profile is not None or not profiling_requested():
+        return
+    _profile = {
+        'hook': hook_name,
+        'timestamp': time.time(),
+        'error': None,
+        'spans': {},
+        '_start': time.monotonic(),
+    }
+    # check_output() and check_call() call run() and call() respectively,
+    # so each command is timed once however it was started.
+    for name in ('run', 'call'):
+        _subprocess_originals[name] = getattr(subprocess, name)
+        setattr(subprocess, name, _timed_subprocess(getattr(subprocess, name)))
+    excepthook = sys.excepthook
+
+    def _excepthook(exc_type, exc_value, exc_tb):
+        if _profile is not None:
+            _profile['error'] = exc_type.__name__
+        excepthook(exc_type, exc_value, exc_tb)
+
+    sys.excepthook = _excepthook
+    atexit.register(stop_profiling)
+
+
+def stop_profiling():
+    """Stop profiling and append the profile to the profile file.
+
+    :returns: the profile, or None if not profiling
+    :rtype: Optional[Dict[str, Any]]
+    """
+    global _profile
+    if _profile is None:
+        return None
+    for name, original in _subprocess_originals.items():
+        setattr(subprocess, name, original)
+    _subprocess_originals.clear()
+    with _profile_lock:
+        profile, _profile = _profile, None
+    profile['wall'] = time.monotonic() - profile.pop('_start')
+    profile['unit'] = local_unit()
+    profile['cache'] = cache_info()
+    path = profile_file()
+    if path:
+        try:
+            _append_profile(path, profile)
+        except OSError as e:
+            log('Unable to write hook profile to {}: {}'.format(path, e),
+                level=WARNING)
+        else:
+            log('Hook profile written to {}'.format(path), level=DEBUG)
+    return profile
+
+
+def profile_file():
+    """Return the path of the profile file, or None outside a charm."""
+    path = os.environ.get(PROFILE_FILE_ENV)
+    if path:
+        return path
+    if charm_dir():
+        return os.path.join(charm_dir(), PROFILE_FILE)
+    return None
+
+
+def _append_profile(path, profile):
+    try:
+        if os.path.getsize(path) > PROFILE_FILE_MAX_SIZE:
+            os.replace(path, path + '.1')
+    except FileNotFoundError:
+        pass
+    with open(path, 'a') as f:
+        f.write(json.dumps(profile, sort_keys=True) + '\n')
+
+
+def read_profiles(path=None, limit=None):
+    """Read recorded hook profiles, oldest first.
+
+    :param path: profile file, defaults to profile_file()
+    :type path: Optional[str]
+    :param limit: only return the most recent limit profiles
+    :type limit: Optional[int]
+    :returns: profiles as written by stop_profiling()
+    :rtype: List[Dict[str, Any]]
+    """
+    path = path or profile_file()
+    profiles = []
+    if not path:
+        return profiles
+    for _path in (path + '.1', path):
+        try:
+            with open(_path) as f:
+                for line in f:
+                    try:
+                        profiles.append(json.loads(line))
+                    except ValueError:
+                        # Truncated by a full disk or an interrupted write.
+                        continue
+        except FileNotFoundError:
+            continue
+    if limit:
+        profiles = profiles[-limit:]
+    return profiles
+
+
+def summarize_profiles(profiles, top=10):
+    """Summarize hook profiles.
+
+    :param profiles: profiles as returned by read_profiles()
+    :type profiles: List[Dict[str, Any]]
+    :param top: number of spans to list, by total time
+    :type top: int
+    :returns: {'profiles': count, 'wall': total wall time,
+               'hooks': {hook: {'count', 'seconds', 'mean', 'max',
+                                'errors'}},
+               'categories': {category: seconds},
+               'spans': [{'category', 'name', 'count', 'seconds'}],
+               'cache': {function: {'hits', 'misses'}}}
+    :rtype: Dict[str, Any]
+    """
+    hooks = {}
+    categories = {}
+    spans = {}
+    cache = {}
+    for profile in profiles:
+        hook = hooks.setdefault(profile['hook'], {
+            'count': 0, 'seconds': 0.0, 'max': 0.0, 'errors': 0})
+        hook['count'] += 1
+        hook['seconds'] += profile['wall']
+        hook['max'] = max(hook['max'], profile['wall'])
+        if profile.get('error'):
+            hook['errors'] += 1
+        for category, names in profile['spans'].items():
+            for name, span in names.items():
+                categories[category] = (
+                    categories.get(category, 0.0) + span['seconds'])
+                total = spans.setdefault(
+                    (category, name), {'category': category, 'name': name,
+                                       'count': 0, 'seconds': 0.0})
+                total['count'] += span['count']
+                total['seconds'] += span['seconds']
+        for name, usage in profile.get('cache', {}).items():
+            total = cache.setdefault(name, {'hits': 0, 'misses': 0})
+            total['hits'] += usage['hits']
+            total['misses'] += usage['misses']
+    for hook in hooks.values():
+        hook['mean'] = hook['seconds'] / hook['count']
+    return {
+        'profiles': len(profiles),
+        'wall': sum(hook['seconds'] for hook in hooks.values()),
+        'hooks': hooks,
+        'categories': categories,
+        'spans': sorted(spans.values(),
+                        key=lambda span: span['seconds'],
+                        reverse=True)[:top],
+        'cache': cache,
+    }
+
+
+def format_summary(summary):
+    """Format a summary from summarize_profiles() as a text report.
+
+    :rtype: str
+    """
+    wall = summary['wall'] or 1.0
+    lines = ['{} hook profiles, {:.2f}s in total'.format(
+        summary['profiles'], summary['wall']), '',
+        '{:<40} {:>6} {:>6} {:>9} {:>9}'.format(
+            'hook', 'count', 'errors', 'mean(s)', 'max(s)')]
+    for name, hook in sorted(summary['hooks'].items(),
+                             key=lambda item: item[1]['seconds'],
+                             reverse=True):
+        lines.append('{:<40} {:>6} {:>6} {:>9.2f} {:>9.2f}'.format(
+            name, hook['count'], hook['errors'], hook['mean'], hook['max']))
+    lines.extend(['', '{:<40} {:>9} {:>6}'.format(
+        'category (spans nest)', 'total(s)', 'share')])
+    for category, seconds in sorted(summary['categories'].items(),
+                                    key=lambda item: item[1], reverse=True):
+        lines.append('{:<40} {:>9.2f} {:>5.0%}'.format(
+            category, seconds, seconds / wall))
+    lines.extend(['', '{:<13} {:<40} {:>6} {:>9} {:>9}'.format(
+        'category', 'span', 'count', 'total(s)', 'mean(s)')])
+    for span in summary['spans']:
+        lines.append('{:<13} {:<40} {:>6} {:>9.2f} {:>9.3f}'.format(
+            span['category'], span['name'], span['count'], span['seconds'],
+            span['seconds'] / span['count']))
+    if summary.get('cache'):
+        lines.extend(['', '{:<54} {:>9} {:>9}'.format(
+            'cached function', 'hits', 'misses')])
+        for name, usage in sorted(summary['cache'].items()):
+            lines.append('{:<54} {:>9} {:>9}'.format(
+                name, usage['hits'], usage['misses']))
+    return '\n'.join(lines)
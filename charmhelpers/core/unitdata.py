@@ -149,7 +149,6 @@ associated to the hookname.
 import collections
 import contextlib
 import datetime
-import itertools
 import json
 import logging
 import os
@@ -159,6 +158,33 @@ import sys
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# Values are only updated when they change, so that the number of rows
+# changed tells whether a revision needs recording.
+_UPSERT_KV = '''
+    insert into kv (key, data) values (?, ?)
+    on conflict (key) do update set data = excluded.data
+    where data != excluded.data'''
+_UPSERT_REVISION = '''
+    insert into kv_revisions (key, revision, data) values (?, ?, ?)
+    on conflict (key, revision) do update set data = excluded.data'''
+# Upserts need SQLite 3.24; older versions update the rows which exist and
+# insert the others.
+_HAVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24)
+_UPDATE_KV = 'update kv set data = ? where key = ? and data != ?'
+_INSERT_KV = 'insert or ignore into kv (key, data) values (?, ?)'
+_REPLACE_REVISION = '''
+    insert or replace into kv_revisions (key, revision, data)
+    values (?, ?, ?)'''
+# Keys per query, within SQLite's default limit of host parameters.
+_MAX_VARIABLES = 500
+
+# Hook revisions kept by Storage.compact() by default: at most this many,
+# and none older than this.
+HISTORY_MAX_REVISIONS = 10000
+HISTORY_MAX_AGE = datetime.timedelta(days=30)
+# hook_scope() compacts the history every this many revisions.
+HISTORY_COMPACT_INTERVAL = 100
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -171,10 +197,24 @@ class Storage(object):
     Note: to facilitate unit testing, ':memory:' can be passed as the
     path parameter which causes sqlite3 to only build the db in memory.
     This should only be used for testing purposes.
+
+    With read_cache, values read or written are kept in memory, so that
+    get() only queries the database once per key.  Only use it where no
+    other process writes to the database meanwhile, e.g. within a hook.
+
+    The hooks and revisions recorded by hook_scope() are limited to the
+    last history_max_revisions, and to those recorded within
+    history_max_age, see compact(); None removes either limit.
     """
-    def __init__(self, path=None, keep_revisions=False):
+    def __init__(self, path=None, keep_revisions=False, read_cache=False,
+                 history_max_revisions=HISTORY_MAX_REVISIONS,
+                 history_max_age=HISTORY_MAX_AGE):
         self.db_path = path
         self.keep_revisions = keep_revisions
+        self.history_max_revisions = history_max_revisions
+        self.history_max_age = history_max_age
+        # {key: serialized value, or None if not set}
+        self._read_cache = {} if read_cache else None
         if path is None:
             if 'UNIT_STATE_DB' in os.environ:
                 self.db_path = os.environ['UNIT_STATE_DB']
@@ -186,6 +226,13 @@ class Storage(object):
                 os.fchmod(f.fileno(), 0o600)
         self.conn = sqlite3.connect('%s' % self.db_path)
         self.cursor = self.conn.cursor()
+        if self.db_path != ':memory:':
+            # Commits append to the write-ahead log rather than rewriting
+            # the database through a rollback journal, and are only synced
+            # at checkpoints; a commit may be lost on power failure, but
+            # the database stays consistent.
+            self.cursor.execute('pragma journal_mode=WAL')
+            self.cursor.execute('pragma synchronous=NORMAL')
         self.revision = None
         self._closed = False
         self._init()
@@ -199,13 +246,22 @@ class Storage(object):
         self._closed = True
 
     def get(self, key, default=None, record=False):
-        self.cursor.execute('select data from kv where key=?', [key])
-        result = self.cursor.fetchone()
-        if not result:
+        if self._read_cache is not None and key in self._read_cache:
+            data = self._read_cache[key]
+        else:
+            self.cursor.execute('select data from kv where key=?', [key])
+            result = self.cursor.fetchone()
+            data = result[0] if result else None
+            self._cache(key, data)
+        if data is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(data))
+        return json.loads(data)
+
+    def _cache(self, key, data):
+        if self._read_cache is not None:
+            self._read_cache[key] = data
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -236,18 +292,62 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        serialized = [("%s%s" % (prefix, k), json.dumps(v))
+                      for k, v in mapping.items()]
+        if self.keep_revisions and self.revision:
+            # Only changed keys get a revision.
+            current = self._getmany([key for key, _ in serialized])
+            serialized = [(key, data) for key, data in serialized
+                          if current.get(key) != data]
+        if not serialized:
+            return
+        self._write_kv(serialized)
+        for key, data in serialized:
+            self._cache(key, data)
+        if self.keep_revisions and self.revision:
+            self._write_revisions(
+                [(key, self.revision, data) for key, data in serialized])
+
+    def _write_kv(self, rows):
+        """Insert or update (key, serialized value) rows.
+
+        :returns: the number of rows changed.
+        :rtype: int
+        """
+        if _HAVE_UPSERT:
+            self.cursor.executemany(_UPSERT_KV, rows)
+            return self.cursor.rowcount
+        self.cursor.executemany(
+            _UPDATE_KV, [(data, key, data) for key, data in rows])
+        changed = self.cursor.rowcount
+        self.cursor.executemany(_INSERT_KV, rows)
+        return changed + self.cursor.rowcount
+
+    def _write_revisions(self, rows):
+        """Insert or update (key, revision, serialized value) rows."""
+        self.cursor.executemany(
+            _UPSERT_REVISION if _HAVE_UPSERT else _REPLACE_REVISION, rows)
+
+    def _getmany(self, keys):
+        """Return {key: serialized value} of those of keys which are set."""
+        found = {}
+        for i in range(0, len(keys), _MAX_VARIABLES):
+            chunk = keys[i:i + _MAX_VARIABLES]
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            found.update(self.cursor.fetchall())
+        return found
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
         self.cursor.execute('delete from kv where key=?', [key])
+        self._cache(key, None)
         if self.keep_revisions and self.revision and self.cursor.rowcount:
-            self.cursor.execute(
-                'insert into kv_revisions values (?, ?, ?)',
-                [key, self.revision, json.dumps('DELETED')])
+            self._write_revisions(
+                [(key, self.revision, json.dumps('DELETED'))])
 
     def unsetrange(self, keys=None, prefix=""):
         """
@@ -260,18 +360,24 @@ class Storage(object):
         """
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
-            self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
+            self.cursor.executemany('delete from kv where key=?',
+                                    [(key,) for key in keys])
+            for key in keys:
+                self._cache(key, None)
             if self.keep_revisions and self.revision and self.cursor.rowcount:
-                self.cursor.execute(
-                    'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
-                    list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
+                deleted = json.dumps('DELETED')
+                self._write_revisions(
+                    [(key, self.revision, deleted) for key in keys])
         else:
             self.cursor.execute('delete from kv where key like ?',
                                 ['%s%%' % prefix])
+            if self._read_cache is not None:
+                # like also matches keys which don't start with prefix,
+                # e.g. with _ or in another case.
+                self._read_cache.clear()
             if self.keep_revisions and self.revision and self.cursor.rowcount:
-                self.cursor.execute(
-                    'insert into kv_revisions values (?, ?, ?)',
-                    ['%s%%' % prefix, self.revision, json.dumps('DELETED')])
+                self._write_revisions(
+                    [('%s%%' % prefix, self.revision, json.dumps('DELETED'))])
 
     def set(self, key, value):
         """
@@ -282,46 +388,20 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
         # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
-
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+        if (self._read_cache is not None and
+                self._read_cache.get(key) == serialized):
+            return value
+        changed = self._write_kv([(key, serialized)])
+        self._cache(key, serialized)
+        if not changed:
+            return value
 
         # Save
         if (not self.keep_revisions) or (not self.revision):
             return value
 
-        self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+        self._write_revisions([(key, self.revision, serialized)])
 
         return value
 
@@ -364,6 +444,8 @@ class Storage(object):
             (name or sys.argv[0],
              datetime.datetime.utcnow().isoformat()))
         self.revision = self.cursor.lastrowid
+        if self.revision % HISTORY_COMPACT_INTERVAL == 0:
+            self.compact()
         try:
             yield self.revision
             self.revision = None
@@ -374,6 +456,38 @@ class Storage(object):
         else:
             self.flush()
 
+    def compact(self):
+        """Remove the hooks and revisions beyond the history limits."""
+        cutoff = 0
+        if self.history_max_revisions is not None:
+            self.cursor.execute('select max(version) from hooks')
+            latest = self.cursor.fetchone()[0] or 0
+            cutoff = latest - self.history_max_revisions
+        if self.history_max_age is not None:
+            oldest = datetime.datetime.utcnow() - self.history_max_age
+            # Dates are ISO 8601, so sort as strings.
+            self.cursor.execute(
+                'select max(version) from hooks where date < ?',
+                [oldest.isoformat()])
+            cutoff = max(cutoff, self.cursor.fetchone()[0] or 0)
+        if cutoff <= 0:
+            return
+        self.cursor.execute('delete from kv_revisions where revision <= ?',
+                            [cutoff])
+        self.cursor.execute('delete from hooks where version <= ?', [cutoff])
+
+    def vacuum(self):
+        """Compact the history and rebuild the database file, releasing the
+        space of removed rows.
+
+        Pending changes are committed first.
+        """
+        self.compact()
+        self.flush()
+        self.cursor.execute('vacuum')
+        if self.db_path != ':memory:':
+            self.cursor.execute('pragma wal_checkpoint(TRUNCATE)')
+
     def flush(self, save=True):
         if save:
             self.conn.commit()
@@ -381,6 +495,8 @@ class Storage(object):
             return
         else:
             self.conn.rollback()
+            if self._read_cache is not None:
+                self._read_cache.clear()
 
     def _init(self):
         self.cursor.execute('''
@@ -396,6 +512,10 @@ class Storage(object):
                data text,
                primary key (key, revision)
                )''')
+        # For compact(); gethistory() uses the primary key.
+        self.cursor.execute('''
+            create index if not exists kv_revisions_revision
+               on kv_revisions (revision)''')
         self.cursor.execute('''
             create table if not exists hooks (
                version integer primary key autoincrement,
@@ -412,6 +532,7 @@ class Storage(object):
                  hooks h
             where kv.key=?
              and kv.revision = h.version
+            order by kv.revision
             ''', [key])
         if deserialize is False:
             return self.cursor.fetchall()
@@ -552,11 +673,13 @@ def kv():
         # Help the linter realise that in_memory_db is always set
         raise Exception("Cannot reach this line")
 
+    # The unit agent runs one hook at a time, so the database doesn't
+    # change under the process while it runs.
     if _KV is None:
         if in_memory_db:
-            _KV = Storage(":memory:")
+            _KV = Storage(":memory:", read_cache=True)
         else:
-            _KV = Storage()
+            _KV = Storage(read_cache=True)
     else:
         if in_memory_db and _KV.db_path != ":memory:":
             logging.warning("Running with in_memory_db and KV is not set to :memory:")
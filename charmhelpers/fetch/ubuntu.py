@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from collections import OrderedDict
+import hashlib
+import os
 import platform
 import re
 import subprocess
@@ -20,6 +22,7 @@ import sys
 import time
 
 from charmhelpers import deprecate
+from charmhelpers.core import unitdata
 from charmhelpers.core.host import get_distrib_codename, get_system_env
 
 from charmhelpers.core.hookenv import (
@@ -366,18 +369,71 @@ CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
 CMD_RETRY_COUNT = 10  # Retry a failing fatal command X times.
 
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# The installed packages index, see _installed_packages().
+_dpkg_status = {'stat': None, 'packages': {}}
+
+
+def _installed_packages():
+    """Return the packages dpkg has installed.
+
+    The index is read from DPKG_STATUS, and read again only when dpkg has
+    changed that file, so that checking for installed packages does not
+    run dpkg-query or apt-cache.
+
+    :returns: {package: version}, with each package also listed as
+              package:architecture.
+    :rtype: Dict[str, str]
+    """
+    try:
+        st = os.stat(DPKG_STATUS)
+    except FileNotFoundError:
+        return {}
+    stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if _dpkg_status['stat'] == stat:
+        return _dpkg_status['packages']
+    packages = {}
+    fields = {}
+    with open(DPKG_STATUS, encoding='UTF-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                _index_package(packages, fields)
+                fields = {}
+            elif not line[0].isspace() and ':' in line:
+                name, value = line.split(':', 1)
+                fields[name] = value.strip()
+    _index_package(packages, fields)
+    _dpkg_status.update(stat=stat, packages=packages)
+    return packages
+
+
+def _index_package(packages, fields):
+    if (not fields.get('Package') or
+            not fields.get('Status', '').endswith(' installed')):
+        return
+    packages[fields['Package']] = fields.get('Version', '')
+    if fields.get('Architecture'):
+        packages['{Package}:{Architecture}'.format(**fields)] = fields.get(
+            'Version', '')
+
+
+def _missing_packages(packages):
+    installed = _installed_packages()
+    return [package for package in packages if package not in installed]
+
+
 def filter_installed_packages(packages):
     """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
+    _pkgs = _missing_packages(packages)
+    if _pkgs:
+        cache = apt_cache()
+        for package in _pkgs:
+            try:
+                cache[package]
+            except KeyError:
+                log('Package {} has no installation candidate.'
+                    .format(package), level='WARNING')
     return _pkgs
 
 
@@ -423,9 +479,13 @@ def apt_cache(*_, **__):
     return ubuntu_apt_pkg.Cache()
 
 
-def apt_install(packages, options=None, fatal=False, quiet=False):
+def apt_install(packages, options=None, fatal=False, quiet=False,
+                upgrade=False):
     """Install one or more packages.
 
+    Nothing is run if all of the packages are already installed, unless
+    upgrade is True or options include --reinstall.
+
     :param packages: Package(s) to install
     :type packages: Option[str, List[str]]
     :param options: Options to pass on to apt-get
@@ -435,21 +495,28 @@ def apt_install(packages, options=None, fatal=False, quiet=False):
     :type fatal: bool
     :param quiet: if True (default), suppress log message to stdout/stderr
     :type quiet: bool
+    :param upgrade: if True, run apt-get even if the packages are installed,
+                    so that they are upgraded to their candidate versions.
+    :type upgrade: bool
     :raises: subprocess.CalledProcessError
     """
     if not packages:
         log("Nothing to install", level=DEBUG)
         return
+    if isinstance(packages, str):
+        packages = [packages]
     if options is None:
         options = ['--option=Dpkg::Options::=--force-confold']
 
+    if not (upgrade or '--reinstall' in options or
+            _missing_packages(packages)):
+        log("{} already installed".format(packages), level=DEBUG)
+        return
+
     cmd = ['apt-get', '--assume-yes']
     cmd.extend(options)
     cmd.append('install')
-    if isinstance(packages, str):
-        cmd.append(packages)
-    else:
-        cmd.extend(packages)
+    cmd.extend(packages)
     if not quiet:
         log("Installing {} with options: {}"
             .format(packages, options))
@@ -481,12 +548,111 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
-def apt_update(fatal=False):
-    """Update local apt cache."""
+APT_SOURCES_LIST = '/etc/apt/sources.list'
+APT_SOURCES_PARTS = '/etc/apt/sources.list.d'
+APT_LISTS_DIR = '/var/lib/apt/lists'
+# Unit state of the last apt_update(), see _apt_update_state().
+APT_UPDATE_KEY = 'charmhelpers.fetch.apt-update'
+
+
+def _sources_fingerprint():
+    """Return the sha256 of each APT source file.
+
+    :rtype: Dict[str, str]
+    """
+    paths = [APT_SOURCES_LIST]
+    try:
+        paths.extend(
+            os.path.join(APT_SOURCES_PARTS, name)
+            for name in sorted(os.listdir(APT_SOURCES_PARTS))
+            if name.endswith(('.list', '.sources')))
+    except FileNotFoundError:
+        pass
+    fingerprint = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                fingerprint[path] = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            continue
+    return fingerprint
+
+
+def _lists_mtime():
+    try:
+        return os.stat(APT_LISTS_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _apt_update_state():
+    """Return the unit state recorded by the last apt_update().
+
+    :returns: {'sources': fingerprint of the sources updated,
+               'lists': mtime of APT_LISTS_DIR after the update,
+               'updated': time of the last update of all sources}, or None
+    :rtype: Optional[Dict[str, Any]]
+    """
+    return unitdata.kv().get(APT_UPDATE_KEY)
+
+
+def _set_apt_update_state(sources, updated):
+    db = unitdata.kv()
+    db.set(APT_UPDATE_KEY, {'sources': sources, 'lists': _lists_mtime(),
+                            'updated': updated})
+    db.flush()
+
+
+def apt_update(fatal=False, max_age=None):
+    """Update local apt cache.
+
+    With max_age, the last update is recorded in the unit's state and the
+    indexes are only updated again if they are older than max_age seconds,
+    if the APT sources have changed or if something else changed the lists
+    directory since.  If only source files were added or changed while the
+    indexes of the others are still fresh, just those files are updated.
+    An update is only recorded if all of its fetches succeeded.
+
+    :param fatal: Whether the command's output should be checked and
+                  retried.
+    :type fatal: bool
+    :param max_age: age in seconds up to which indexes are kept; None or 0
+                    always updates them.
+    :type max_age: Optional[int]
+    """
     cmd = ['apt-get', 'update']
-    if fatal:
+    if fatal or max_age:
+        # Without it apt-get update succeeds when fetches fail, which would
+        # be recorded as fresh indexes.
         cmd.append("--error-on=any")
-    _run_apt_command(cmd, fatal)
+    if not max_age:
+        _run_apt_command(cmd, fatal)
+        return
+
+    sources = _sources_fingerprint()
+    state = _apt_update_state()
+    if (state is None or state['lists'] != _lists_mtime() or
+            time.time() - state['updated'] >= max_age or
+            not set(state['sources']) <= set(sources)):
+        # A command which is not fatal returns its exit code.
+        if not _run_apt_command(cmd, fatal):
+            _set_apt_update_state(sources, time.time())
+        return
+    changed = [path for path, digest in sources.items()
+               if state['sources'].get(path) != digest]
+    if not changed:
+        log("APT sources unchanged and indexes fresh, skipping apt update",
+            level=DEBUG)
+        return
+    for path in changed:
+        log("Updating APT indexes of {}".format(path), level=DEBUG)
+        if _run_apt_command(
+                cmd + ['-o', 'Dir::Etc::sourcelist={}'.format(path),
+                       '-o', 'Dir::Etc::sourceparts=-',
+                       '-o', 'APT::Get::List-Cleanup=0'],
+                fatal):
+            return
+    _set_apt_update_state(sources, state['updated'])
 
 
 def apt_purge(packages, fatal=False):
@@ -1040,6 +1206,8 @@ def _run_apt_command(cmd, fatal=False, quiet=False):
     :param quiet: if True, silence the output of the command from stdout and
         stderr
     :type quiet: bool
+    :returns: the exit code of a command which is not fatal
+    :rtype: Optional[int]
     """
     if fatal:
         _run_with_retries(
@@ -1050,7 +1218,7 @@ def _run_apt_command(cmd, fatal=False, quiet=False):
         if quiet:
             kwargs['stdout'] = subprocess.DEVNULL
             kwargs['stderr'] = subprocess.DEVNULL
-        subprocess.call(cmd, env=get_apt_dpkg_env(), **kwargs)
+        return subprocess.call(cmd, env=get_apt_dpkg_env(), **kwargs)
 
 
 def get_upstream_version(package):
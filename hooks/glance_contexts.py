@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 from charmhelpers.core.strutils import (
     bytes_from_string
 )
@@ -34,6 +36,7 @@ from charmhelpers.contrib.openstack.context import (
     BindHostContext,
     VolumeAPIContext,
     IdentityServiceContext,
+    WSGIWorkerConfigContext,
 )
 
 from charmhelpers.contrib.hahelpers.cluster import (
@@ -42,11 +45,20 @@ from charmhelpers.contrib.hahelpers.cluster import (
     https,
 )
 
+from charmhelpers.core.host import (
+    CompareHostReleases,
+    lsb_release,
+)
+
 from charmhelpers.contrib.openstack.utils import (
     os_release,
     CompareOpenStackReleases,
 )
 
+IMAGE_CACHE_DIR = '/var/lib/glance/image-cache/'
+SWIFT_UPLOAD_BUFFER_DIR = '/var/lib/glance/swift-upload-buffer/'
+GLANCE_WSGI_SCRIPT = '/usr/bin/glance-wsgi-api'
+
 
 class GlanceContext(OSContextGenerator):
 
@@ -75,6 +87,90 @@ class GlanceContext(OSContextGenerator):
         return ctxt
 
 
+class DatabasePoolContext(OSContextGenerator):
+    """oslo.db connection pool settings for the [database] section.
+
+    The pool is per worker process, so the oslo.db defaults of 5 pooled and
+    10 overflow connections per worker are kept unless configured.
+    """
+
+    def __call__(self):
+        ctxt = {
+            'database_connection_recycle_time': config(
+                'database-connection-recycle-time'),
+        }
+        if config('database-max-pool-size') is not None:
+            ctxt['database_max_pool_size'] = config('database-max-pool-size')
+        if config('database-max-overflow') is not None:
+            ctxt['database_max_overflow'] = config('database-max-overflow')
+        if config('database-pool-timeout') is not None:
+            ctxt['database_pool_timeout'] = config('database-pool-timeout')
+        if config('database-max-retries') is not None:
+            ctxt['database_max_retries'] = config('database-max-retries')
+        return ctxt
+
+
+class GlanceServerTuningContext(OSContextGenerator):
+    """Socket settings for the eventlet based glance-api and glance-registry
+    servers.
+    """
+
+    SOMAXCONN = '/proc/sys/net/core/somaxconn'
+
+    config_keys = {
+        'backlog': 'listen-backlog',
+        'max_header_line': 'max-header-line',
+        'client_socket_timeout': 'client-socket-timeout',
+        'tcp_keepidle': 'tcp-keepidle',
+    }
+
+    @classmethod
+    def somaxconn(cls):
+        """Return the kernel limit on the listen backlog of a socket.
+
+        :returns: value of net.core.somaxconn or None if it can't be read.
+        :rtype: Optional[int]
+        """
+        try:
+            with open(cls.SOMAXCONN) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def __call__(self):
+        try:
+            self.validate()
+        except ValueError as e:
+            juju_log('Invalid server tuning config: {}'.format(e),
+                     level=ERROR)
+            return {}
+        ctxt = {}
+        for key, config_key in self.config_keys.items():
+            if config(config_key) is not None:
+                ctxt[key] = config(config_key)
+        somaxconn = self.somaxconn()
+        if (somaxconn and ctxt['backlog'] > somaxconn and
+                not config('raise-somaxconn')):
+            juju_log('listen-backlog {} exceeds net.core.somaxconn {}, the '
+                     'kernel will silently truncate it'
+                     .format(ctxt['backlog'], somaxconn), level=WARNING)
+        return ctxt
+
+    def validate(self):
+        backlog = config('listen-backlog')
+        if not backlog or backlog < 1:
+            raise ValueError(
+                "listen-backlog must be a positive integer, got {}"
+                .format(backlog))
+        for config_key in ('max-header-line', 'client-socket-timeout',
+                           'tcp-keepidle'):
+            value = config(config_key)
+            if value is not None and value < 0:
+                raise ValueError(
+                    "{} must not be negative, got {}"
+                    .format(config_key, value))
+
+
 class GlancePolicyContext(OSContextGenerator):
     """This Context is only used from Ussuri onwards.  At Ussuri, Glance
     implemented policy-in-code, and thus didn't ship with a policy.json.
@@ -147,6 +243,94 @@ class GlanceImageImportContext(OSContextGenerator):
         return
 
 
+class GlanceImageCacheContext(OSContextGenerator):
+    """Configure the glance-api local image cache.
+
+    Enables the cachemanagement paste flavor, sizes the cache and provides
+    the schedules for the systemd timers driving glance-cache-pruner and
+    glance-cache-cleaner.
+    """
+
+    def __call__(self):
+        try:
+            self.validate()
+        except ValueError:
+            # ValueError will be handled in assess_status and the charm status
+            # will be blocked there.
+            return {}
+
+        if not config('image-cache-enabled'):
+            return {}
+
+        return {
+            'image_cache_enabled': True,
+            'image_cache_dir': IMAGE_CACHE_DIR,
+            'image_cache_max_size': self.max_size(),
+            'image_cache_stall_time': config('image-cache-stall-time'),
+            'image_cache_prefetcher_interval': config(
+                'image-cache-prefetcher-interval'),
+            'image_cache_pruner_schedule': config(
+                'image-cache-pruner-schedule'),
+            'image_cache_cleaner_schedule': config(
+                'image-cache-cleaner-schedule'),
+        }
+
+    @staticmethod
+    def _backing_fs_size(path):
+        """Return the size in bytes of the filesystem holding path.
+
+        As the cache directory may not have been created yet, walk up to the
+        nearest existing parent directory.
+        """
+        while not os.path.exists(path):
+            path = os.path.dirname(path.rstrip('/')) or '/'
+        st = os.statvfs(path)
+        return st.f_blocks * st.f_frsize
+
+    def max_size(self):
+        """Resolve image-cache-max-size to a number of bytes.
+
+        :returns: maximum size of the image cache in bytes
+        :rtype: int
+        :raises: ValueError if the option cannot be parsed
+        """
+        value = str(config('image-cache-max-size')).replace(' ', '').upper()
+        if value.endswith('%'):
+            try:
+                percent = float(value[:-1])
+            except ValueError:
+                raise ValueError('invalid percentage: {}'.format(value))
+            if not 0 < percent <= 100:
+                raise ValueError('percentage out of range: {}'.format(value))
+            return int(self._backing_fs_size(IMAGE_CACHE_DIR) * percent / 100)
+        try:
+            return bytes_from_string(value)
+        except (ValueError, KeyError):
+            raise ValueError('invalid size: {}'.format(value))
+
+    def validate(self):
+        if not config('image-cache-enabled'):
+            return
+        _release = os_release('glance-common')
+        if CompareOpenStackReleases(_release) < 'ussuri':
+            juju_log('Not enabling image cache: The charm supports the '
+                     'image cache only for Ussuri or later releases. Your '
+                     'release is {}'.format(_release), level=ERROR)
+            raise ValueError('{} is not supported'.format(_release))
+        try:
+            self.max_size()
+        except ValueError as e:
+            juju_log('Unable to parse value for image-cache-max-size ({}), '
+                     'see config.yaml for information about valid '
+                     'formatting'.format(config('image-cache-max-size')),
+                     level=ERROR)
+            raise ValueError('image-cache-max-size: {}'.format(str(e)))
+        for key in ('image-cache-pruner-schedule',
+                    'image-cache-cleaner-schedule'):
+            if not config(key):
+                raise ValueError('{} must not be empty'.format(key))
+
+
 class CephGlanceContext(OSContextGenerator):
     interfaces = ['ceph-glance']
 
@@ -177,6 +361,59 @@ class CephGlanceContext(OSContextGenerator):
         }
 
 
+class CephClientTuningContext(OSContextGenerator):
+    """RBD store and librados/librbd client tuning.
+
+    Provides the RBD chunking options for the glance-api [ceph] backend
+    section and the client settings rendered into the [client] section of
+    the charm's ceph.conf.
+    """
+
+    client_config_keys = (
+        ('rbd-objecter-inflight-ops', 'objecter inflight ops'),
+        ('rbd-objecter-inflight-op-bytes', 'objecter inflight op bytes'),
+        ('rbd-cache-size', 'rbd cache size'),
+    )
+
+    def __call__(self):
+        try:
+            self.validate()
+        except ValueError:
+            # ValueError will be handled in assess_status and the charm status
+            # will be blocked there.
+            return {}
+
+        client_settings = {}
+        for key, option in self.client_config_keys:
+            if config(key) is not None:
+                client_settings[option] = config(key)
+        if config('rbd-cache-size'):
+            client_settings['rbd cache'] = 'true'
+        if config('rbd-cache-writethrough-until-flush') is not None:
+            client_settings['rbd cache writethrough until flush'] = str(
+                config('rbd-cache-writethrough-until-flush')).lower()
+
+        ctxt = {
+            'rbd_store_chunk_size': config('rbd-store-chunk-size'),
+            'rbd_client_cache_settings': client_settings,
+        }
+        if config('rbd-thin-provisioning'):
+            ctxt['rbd_thin_provisioning'] = 'true'
+        return ctxt
+
+    def validate(self):
+        chunk_size = config('rbd-store-chunk-size')
+        if (not isinstance(chunk_size, int) or chunk_size < 1 or
+                chunk_size & (chunk_size - 1)):
+            juju_log('Invalid value for rbd-store-chunk-size ({}), it must '
+                     'be a power of two'.format(chunk_size), level=ERROR)
+            raise ValueError('rbd-store-chunk-size must be a power of two')
+        for key, _ in self.client_config_keys:
+            value = config(key)
+            if value is not None and value < 0:
+                raise ValueError('{} must not be negative'.format(key))
+
+
 class ObjectStoreContext(OSContextGenerator):
     interfaces = ['object-store']
 
@@ -192,6 +429,60 @@ class ObjectStoreContext(OSContextGenerator):
         }
 
 
+class SwiftStoreTuningContext(OSContextGenerator):
+    """Swift large object, upload buffering and container sharding options.
+
+    Used for both the [swift] backend section of glance-api.conf and
+    glance-swift.conf.
+    """
+
+    def __call__(self):
+        if not relation_ids('object-store'):
+            return {}
+        try:
+            self.validate()
+        except ValueError:
+            # ValueError will be handled in assess_status and the charm status
+            # will be blocked there.
+            return {}
+
+        ctxt = {
+            'swift_store_large_object_size': config(
+                'swift-store-large-object-size'),
+            'swift_store_large_object_chunk_size': config(
+                'swift-store-large-object-chunk-size'),
+            'swift_store_multi_tenant': str(
+                bool(config('swift-store-multi-tenant'))).lower(),
+            'swift_store_multiple_containers_seed': config(
+                'swift-store-multiple-containers-seed') or 0,
+        }
+        if config('swift-buffer-on-upload'):
+            # The directory is created by configure_swift_upload_buffer().
+            ctxt['swift_buffer_on_upload'] = 'true'
+            ctxt['swift_upload_buffer_dir'] = SWIFT_UPLOAD_BUFFER_DIR
+        return ctxt
+
+    def validate(self):
+        size = config('swift-store-large-object-size')
+        chunk_size = config('swift-store-large-object-chunk-size')
+        seed = config('swift-store-multiple-containers-seed') or 0
+        if not size or size < 1:
+            raise ValueError('swift-store-large-object-size must be '
+                             'positive')
+        if not chunk_size or chunk_size < 1:
+            raise ValueError('swift-store-large-object-chunk-size must be '
+                             'positive')
+        if chunk_size > size:
+            juju_log('swift-store-large-object-chunk-size ({}) is larger '
+                     'than swift-store-large-object-size ({})'
+                     .format(chunk_size, size), level=ERROR)
+            raise ValueError('swift-store-large-object-chunk-size must not '
+                             'exceed swift-store-large-object-size')
+        if not 0 <= seed <= 32:
+            raise ValueError('swift-store-multiple-containers-seed must be '
+                             'between 0 and 32')
+
+
 class ExternalS3Context(OSContextGenerator):
     required_config_keys = (
         "s3-store-host",
@@ -199,6 +490,7 @@ class ExternalS3Context(OSContextGenerator):
         "s3-store-secret-key",
         "s3-store-bucket",
     )
+    bucket_url_formats = ("auto", "virtual", "path")
 
     def __call__(self):
         try:
@@ -215,6 +507,15 @@ class ExternalS3Context(OSContextGenerator):
                 "s3_store_access_key": config("s3-store-access-key"),
                 "s3_store_secret_key": config("s3-store-secret-key"),
                 "s3_store_bucket": config("s3-store-bucket"),
+                "s3_store_create_bucket_on_put": str(
+                    bool(config("s3-store-create-bucket-on-put"))).lower(),
+                "s3_store_bucket_url_format": config(
+                    "s3-store-bucket-url-format"),
+                "s3_store_large_object_size": config(
+                    "s3-store-large-object-size"),
+                "s3_store_large_object_chunk_size": config(
+                    "s3-store-large-object-chunk-size"),
+                "s3_store_thread_pools": config("s3-store-thread-pools"),
             }
             if config("expose-image-locations"):
                 juju_log("Forcibly overriding expose_image_locations "
@@ -242,6 +543,7 @@ class ExternalS3Context(OSContextGenerator):
                     level=ERROR,
                 )
                 raise ValueError("{} is not supported".format(_release))
+            self.validate_tuning()
         elif any(required_values):
             juju_log(
                 "Unable to use S3 backend without all required S3 options "
@@ -254,6 +556,25 @@ class ExternalS3Context(OSContextGenerator):
             )
             raise ValueError("Missing necessary config options")
 
+    def validate_tuning(self):
+        """Check the S3 multipart upload and bucket addressing options."""
+        url_format = config("s3-store-bucket-url-format")
+        if url_format not in self.bucket_url_formats:
+            raise ValueError(
+                "s3-store-bucket-url-format must be one of {}".format(
+                    ", ".join(self.bucket_url_formats)))
+        size = config("s3-store-large-object-size")
+        chunk_size = config("s3-store-large-object-chunk-size")
+        if not size or size < 1:
+            raise ValueError("s3-store-large-object-size must be positive")
+        # S3 rejects multipart uploads with parts smaller than 5MB.
+        if not chunk_size or chunk_size < 5:
+            raise ValueError(
+                "s3-store-large-object-chunk-size must be at least 5")
+        thread_pools = config("s3-store-thread-pools")
+        if not thread_pools or thread_pools < 1:
+            raise ValueError("s3-store-thread-pools must be positive")
+
 
 class CinderStoreContext(OSContextGenerator):
     interfaces = ['cinder-volume-service', 'storage-backend']
@@ -280,13 +601,16 @@ class MultiBackendContext(OSContextGenerator):
         ceph_ctx = CephGlanceContext()()
         if not ceph_ctx:
             return
+        tuning_ctx = CephClientTuningContext()()
         ctx = {
-            "rbd_store_chunk_size": 8,
+            "rbd_store_chunk_size": tuning_ctx.get("rbd_store_chunk_size", 8),
             "rbd_store_pool": ceph_ctx["rbd_pool"],
             "rbd_store_user": ceph_ctx["rbd_user"],
             "rados_connect_timeout": 0,
             "rbd_store_ceph_conf": "/etc/ceph/ceph.conf",
         }
+        if tuning_ctx.get("rbd_thin_provisioning"):
+            ctx["rbd_thin_provisioning"] = tuning_ctx["rbd_thin_provisioning"]
         return ctx
 
     def _get_swift_config(self):
@@ -298,6 +622,7 @@ class MultiBackendContext(OSContextGenerator):
             "swift_store_config_file": "/etc/glance/glance-swift.conf",
             "swift_store_create_container_on_put": "true",
         }
+        ctx.update(SwiftStoreTuningContext()())
         return ctx
 
     def _get_s3_config(self):
@@ -305,10 +630,17 @@ class MultiBackendContext(OSContextGenerator):
         if not s3_ctx:
             return
         ctx = {
-            "s3_store_host": s3_ctx["s3_store_host"],
-            "s3_store_access_key": s3_ctx["s3_store_access_key"],
-            "s3_store_secret_key": s3_ctx["s3_store_secret_key"],
-            "s3_store_bucket": s3_ctx["s3_store_bucket"],
+            key: s3_ctx[key] for key in (
+                "s3_store_host",
+                "s3_store_access_key",
+                "s3_store_secret_key",
+                "s3_store_bucket",
+                "s3_store_create_bucket_on_put",
+                "s3_store_bucket_url_format",
+                "s3_store_large_object_size",
+                "s3_store_large_object_chunk_size",
+                "s3_store_thread_pools",
+            )
         }
         return ctx
 
@@ -454,6 +786,9 @@ class MultiStoreContext(OSContextGenerator):
 class HAProxyContext(OSContextGenerator):
     interfaces = ['cluster']
 
+    modes = ('tcp', 'http')
+    http_reuse_modes = ('never', 'safe', 'aggressive', 'always')
+
     def __call__(self):
         '''Extends the main charmhelpers HAProxyContext with a port mapping
         specific to this charm.
@@ -477,8 +812,169 @@ class HAProxyContext(OSContextGenerator):
         }
         ctxt['backend_options'] = backend_options
         ctxt['https'] = https()
+        try:
+            self.validate()
+        except ValueError as e:
+            juju_log('Invalid haproxy config: {}'.format(e), level=ERROR)
+            return ctxt
+        # NOTE: with https enabled haproxy passes TLS through to the apache
+        # frontend so it can only balance in tcp mode.
+        if config('haproxy-mode') == 'http' and not ctxt['https']:
+            ctxt['haproxy_http_mode'] = True
+            ctxt['haproxy_http_reuse'] = config('haproxy-http-reuse')
+        ctxt['server_maxconn'] = self.server_maxconn()
+        ctxt['server_maxqueue'] = config('haproxy-server-maxqueue')
+        ctxt['haproxy_maxconn'] = config('haproxy-maxconn')
+        ctxt['haproxy_tune_bufsize'] = config('haproxy-tune-bufsize')
+        # nbthread and cpu-map auto: need haproxy >= 1.8, where threads are
+        # experimental; they are only used by default from haproxy 2.0.
+        ubuntu_rel = CompareHostReleases(
+            lsb_release()['DISTRIB_CODENAME'].lower())
+        if (ubuntu_rel >= 'focal' or
+                (ubuntu_rel >= 'bionic' and config('haproxy-nbthread'))):
+            cpus = sorted(os.sched_getaffinity(0))
+            nbthread = self.nbthread(len(cpus))
+            ctxt['haproxy_nbthread'] = nbthread
+            if config('haproxy-cpu-pinning') and nbthread < len(cpus):
+                # pin the haproxy threads to the highest numbered cpus the
+                # unit may use.
+                ctxt['haproxy_cpu_map'] = 'auto:1/1-{} {}'.format(
+                    nbthread, self.cpu_ranges(cpus[-nbthread:]))
         return ctxt
 
+    @staticmethod
+    def nbthread(cpus):
+        """Number of haproxy threads; a quarter of the cpus, between one and
+        four, unless configured.
+
+        :param cpus: number of cpus of the unit.
+        :type cpus: int
+        :returns: number of threads.
+        :rtype: int
+        """
+        if config('haproxy-nbthread'):
+            return config('haproxy-nbthread')
+        return min(4, max(1, cpus // 4))
+
+    @staticmethod
+    def cpu_ranges(cpus):
+        """Format cpu ids as a haproxy cpu-map cpu set, e.g. [0, 2, 3, 4]
+        as '0 2-4'.
+
+        :param cpus: sorted cpu ids.
+        :type cpus: List[int]
+        :rtype: str
+        """
+        ranges = []
+        for cpu in cpus:
+            if ranges and ranges[-1][1] == cpu - 1:
+                ranges[-1][1] = cpu
+            else:
+                ranges.append([cpu, cpu])
+        return ' '.join(str(first) if first == last else
+                        '{}-{}'.format(first, last)
+                        for first, last in ranges)
+
+    @staticmethod
+    def server_maxconn():
+        """Maximum number of concurrent connections haproxy sends to each
+        glance-api unit before queueing requests.
+
+        When not configured this is derived from the number of WSGI processes
+        and threads; the eventlet glance-api is not limited by default as
+        each worker serves many requests concurrently.
+
+        :returns: maxconn or None for no limit.
+        :rtype: Optional[int]
+        """
+        if config('haproxy-server-maxconn'):
+            return config('haproxy-server-maxconn')
+        wsgi_ctxt = GlanceWSGIWorkerConfigContext()()
+        if wsgi_ctxt:
+            return wsgi_ctxt['processes'] * wsgi_ctxt['threads']
+        return None
+
+    def validate(self):
+        if config('haproxy-mode') not in self.modes:
+            raise ValueError(
+                "haproxy-mode must be one of {}, got '{}'"
+                .format(', '.join(self.modes), config('haproxy-mode')))
+        if config('haproxy-http-reuse') not in self.http_reuse_modes:
+            raise ValueError(
+                "haproxy-http-reuse must be one of {}, got '{}'"
+                .format(', '.join(self.http_reuse_modes),
+                        config('haproxy-http-reuse')))
+        for key in ('haproxy-server-maxconn', 'haproxy-server-maxqueue',
+                    'haproxy-nbthread', 'haproxy-tune-bufsize'):
+            value = config(key)
+            if value is not None and value < 0:
+                raise ValueError(
+                    "{} must not be negative, got {}".format(key, value))
+        if not config('haproxy-maxconn') or config('haproxy-maxconn') < 1:
+            raise ValueError(
+                "haproxy-maxconn must be a positive integer, got {}"
+                .format(config('haproxy-maxconn')))
+
+
+class GlanceWSGIWorkerConfigContext(WSGIWorkerConfigContext):
+    """Settings for serving glance-api from Apache mod_wsgi or uWSGI.
+
+    Returns an empty context when glance-api runs as the eventlet based
+    glance-api service, which is the default.
+    """
+
+    servers = ('eventlet', 'mod_wsgi', 'uwsgi')
+
+    def __init__(self):
+        super(GlanceWSGIWorkerConfigContext, self).__init__(
+            name='glance-api',
+            script=GLANCE_WSGI_SCRIPT,
+            user='glance',
+            group='glance')
+
+    def __call__(self):
+        try:
+            self.validate()
+        except ValueError as e:
+            juju_log('Invalid wsgi config: {}'.format(e), level=ERROR)
+            return {}
+        server = config('wsgi-server')
+        if server == 'eventlet':
+            return {}
+        ctxt = super(GlanceWSGIWorkerConfigContext, self).__call__()
+        if config('wsgi-processes'):
+            ctxt['processes'] = config('wsgi-processes')
+        ctxt.update({
+            'wsgi_server': server,
+            'port': determine_api_port(9292, singlenode_mode=True),
+            'bind_address': '[::]' if config('prefer-ipv6') else '0.0.0.0',
+            'threads': config('wsgi-threads') or 1,
+            'listen_backlog': config('wsgi-listen-backlog'),
+            'buffer_size': config('wsgi-buffer-size'),
+            'post_buffering': config('wsgi-post-buffering'),
+        })
+        return ctxt
+
+    def validate(self):
+        server = config('wsgi-server')
+        if server not in self.servers:
+            raise ValueError(
+                "wsgi-server must be one of {}, got '{}'"
+                .format(', '.join(self.servers), server))
+        if server == 'eventlet':
+            return
+        _release = os_release('glance-common')
+        if CompareOpenStackReleases(_release) < 'ussuri':
+            raise ValueError(
+                "wsgi-server '{}' requires OpenStack Ussuri or later"
+                .format(server))
+        for key in ('wsgi-processes', 'wsgi-threads', 'wsgi-listen-backlog',
+                    'wsgi-buffer-size', 'wsgi-post-buffering'):
+            value = config(key)
+            if value is not None and value < 0:
+                raise ValueError(
+                    "{} must not be negative, got {}".format(key, value))
+
 
 class ApacheSSLContext(SSLContext):
     interfaces = ['https']
@@ -0,0 +1,79 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deferred imports of charmhelpers subsystems only some hooks use.
+
+The stand-ins returned here are module level names like any other import,
+so they can be patched in the same way, but the module providing them is
+only imported when they are first called.
+"""
+
+import functools
+import importlib
+
+
+def lazy_import(module, *names):
+    """Return stand-ins for the functions or classes names of module.
+
+    Each stand-in imports module and calls the named attribute when called,
+    e.g. ``CephBrokerRq = lazy_import(CEPH, 'CephBrokerRq')``.
+
+    :param module: dotted name of the module
+    :type module: str
+    :param names: names of callables in module
+    :type names: str
+    :returns: a stand-in, or a tuple of stand-ins if several names are given
+    :rtype: Union[Callable, Tuple[Callable, ...]]
+    """
+    def _stand_in(name):
+        def _call(*args, **kwargs):
+            target = getattr(importlib.import_module(module), name)
+            return target(*args, **kwargs)
+        _call.__name__ = _call.__qualname__ = name
+        _call.__doc__ = 'Calls {}.{}, importing it on first use.'.format(
+            module, name)
+        return _call
+
+    stand_ins = tuple(_stand_in(name) for name in names)
+    if len(stand_ins) == 1:
+        return stand_ins[0]
+    return stand_ins
+
+
+def lazy_decorator(module, name):
+    """Return a stand-in for the decorator factory name of module.
+
+    The decorator is resolved, importing module, when the decorated function
+    is first called rather than when it is decorated.
+
+    :param module: dotted name of the module
+    :type module: str
+    :param name: name of a decorator factory in module, e.g. 'harden'
+    :type name: str
+    :returns: decorator factory
+    :rtype: Callable
+    """
+    def _factory(*dargs, **dkwargs):
+        def _decorator(f):
+            decorated = []
+
+            @functools.wraps(f)
+            def _wrapper(*args, **kwargs):
+                if not decorated:
+                    factory = getattr(importlib.import_module(module), name)
+                    decorated.append(factory(*dargs, **dkwargs)(f))
+                return decorated[0](*args, **kwargs)
+            return _wrapper
+        return _decorator
+    return _factory
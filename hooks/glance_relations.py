@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import os
 import sys
 
@@ -36,6 +37,12 @@ from subprocess import (
 
 from glance_utils import (
     backup_deprecated_configurations,
+    api_service_name,
+    configure_image_cache,
+    configure_storage,
+    configure_swift_upload_buffer,
+    configure_sysctl,
+    configure_wsgi_server,
     do_openstack_upgrade,
     migrate_database,
     register_configs,
@@ -60,6 +67,10 @@ from glance_utils import (
     remove_old_packages,
     deprecated_services,
     get_ceph_request,
+    release_storage,
+    restart_dependencies,
+    stagger_restarts,
+    wait_for_service_ready,
 )
 from charmhelpers.core.hookenv import (
     charm_dir,
@@ -69,11 +80,13 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     open_port,
     local_unit,
+    log_cache_info,
     relation_get,
     relation_set,
     relation_ids,
     related_units,
     service_name,
+    storage_get,
     UnregisteredHookError,
     status_set,
 )
@@ -104,7 +117,7 @@ from charmhelpers.contrib.openstack.utils import (
     openstack_upgrade_available,
     os_release,
     sync_db_with_multi_ipv6_addresses,
-    pausable_restart_on_change as restart_on_change,
+    pausable_restart_on_change,
     is_unit_paused_set,
     os_requires_version,
     series_upgrade_prepare,
@@ -113,13 +126,6 @@ from charmhelpers.contrib.openstack.utils import (
     is_db_initialised,
     is_db_maintenance_mode,
 )
-from charmhelpers.contrib.storage.linux.ceph import (
-    send_application_name,
-    send_request_if_needed,
-    is_request_complete,
-    ensure_ceph_keyring,
-    delete_keyring,
-)
 from charmhelpers.payload.execd import (
     execd_preinstall
 )
@@ -133,20 +139,47 @@ from charmhelpers.contrib.openstack.ip import (
 from charmhelpers.contrib.openstack.context import (
     ADDRESS_TYPES,
 )
-from charmhelpers.contrib.charmsupport import nrpe
-from charmhelpers.contrib.hardening.harden import harden
 
-from charmhelpers.contrib.openstack.cert_utils import (
-    get_certificate_request,
-    process_certificates,
-)
 from charmhelpers.contrib.openstack.policyd import (
     maybe_do_policyd_overrides,
     maybe_do_policyd_overrides_on_config_changed,
 )
+from charmhelpers.contrib.openstack.templating import (
+    flush_bytecode_cache,
+)
+from charmhelpers.core.unitdata import kv
+
+from glance_lazy import (
+    lazy_decorator,
+    lazy_import,
+)
+from glance_status import invalidate_status_assessment
+
+# Only some hooks use these subsystems, so defer importing them.
+(send_application_name,
+ send_request_if_needed,
+ is_request_complete,
+ ensure_ceph_keyring,
+ delete_keyring) = lazy_import(
+    'charmhelpers.contrib.storage.linux.ceph',
+    'send_application_name', 'send_request_if_needed', 'is_request_complete',
+    'ensure_ceph_keyring', 'delete_keyring')
+(get_certificate_request,
+ process_certificates) = lazy_import(
+    'charmhelpers.contrib.openstack.cert_utils',
+    'get_certificate_request', 'process_certificates')
+harden = lazy_decorator('charmhelpers.contrib.hardening.harden', 'harden')
 
 
 hooks = Hooks()
+
+# Restart backends before the frontends in front of them, once they are
+# ready, and stagger restarts between units.
+restart_on_change = functools.partial(
+    pausable_restart_on_change,
+    restart_dependencies=restart_dependencies,
+    post_svc_restart_f=wait_for_service_ready,
+    pre_restarts_wait_f=stagger_restarts)
 # Note that CONFIGS is now set up via resolve_CONFIGS so that it is not a
 # module load time constraint.
 CONFIGS = None
@@ -180,11 +213,12 @@ def install_hook():
     configure_installation_source(src)
 
     status_set('maintenance', 'Installing apt packages')
-    apt_update(fatal=True)
+    apt_update(fatal=True, max_age=config('apt-update-max-age'))
     # (ajkavanagh) LP: #1989538
     # Tactical fix to force openstack-release to match the configured
-    # installation source; note that it comes after apt_update().
-    apt_install(['openstack-release'], fatal=False, quiet=True)
+    # installation source; note that it comes after apt_update(), and that
+    # it is upgraded if it is already installed.
+    apt_install(['openstack-release'], fatal=False, quiet=True, upgrade=True)
     apt_install(determine_packages(), fatal=True)
 
     for service in SERVICES:
@@ -193,7 +227,7 @@ def install_hook():
     maybe_do_policyd_overrides(
         os_release('glance-common'),
         'glance',
-        restart_handler=lambda: service_restart('glance-api'))
+        restart_handler=lambda: service_restart(api_service_name()))
 
     # Make sure iscsid has a unique InitiatorName by starting iscsid
     # and invoking /lib/open-iscsi/startup-checks.sh indirectly as
@@ -223,7 +257,7 @@ def db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def db_changed():
     resolve_CONFIGS()
     if is_db_maintenance_mode():
@@ -293,7 +327,7 @@ def image_service_joined(relation_id=None):
 
 
 @hooks.hook('object-store-relation-joined')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def object_store_joined():
     resolve_CONFIGS()
     if 'identity-service' not in CONFIGS.complete_contexts():
@@ -320,7 +354,7 @@ def ceph_joined():
 
 
 @hooks.hook('ceph-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ceph_changed():
     resolve_CONFIGS()
     if 'ceph' not in CONFIGS.complete_contexts():
@@ -341,20 +375,20 @@ def ceph_changed():
         # guarantee that ceph resources are ready.
         # Don't restart if the unit is in maintenance mode
         if not is_unit_paused_set():
-            service_restart('glance-api')
+            service_restart(api_service_name())
     else:
         send_request_if_needed(get_ceph_request())
 
 
 @hooks.hook('ceph-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ceph_departed():
     resolve_CONFIGS()
     CONFIGS.write_all()
 
 
 @hooks.hook('ceph-relation-broken')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ceph_broken():
     resolve_CONFIGS()
     service = service_name()
@@ -383,7 +417,7 @@ def keystone_joined(relation_id=None):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def keystone_changed():
     resolve_CONFIGS()
     if 'identity-service' not in CONFIGS.complete_contexts():
@@ -405,7 +439,7 @@ def keystone_changed():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 @harden()
 def config_changed():
     resolve_CONFIGS()
@@ -422,7 +456,12 @@ def config_changed():
             resolve_CONFIGS(force_update=True)
 
     open_port(9292)
+    configure_sysctl()
     configure_https()
+    storage_attached()
+    configure_image_cache(CONFIGS)
+    configure_swift_upload_buffer()
+    configure_wsgi_server(CONFIGS)
 
     update_nrpe_config()
 
@@ -453,7 +492,7 @@ def config_changed():
     maybe_do_policyd_overrides_on_config_changed(
         os_release('glance-common'),
         'glance',
-        restart_handler=lambda: service_restart('glance-api'))
+        restart_handler=lambda: service_restart(api_service_name()))
 
 
 @hooks.hook('cluster-relation-joined')
@@ -474,7 +513,7 @@ def cluster_joined(relation_id=None):
 
 @hooks.hook('cluster-relation-changed')
 @hooks.hook('cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 def cluster_changed():
     resolve_CONFIGS()
     configure_https()
@@ -483,11 +522,16 @@ def cluster_changed():
 
 
 @hooks.hook('upgrade-charm')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 @harden()
 def upgrade_charm():
+    # Templates compiled by the previous revision of the charm.
+    flush_bytecode_cache()
+    # Release the space of unit state history dropped since the last
+    # upgrade.
+    kv().vacuum()
     resolve_CONFIGS()
-    apt_update()
+    apt_update(max_age=config('apt-update-max-age'))
     apt_install(filter_installed_packages(determine_packages()), fatal=True)
     packages_removed = remove_old_packages()
     backup_deprecated_configurations()
@@ -499,6 +543,9 @@ def upgrade_charm():
     # call.
     update_image_location_policy()
     CONFIGS.write_all()
+    configure_image_cache(CONFIGS)
+    configure_swift_upload_buffer()
+    configure_wsgi_server(CONFIGS)
     if packages_removed:
         juju_log("Package purge detected, restarting services", "INFO")
         for s in services():
@@ -507,7 +554,7 @@ def upgrade_charm():
     maybe_do_policyd_overrides(
         os_release('glance-common'),
         'glance',
-        restart_handler=lambda: service_restart('glance-api'))
+        restart_handler=lambda: service_restart(api_service_name()))
 
     # Make sure iscsid has a unique InitiatorName by starting iscsid
     # and invoking /lib/open-iscsi/startup-checks.sh indirectly as
@@ -578,7 +625,7 @@ def amqp_joined():
 
 
 @hooks.hook('amqp-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def amqp_changed():
     resolve_CONFIGS()
     if 'amqp' not in CONFIGS.complete_contexts():
@@ -592,6 +639,7 @@ def amqp_changed():
 def update_nrpe_config():
     # python-dbus is used by check_upstart_job
     apt_install('python-dbus')
+    from charmhelpers.contrib.charmsupport import nrpe
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
@@ -622,7 +670,7 @@ def install_packages_for_cinder_store():
 
 @hooks.hook('cinder-volume-service-relation-joined')
 @os_requires_version('mitaka', 'glance-common')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 def cinder_volume_service_relation_joined(relid=None):
     resolve_CONFIGS()
     install_packages_for_cinder_store()
@@ -631,7 +679,7 @@ def cinder_volume_service_relation_joined(relid=None):
 
 @hooks.hook('storage-backend-relation-changed')
 @os_requires_version('mitaka', 'glance-common')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 def storage_backend_hook():
     resolve_CONFIGS()
     if 'storage-backend' not in CONFIGS.complete_contexts():
@@ -641,6 +689,23 @@ def storage_backend_hook():
     CONFIGS.write(GLANCE_API_CONF)
 
 
+@hooks.hook('image-cache-storage-attached',
+            'image-staging-storage-attached',
+            'image-store-storage-attached')
+def storage_attached():
+    if configure_storage() and not is_unit_paused_set():
+        service_restart(api_service_name())
+
+
+@hooks.hook('image-cache-storage-detaching',
+            'image-staging-storage-detaching',
+            'image-store-storage-detaching')
+def storage_detaching():
+    device = storage_get('location')
+    if device:
+        release_storage(device)
+
+
 @hooks.hook('certificates-relation-joined')
 def certs_joined(relation_id=None):
     relation_set(
@@ -649,7 +714,7 @@ def certs_joined(relation_id=None):
 
 
 @hooks.hook('certificates-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map, stopstart=True)
 def certs_changed(relation_id=None, unit=None):
     process_certificates('glance', relation_id, unit)
     configure_https()
@@ -671,10 +736,23 @@ def post_series_upgrade():
         resume_unit_helper, CONFIGS)
 
 
-if __name__ == '__main__':
+def main(args):
+    invalidate_status_assessment()
     try:
-        hooks.execute(sys.argv)
+        hooks.execute(args)
     except UnregisteredHookError as e:
         juju_log('Unknown hook {} - skipping.'.format(e))
     resolve_CONFIGS()
     assess_status(CONFIGS)
+    # Commit the unit state recorded by the hook, e.g. the fingerprints of
+    # the templates written; a failed hook doesn't get here and its changes
+    # are discarded.
+    kv().flush()
+    # The cache usage is also recorded in the hook profile when profiling;
+    # only log it with debug, as it's a line in every hook's log.
+    if config('debug'):
+        log_cache_info()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
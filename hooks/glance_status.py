@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight entry point for the update-status hook.
+
+Every other hook drops the record of the last status assessment when it
+starts and finishes with a full assess_status(), which records what it saw
+in unitdata, so a hook which fails part way leaves no record.  update-status
+only imports the rest of the charm and repeats the full assessment (and
+hardening) when that record is missing or stale, the charm config has
+changed since, or the liveness of a managed service or whether one of the
+unit's ports is listening differs from what was recorded.  Relation and
+config changes always dispatch a hook on this unit, so an otherwise
+unchanged record means the unit's workload status is still current.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+
+_path = os.path.dirname(os.path.realpath(__file__))
+_parent = os.path.abspath(os.path.join(_path, ".."))
+
+
+def _add_path(path):
+    if path not in sys.path:
+        sys.path.insert(1, path)
+
+
+_add_path(_parent)
+
+
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    DEBUG,
+)
+from charmhelpers.core.host import service_running
+from charmhelpers.core.profiling import start_profiling
+from charmhelpers.core.unitdata import kv
+
+# unitdata key of the record written by the last full assessment.
+STATUS_ASSESSMENT_KEY = 'status-assessment'
+# Repeat the full assessment at least this often, in seconds.
+STATUS_ASSESSMENT_MAX_AGE = 3600
+
+
+def config_fingerprint():
+    """Return a digest of the current charm config.
+
+    :returns: hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(
+        json.dumps(dict(config()), sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def services_liveness(services):
+    """Return whether each of services is running.
+
+    :param services: names of services
+    :type services: List[str]
+    :returns: {service: running}
+    :rtype: Dict[str, bool]
+    """
+    return {svc: bool(service_running(svc)) for svc in services}
+
+
+def ports_open(ports):
+    """Return whether something listens on each of ports on localhost.
+
+    :param ports: port numbers
+    :type ports: List[int]
+    :returns: {port: open}, with the ports as strings as they are stored
+    :rtype: Dict[str, bool]
+    """
+    result = {}
+    for port in ports:
+        try:
+            socket.create_connection(('localhost', int(port)),
+                                     timeout=1).close()
+        except OSError:
+            result[str(port)] = False
+        else:
+            result[str(port)] = True
+    return result
+
+
+def record_status_assessment(services, ports=None):
+    """Record that the workload status was fully assessed.
+
+    :param services: names of the services the assessment checked
+    :type services: List[str]
+    :param ports: ports of the services
+    :type ports: Optional[List[int]]
+    """
+    db = kv()
+    db.set(STATUS_ASSESSMENT_KEY, {
+        'config': config_fingerprint(),
+        'services': services_liveness(services),
+        'ports': ports_open(ports or []),
+        'timestamp': time.time(),
+    })
+    db.flush()
+
+
+def invalidate_status_assessment():
+    """Drop the record of the last status assessment.
+
+    Called when a hook starts, so that update-status reassesses the status
+    if the hook fails after changing it and before assessing it again.
+    """
+    db = kv()
+    if db.get(STATUS_ASSESSMENT_KEY) is not None:
+        db.unset(STATUS_ASSESSMENT_KEY)
+        # Committed now, as a failing hook doesn't flush unitdata.
+        db.flush()
+
+
+def status_assessment_current():
+    """Check whether the recorded status assessment still applies.
+
+    :returns: True if the workload status doesn't need to be reassessed
+    :rtype: bool
+    """
+    record = kv().get(STATUS_ASSESSMENT_KEY)
+    if not record:
+        log('No status assessment recorded', level=DEBUG)
+        return False
+    if time.time() - record['timestamp'] > STATUS_ASSESSMENT_MAX_AGE:
+        log('Recorded status assessment expired', level=DEBUG)
+        return False
+    if record['config'] != config_fingerprint():
+        log('Config changed since status was assessed', level=DEBUG)
+        return False
+    if record['services'] != services_liveness(record['services']):
+        log('Service liveness changed since status was assessed',
+            level=DEBUG)
+        return False
+    ports = record.get('ports', {})
+    if ports != ports_open(ports):
+        log('Listening ports changed since status was assessed',
+            level=DEBUG)
+        return False
+    return True
+
+
+def main(args):
+    start_profiling(os.path.basename(args[0]))
+    if status_assessment_current():
+        log('Status unchanged since last assessment', level=DEBUG)
+        return
+    import glance_relations
+    glance_relations.main(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
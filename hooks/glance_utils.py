@@ -16,10 +16,16 @@
 
 import json
 import os
+import socket
 import subprocess
+import tempfile
+import time
+import urllib.error
+import urllib.request
 from itertools import chain
 
 import glance_contexts
+from glance_status import record_status_assessment
 
 from collections import OrderedDict
 
@@ -30,15 +36,22 @@ from charmhelpers.fetch import (
     add_source,
     apt_autoremove,
     apt_purge,
+    filter_installed_packages,
     filter_missing_packages)
 
 from charmhelpers.core.hookenv import (
     config,
+    hook_name,
+    local_unit,
     log,
+    DEBUG,
     INFO,
     WARNING,
     relation_ids,
     service_name,
+    status_set,
+    storage_get,
+    storage_list,
 )
 
 
@@ -47,8 +60,18 @@ from charmhelpers.core.host import (
     is_container,
     lsb_release,
     mkdir,
+    mount,
+    mounts,
+    umount,
+    service,
+    service_enable,
+    service_pause,
+    service_reload,
+    service_restart,
+    service_resume,
     service_stop,
     service_start,
+    user_exists,
 )
 
 from charmhelpers.contrib.openstack import (
@@ -56,9 +79,13 @@ from charmhelpers.contrib.openstack import (
     context,)
 
 from charmhelpers.contrib.hahelpers.cluster import (
+    determine_apache_port,
+    determine_api_port,
     is_elected_leader,
     get_hacluster_config,
     get_managed_services_and_ports,
+    https,
+    peer_units,
 )
 
 from charmhelpers.contrib.openstack.alternatives import install_alternative
@@ -83,16 +110,25 @@ from charmhelpers.contrib.openstack.utils import (
 from charmhelpers.core.decorators import (
     retry_on_exception,
 )
-from charmhelpers.contrib.storage.linux.ceph import (
-    CephBrokerRq,
-    is_request_complete,
-)
 from charmhelpers.contrib.openstack.context import (
     CephBlueStoreCompressionContext,
 )
 
+from charmhelpers.core.sysctl import create as sysctl_create
 from charmhelpers.core.unitdata import kv
 
+from glance_lazy import lazy_import
+
+# Only the ceph and storage hooks need these, so defer importing them.
+(CephBrokerRq,
+ copy_files,
+ filesystem_mounted,
+ is_request_complete,
+ make_filesystem) = lazy_import(
+    'charmhelpers.contrib.storage.linux.ceph',
+    'CephBrokerRq', 'copy_files', 'filesystem_mounted', 'is_request_complete',
+    'make_filesystem')
+
 
 CLUSTER_RES = "grp_glance_vips"
 
@@ -145,6 +181,47 @@ HTTPS_APACHE_24_CONF = "/etc/apache2/sites-available/" \
 APACHE_SSL_DIR = '/etc/apache2/ssl/glance'
 
 MEMCACHED_CONF = '/etc/memcached.conf'
+SYSCTL_CONF = '/etc/sysctl.d/50-glance.conf'
+
+SYSTEMD_SYSTEM_DIR = '/etc/systemd/system'
+GLANCE_CACHE_PRUNER_SERVICE = os.path.join(SYSTEMD_SYSTEM_DIR,
+                                           'glance-cache-pruner.service')
+GLANCE_CACHE_PRUNER_TIMER = os.path.join(SYSTEMD_SYSTEM_DIR,
+                                         'glance-cache-pruner.timer')
+GLANCE_CACHE_CLEANER_SERVICE = os.path.join(SYSTEMD_SYSTEM_DIR,
+                                            'glance-cache-cleaner.service')
+GLANCE_CACHE_CLEANER_TIMER = os.path.join(SYSTEMD_SYSTEM_DIR,
+                                          'glance-cache-cleaner.timer')
+IMAGE_CACHE_UNITS = [
+    GLANCE_CACHE_PRUNER_SERVICE,
+    GLANCE_CACHE_PRUNER_TIMER,
+    GLANCE_CACHE_CLEANER_SERVICE,
+    GLANCE_CACHE_CLEANER_TIMER,
+]
+GLANCE_STAGING_DIR = '/var/lib/glance/staging/'
+WSGI_GLANCE_API_CONF = '/etc/apache2/sites-enabled/wsgi-glance-api.conf'
+GLANCE_API_UWSGI_INI = os.path.join(GLANCE_CONF_DIR, 'glance-api-uwsgi.ini')
+GLANCE_API_UWSGI_SERVICE = os.path.join(SYSTEMD_SYSTEM_DIR,
+                                        'glance-api-uwsgi.service')
+# Config files, packages and the service serving glance-api for each of the
+# supported wsgi-server values other than the default eventlet glance-api.
+WSGI_SERVER_CONFIGS = {
+    'mod_wsgi': [WSGI_GLANCE_API_CONF],
+    'uwsgi': [GLANCE_API_UWSGI_INI, GLANCE_API_UWSGI_SERVICE],
+}
+WSGI_SERVER_PACKAGES = {
+    'mod_wsgi': ['libapache2-mod-wsgi-py3'],
+    'uwsgi': ['uwsgi-core', 'uwsgi-plugin-python3'],
+}
+WSGI_SERVER_SERVICES = {
+    'mod_wsgi': 'apache2',
+    'uwsgi': 'glance-api-uwsgi',
+}
+# Hooks which run on all units at about the same time, and so stagger their
+# restarts, see stagger_restarts().
+STAGGER_RESTART_HOOKS = ('config-changed', 'upgrade-charm')
+IMAGE_CACHE_TIMERS = [os.path.basename(GLANCE_CACHE_PRUNER_TIMER),
+                      os.path.basename(GLANCE_CACHE_CLEANER_TIMER)]
 
 TEMPLATES = 'templates/'
 
@@ -170,6 +247,8 @@ CONFIG_FILES = OrderedDict([
                           glance_contexts.LoggingConfigContext(),
                           glance_contexts.GlanceIPv6Context(),
                           context.WorkerConfigContext(),
+                          glance_contexts.DatabasePoolContext(),
+                          glance_contexts.GlanceServerTuningContext(),
                           context.OSConfigFlagContext(
                               charm_flag='registry-config-flags',
                               template_flag='registry_config_flags'),
@@ -191,6 +270,8 @@ CONFIG_FILES = OrderedDict([
                           glance_contexts.LoggingConfigContext(),
                           glance_contexts.GlanceIPv6Context(),
                           context.WorkerConfigContext(),
+                          glance_contexts.DatabasePoolContext(),
+                          glance_contexts.GlanceServerTuningContext(),
                           glance_contexts.MultiStoreContext(),
                           glance_contexts.MultiBackendContext(),
                           context.OSConfigFlagContext(
@@ -205,14 +286,16 @@ CONFIG_FILES = OrderedDict([
                           context.MemcacheContext(),
                           glance_contexts.GlanceImageImportContext(),
                           context.KeystoneAuditMiddleware(service=CHARM),
-                          glance_contexts.ExternalS3Context()],
+                          glance_contexts.ExternalS3Context(),
+                          glance_contexts.GlanceImageCacheContext()],
         'services': ['glance-api']
     }),
     (GLANCE_SWIFT_CONF, {
         'hook_contexts': [glance_contexts.ObjectStoreContext(),
                           context.IdentityServiceContext(
                               service='glance',
-                              service_user='glance')],
+                              service_user='glance'),
+                          glance_contexts.SwiftStoreTuningContext()],
         'services': ['glance-api']
     }),
     (GLANCE_POLICY_FILE, {
@@ -228,7 +311,8 @@ CONFIG_FILES = OrderedDict([
         'services': ['glance-api']
     }),
     (ceph_config_file(), {
-        'hook_contexts': [context.CephContext()],
+        'hook_contexts': [context.CephContext(),
+                          glance_contexts.CephClientTuningContext()],
         'services': ['glance-api', 'glance-registry']
     }),
     (HAPROXY_CONF, {
@@ -252,6 +336,34 @@ CONFIG_FILES = OrderedDict([
         'hook_contexts': [glance_contexts.GlancePolicyContext()],
         'services': [],
     }),
+    (GLANCE_CACHE_PRUNER_SERVICE, {
+        'hook_contexts': [glance_contexts.GlanceImageCacheContext()],
+        'services': [],
+    }),
+    (GLANCE_CACHE_PRUNER_TIMER, {
+        'hook_contexts': [glance_contexts.GlanceImageCacheContext()],
+        'services': [],
+    }),
+    (GLANCE_CACHE_CLEANER_SERVICE, {
+        'hook_contexts': [glance_contexts.GlanceImageCacheContext()],
+        'services': [],
+    }),
+    (GLANCE_CACHE_CLEANER_TIMER, {
+        'hook_contexts': [glance_contexts.GlanceImageCacheContext()],
+        'services': [],
+    }),
+    (WSGI_GLANCE_API_CONF, {
+        'hook_contexts': [glance_contexts.GlanceWSGIWorkerConfigContext()],
+        'services': ['apache2'],
+    }),
+    (GLANCE_API_UWSGI_INI, {
+        'hook_contexts': [glance_contexts.GlanceWSGIWorkerConfigContext()],
+        'services': ['glance-api-uwsgi'],
+    }),
+    (GLANCE_API_UWSGI_SERVICE, {
+        'hook_contexts': [glance_contexts.GlanceWSGIWorkerConfigContext()],
+        'services': [],
+    }),
 ])
 
 
@@ -307,6 +419,14 @@ def register_configs():
         configs.register(GLANCE_POLICY_YAML,
                          CONFIG_FILES[GLANCE_POLICY_YAML]['hook_contexts'])
 
+    if cmp_release >= 'ussuri' and config('image-cache-enabled'):
+        for conf in IMAGE_CACHE_UNITS:
+            configs.register(conf, CONFIG_FILES[conf]['hook_contexts'])
+
+    wsgi_server = determine_wsgi_server()
+    for conf in WSGI_SERVER_CONFIGS.get(wsgi_server, []):
+        configs.register(conf, CONFIG_FILES[conf]['hook_contexts'])
+
     return configs
 
 
@@ -319,6 +439,9 @@ def determine_packages():
     if CompareOpenStackReleases(os_release(VERSION_PACKAGE)) >= 'stein':
         # required for image-conversion
         packages.extend(['qemu-utils'])
+    wsgi_server = determine_wsgi_server()
+    if wsgi_server:
+        packages.extend(WSGI_SERVER_PACKAGES[wsgi_server])
     return sorted(packages)
 
 
@@ -384,7 +507,7 @@ def do_openstack_upgrade(configs):
         '--option', 'Dpkg::Options::=--force-confnew',
         '--option', 'Dpkg::Options::=--force-confdef',
     ]
-    apt_update()
+    apt_update(max_age=config('apt-update-max-age'))
     apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
     reset_os_release()
     apt_install(determine_packages(), fatal=True)
@@ -412,15 +535,24 @@ def restart_map():
     '''
     _map = []
     cmp_release = CompareOpenStackReleases(os_release('glance-common'))
+    wsgi_server = determine_wsgi_server()
+    wsgi_configs = WSGI_SERVER_CONFIGS.get(wsgi_server, [])
+    api_service = api_service_name()
 
     for f, ctxt in CONFIG_FILES.items():
         if f == GLANCE_AUDIT_MAP and cmp_release < 'yoga':
             continue
+        if (f in chain(*WSGI_SERVER_CONFIGS.values()) and
+                f not in wsgi_configs):
+            continue
         svcs = []
         for svc in ctxt['services']:
             if cmp_release >= 'stein' and svc == 'glance-registry':
                 continue
-            svcs.append(svc)
+            if svc == 'glance-api':
+                svc = api_service
+            if svc not in svcs:
+                svcs.append(svc)
         if svcs:
             _map.append((f, svcs))
 
@@ -428,12 +560,13 @@ def restart_map():
         _map.append((MEMCACHED_CONF, ['memcached']))
 
     if cmp_release >= 'stein':
-        glance_svcs = ['glance-api']
+        glance_svcs = [api_service]
     else:
-        glance_svcs = ['glance-api', 'glance-registry']
+        glance_svcs = [api_service, 'glance-registry']
 
     if os.path.isdir(APACHE_SSL_DIR):
-        _map.append(('{}/*'.format(APACHE_SSL_DIR), glance_svcs + ['apache2']))
+        _map.append(('{}/*'.format(APACHE_SSL_DIR),
+                     list(OrderedDict.fromkeys(glance_svcs + ['apache2']))))
 
     return OrderedDict(_map)
 
@@ -443,6 +576,163 @@ def services():
     return list(set(chain(*restart_map().values())))
 
 
+def determine_wsgi_server():
+    """Return the WSGI server selected to run glance-api.
+
+    :returns: 'mod_wsgi', 'uwsgi' or None when glance-api runs as the
+              eventlet based glance-api service.
+    :rtype: Optional[str]
+    """
+    server = config('wsgi-server')
+    if server not in WSGI_SERVER_CONFIGS:
+        return None
+    if CompareOpenStackReleases(os_release('glance-common')) < 'ussuri':
+        return None
+    return server
+
+
+def api_service_name():
+    """Return the name of the service which serves glance-api.
+
+    This is the packaged glance-api service unless wsgi-server selects
+    Apache mod_wsgi or uWSGI.
+
+    :returns: the service name.
+    :rtype: str
+    """
+    wsgi_server = determine_wsgi_server()
+    return WSGI_SERVER_SERVICES.get(wsgi_server, 'glance-api')
+
+
+def restart_dependencies():
+    """Return the services each service depends on, so that backends are
+    restarted, and ready, before the frontends in front of them.
+
+    haproxy fronts the apache2 SSL frontend, if any, which fronts glance-api;
+    glance-api uses memcached.
+
+    :returns: {service: [service it depends on, ...]}
+    :rtype: Dict[str, List[str]]
+    """
+    api_service = api_service_name()
+    dependencies = {
+        api_service: ['memcached'],
+        'glance-registry': ['memcached'],
+        'haproxy': list(OrderedDict.fromkeys([api_service, 'apache2'])),
+    }
+    if api_service != 'apache2':
+        dependencies['apache2'] = [api_service]
+    return dependencies
+
+
+def readiness_probes():
+    """Return how to check that each service is ready after a restart.
+
+    :returns: {service: [(probe, port), ...]} where probe is 'http' for an
+              HTTP request to /healthcheck or 'tcp' for a connection.
+    :rtype: Dict[str, List[Tuple[str, int]]]
+    """
+    probes = {
+        api_service_name(): [
+            ('http', determine_api_port(9292, singlenode_mode=True))],
+        'haproxy': [('tcp', 9292)],
+        'memcached': [('tcp', 11211)],
+    }
+    if https():
+        probes.setdefault('apache2', []).append(
+            ('tcp', determine_apache_port(9292, singlenode_mode=True)))
+    return probes
+
+
+def _probe_ready(probe, port):
+    """Run a single readiness probe against localhost.
+
+    Any HTTP response other than a server error means the API is serving;
+    without the healthcheck middleware /healthcheck is a 401 or 404.
+
+    :param probe: 'http' or 'tcp'
+    :type probe: str
+    :param port: port to probe
+    :type port: int
+    :rtype: bool
+    """
+    if probe == 'http':
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        try:
+            opener.open('http://localhost:{}/healthcheck'.format(port),
+                        timeout=5).close()
+        except urllib.error.HTTPError as e:
+            return e.code < 500
+        except OSError:
+            return False
+        return True
+    try:
+        socket.create_connection(('localhost', port), timeout=5).close()
+    except OSError:
+        return False
+    return True
+
+
+def wait_for_service_ready(service_name):
+    """Wait up to restart-readiness-timeout seconds for service_name to be
+    ready after a restart.
+
+    Used as restart_on_change's post_svc_restart_f, so that services aren't
+    restarted while those they depend on are still starting.
+
+    :param service_name: the service restarted
+    :type service_name: str
+    :returns: whether the service is ready
+    :rtype: bool
+    """
+    timeout = config('restart-readiness-timeout')
+    probes = readiness_probes().get(service_name)
+    if not timeout or not probes:
+        return True
+    deadline = time.time() + timeout
+    for probe, port in probes:
+        while not _probe_ready(probe, port):
+            if time.time() >= deadline:
+                log('{} not ready on port {} after {}s'.format(
+                    service_name, port, timeout), level=WARNING)
+                return False
+            time.sleep(1)
+    log('{} is ready'.format(service_name), level=DEBUG)
+    return True
+
+
+def stagger_restarts():
+    """Wait restart-stagger-wait seconds for each lower numbered peer before
+    restarting services, so that units of the application don't all restart
+    at the same time.
+
+    Used as restart_on_change's pre_restarts_wait_f, which is only called
+    when services need restarting.  Only the hooks in STAGGER_RESTART_HOOKS,
+    which Juju runs on every unit after a change to the application, wait;
+    relation hooks are already spread out by the remote units.
+
+    This is best-effort: units don't coordinate, so units whose hooks start
+    at different times, or whose restarts take longer than the wait, can
+    still restart at the same time.
+    """
+    wait = config('restart-stagger-wait')
+    if not wait or hook_name() not in STAGGER_RESTART_HOOKS:
+        return
+
+    def _unit_number(unit):
+        return int(unit.split('/')[-1])
+
+    position = len([unit for unit in peer_units()
+                    if _unit_number(unit) < _unit_number(local_unit())])
+    if not position:
+        return
+    msg = 'Waiting {} seconds for peers to restart services'.format(
+        position * wait)
+    log(msg, level=INFO)
+    status_set('maintenance', msg)
+    time.sleep(position * wait)
+
+
 def deprecated_services():
     ''' Returns a list of deprecated services with this charm '''
     cmp_release = CompareOpenStackReleases(os_release('glance-common'))
@@ -468,6 +758,231 @@ def setup_ipv6():
         apt_install('haproxy/trusty-backports', fatal=True)
 
 
+def configure_image_cache(configs):
+    """Install or remove the systemd timers which run the glance image cache
+    pruner and cleaner.
+
+    The unit files are only registered with configs when the image cache is
+    enabled, see register_configs().
+
+    :param configs: The charms main OSConfigRenderer object.
+    """
+    if glance_contexts.GlanceImageCacheContext()():
+        mkdir(glance_contexts.IMAGE_CACHE_DIR, owner='glance', group='glance',
+              perms=0o750)
+        for unit_file in IMAGE_CACHE_UNITS:
+            configs.write(unit_file)
+        service('daemon-reload')
+        for timer in IMAGE_CACHE_TIMERS:
+            service_enable(timer)
+            if not is_unit_paused_set():
+                service_restart(timer)
+        return
+
+    installed = [f for f in IMAGE_CACHE_UNITS if os.path.exists(f)]
+    if not installed:
+        return
+    for timer in IMAGE_CACHE_TIMERS:
+        service_stop(timer)
+        service('disable', timer)
+    for unit_file in installed:
+        os.remove(unit_file)
+    service('daemon-reload')
+
+
+def configure_swift_upload_buffer():
+    """Create the directory glance-api buffers uploads to swift in, when
+    swift-buffer-on-upload is set.
+
+    Like the other glance directories it is created by the hooks rather than
+    by SwiftStoreTuningContext, as contexts are also evaluated to assess the
+    status.
+    """
+    if config('swift-buffer-on-upload'):
+        mkdir(glance_contexts.SWIFT_UPLOAD_BUFFER_DIR, owner='glance',
+              group='glance', perms=0o750)
+
+
+def configure_wsgi_server(configs):
+    """Switch glance-api between the glance-api service and the WSGI server
+    selected by the wsgi-server option.
+
+    The glance-api service is masked while a WSGI server is in use and the
+    configuration of any previously used WSGI server is removed.
+
+    :param configs: The charms main OSConfigRenderer object.
+    """
+    wsgi_server = determine_wsgi_server()
+    paused = is_unit_paused_set()
+    if wsgi_server:
+        apt_install(filter_installed_packages(
+            WSGI_SERVER_PACKAGES[wsgi_server]), fatal=True)
+        for conf in WSGI_SERVER_CONFIGS[wsgi_server]:
+            configs.write(conf)
+        service_pause('glance-api')
+
+    removed = False
+    for server, confs in WSGI_SERVER_CONFIGS.items():
+        installed = [f for f in confs if os.path.exists(f)]
+        if server == wsgi_server or not installed:
+            continue
+        if server == 'uwsgi':
+            service_stop(WSGI_SERVER_SERVICES[server])
+            service('disable', WSGI_SERVER_SERVICES[server])
+        for conf in installed:
+            os.remove(conf)
+        if server == 'mod_wsgi' and not paused:
+            service_reload('apache2', restart_on_failure=True)
+        removed = True
+
+    if wsgi_server == 'uwsgi' or removed:
+        service('daemon-reload')
+    if wsgi_server == 'uwsgi':
+        service_enable(WSGI_SERVER_SERVICES['uwsgi'])
+    if not wsgi_server and removed and not paused:
+        service_resume('glance-api')
+
+
+def configure_sysctl():
+    """Raise net.core.somaxconn to cover the configured listen backlogs when
+    raise-somaxconn is set, otherwise drop the charm's sysctl file.
+    """
+    if not config('raise-somaxconn'):
+        if os.path.exists(SYSCTL_CONF):
+            log('raise-somaxconn disabled, removing {}; the current '
+                'net.core.somaxconn is kept until reboot'.format(SYSCTL_CONF),
+                level=INFO)
+            os.remove(SYSCTL_CONF)
+        return
+    backlog = max(config('listen-backlog') or 0,
+                  config('wsgi-listen-backlog') or 0)
+    somaxconn = glance_contexts.GlanceServerTuningContext.somaxconn()
+    if somaxconn is not None and backlog <= somaxconn:
+        return
+    sysctl_create({'net.core.somaxconn': backlog}, SYSCTL_CONF, ignore=True)
+
+
+def storage_mountpoints():
+    """Map the charm's storage endpoints to the directories they back.
+
+    :returns: OrderedDict of storage name to mountpoint
+    :rtype: OrderedDict
+    """
+    _mounts = OrderedDict([
+        ('image-cache', glance_contexts.IMAGE_CACHE_DIR),
+        ('image-staging', GLANCE_STAGING_DIR),
+    ])
+    if config('filesystem-store-datadir'):
+        _mounts['image-store'] = config('filesystem-store-datadir')
+    return OrderedDict((k, v.rstrip('/')) for k, v in _mounts.items())
+
+
+def _has_filesystem(device):
+    """Determine whether the block device already carries a filesystem."""
+    return subprocess.call(['blkid', device],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def place_data_on_storage(device, mountpoint):
+    """Format (if required) and mount device on mountpoint.
+
+    Any data already present in mountpoint is migrated onto the device
+    before it is mounted in place and the mount is persisted to fstab using
+    the configured mount options.
+
+    :param device: path to the block device
+    :type device: str
+    :param mountpoint: directory the device should be mounted on
+    :type mountpoint: str
+    :returns: True if the device was mounted
+    :rtype: bool
+    """
+    fstype = config('storage-filesystem-type')
+    options = config('storage-mount-options') or None
+    if not _has_filesystem(device):
+        make_filesystem(device, fstype=fstype)
+
+    mkdir(mountpoint, owner='glance', group='glance', perms=0o750)
+    if os.listdir(mountpoint):
+        log('Migrating existing data in {} to {}'.format(mountpoint, device),
+            level=INFO)
+        tmp_mountpoint = tempfile.mkdtemp(prefix='glance-storage-')
+        try:
+            if not mount(device, tmp_mountpoint, options=options):
+                return False
+            try:
+                copy_files(mountpoint, tmp_mountpoint, symlinks=True)
+            finally:
+                umount(tmp_mountpoint)
+        finally:
+            try:
+                os.rmdir(tmp_mountpoint)
+            except OSError as e:
+                log('Unable to remove {}: {}'.format(tmp_mountpoint, e),
+                    level=WARNING)
+
+    if not mount(device, mountpoint, options=options, persist=True,
+                 filesystem=fstype):
+        return False
+    # ensure ownership of the new mount, the filesystem root is owned by root
+    # after mkfs.
+    mkdir(mountpoint, owner='glance', group='glance', perms=0o750)
+    return True
+
+
+def configure_storage():
+    """Place glance data directories on any attached block devices.
+
+    :returns: True if any new device was mounted
+    :rtype: bool
+    """
+    if not user_exists('glance'):
+        # storage-attached hooks for storage provided at deploy time run
+        # before the install hook; config-changed will complete the work.
+        log('glance user does not exist yet, deferring storage setup',
+            level=INFO)
+        return False
+    mounted = False
+    for name, mountpoint in storage_mountpoints().items():
+        if filesystem_mounted(mountpoint):
+            continue
+        for storage_id in storage_list(name) or []:
+            device = storage_get('location', storage_id)
+            if not device:
+                continue
+            log('Placing {} on {} ({})'.format(mountpoint, device, name),
+                level=INFO)
+            mounted = place_data_on_storage(device, mountpoint) or mounted
+    return mounted
+
+
+def release_storage(device):
+    """Unmount device from any glance data directory it backs.
+
+    glance-api is stopped while the device is unmounted, as it holds files
+    open on it, and started again unless the unit is paused.
+
+    :param device: path to the block device being detached
+    :type device: str
+    """
+    mountpoints = storage_mountpoints().values()
+    releasing = [mountpoint for mountpoint, _device in mounts()
+                 if _device == device and mountpoint in mountpoints]
+    if not releasing:
+        return
+    api_service = api_service_name()
+    service_stop(api_service)
+    try:
+        for mountpoint in releasing:
+            log('Unmounting {} from {}'.format(device, mountpoint),
+                level=INFO)
+            umount(mountpoint, persist=True)
+    finally:
+        if not is_unit_paused_set():
+            service_start(api_service)
+
+
 def get_optional_interfaces():
     """Return the optional interfaces that should be checked if the relavent
     relations have appeared.
@@ -521,6 +1036,10 @@ def check_optional_config_and_relations(configs):
             pass
         except ValueError as e:
             return ('blocked', 'Invalid configuration: {}'.format(str(e)))
+        try:
+            glance_contexts.CephClientTuningContext().validate()
+        except ValueError as e:
+            return ('blocked', 'Invalid configuration: {}'.format(str(e)))
         # ceph pkgs are only installed after the ceph relation is etablished
         # so gate checking broker requests on ceph relation being completed.
         if ('ceph' in configs.complete_contexts()
@@ -533,6 +1052,32 @@ def check_optional_config_and_relations(configs):
     except ValueError as e:
         return ('blocked', 'Invalid external S3 config: {}'.format(str(e)))
 
+    if relation_ids('object-store'):
+        try:
+            glance_contexts.SwiftStoreTuningContext().validate()
+        except ValueError as e:
+            return ('blocked', 'Invalid swift config: {}'.format(str(e)))
+
+    try:
+        glance_contexts.GlanceServerTuningContext().validate()
+    except ValueError as e:
+        return ('blocked', 'Invalid server tuning config: {}'.format(str(e)))
+
+    try:
+        glance_contexts.GlanceWSGIWorkerConfigContext().validate()
+    except ValueError as e:
+        return ('blocked', 'Invalid wsgi config: {}'.format(str(e)))
+
+    try:
+        glance_contexts.HAProxyContext().validate()
+    except ValueError as e:
+        return ('blocked', 'Invalid haproxy config: {}'.format(str(e)))
+
+    try:
+        glance_contexts.GlanceImageCacheContext().validate()
+    except ValueError as e:
+        return ('blocked', 'Invalid image cache config: {}'.format(str(e)))
+
     if relation_ids('cinder-volume-service') and is_container():
         return (
             'blocked',
@@ -555,6 +1100,11 @@ def assess_status(configs):
     """
     assess_status_func(configs)()
     os_application_version_set(VERSION_PACKAGE)
+    _services, _ = get_managed_services_and_ports(services(), [])
+    record_status_assessment(
+        _services,
+        sorted({port for svc, probes in readiness_probes().items()
+                if svc in _services for _, port in probes}))
 
 
 def assess_status_func(configs):
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake Juju hook tools and system commands for replay.py.
+
+replay.py links this script into a directory on PATH under the name of each
+command it fakes.  Every invocation is served from, and hook tools which
+change the model are written back to, the model state in state.json next to
+that directory, and the command name is appended to commands.log there so
+the harness can count the commands each hook ran.  juju-log messages are
+appended to juju-log.log there.  The files are found from
+the path the command was run as, since charmhelpers runs some commands, e.g.
+apt-get, with a minimal environment.
+
+Only the standard library is imported, so that startup time stays close to
+that of the real tools.
+"""
+
+import fcntl
+import json
+import os
+import sys
+
+REAL_ENV = '/usr/bin/env'
+# Commands which change the model state.
+WRITERS = {'relation-set', 'leader-set', 'status-set', 'open-port',
+           'close-port', 'application-version-set'}
+
+
+class ToolError(Exception):
+
+    def __init__(self, message, code=1):
+        super(ToolError, self).__init__(message)
+        self.code = code
+
+
+def _option(args, *names):
+    """Remove the option names and its value from args and return the
+    value, or None."""
+    for name in names:
+        if name in args:
+            i = args.index(name)
+            value = args[i + 1]
+            del args[i:i + 2]
+            return value
+        for arg in args:
+            if arg.startswith(name + '='):
+                args.remove(arg)
+                return arg.split('=', 1)[1]
+    return None
+
+
+def _flag(args, *names):
+    """Remove the flags names from args and return whether one was given."""
+    found = False
+    for name in names:
+        while name in args:
+            args.remove(name)
+            found = True
+    return found
+
+
+def _relation(state, rid):
+    rid = rid or os.environ.get('JUJU_RELATION_ID')
+    if not rid or rid not in state['relations']:
+        raise ToolError('invalid value "{}" for option -r: relation not '
+                        'found'.format(rid), code=2)
+    return rid, state['relations'][rid]
+
+
+def _unit_data(state, relation, unit):
+    if unit == state['unit']:
+        return relation['local']
+    if unit not in relation['units']:
+        raise ToolError('cannot read settings for unit "{}": unit not '
+                        'found'.format(unit), code=2)
+    return relation['units'][unit]
+
+
+def _parse_settings(args):
+    settings = {}
+    for arg in args:
+        key, value = arg.split('=', 1)
+        settings[key] = value
+    return settings
+
+
+def _update(data, settings):
+    for key, value in settings.items():
+        if value in (None, ''):
+            data.pop(key, None)
+        else:
+            data[key] = str(value)
+
+
+def _json(value):
+    return json.dumps(value) + '\n'
+
+
+def relation_get(state, args):
+    rid, relation = _relation(state, _option(args, '-r', '--relation'))
+    app = _flag(args, '--app')
+    args = [arg for arg in args if not arg.startswith('--format')]
+    key = args[0] if args else '-'
+    if app:
+        name = args[1] if len(args) > 1 else relation['app']
+        data = (relation['local_app'] if name == state['unit'].split('/')[0]
+                else relation['app_data'])
+    else:
+        name = args[1] if len(args) > 1 else os.environ.get(
+            'JUJU_REMOTE_UNIT')
+        if not name:
+            raise ToolError('no unit id specified', code=2)
+        data = _unit_data(state, relation, name)
+    return _json(data if key == '-' else data.get(key))
+
+
+def relation_set(state, args):
+    if _flag(args, '--help'):
+        return 'Usage: relation-set [options] key=value [key=value ...]\n' \
+               '    --file  (= )\n'
+    rid, relation = _relation(state, _option(args, '-r', '--relation'))
+    data = relation['local_app'] if _flag(args, '--app') else \
+        relation['local']
+    path = _option(args, '--file')
+    if path:
+        # relation-set --file is only used with YAML charmhelpers dumps,
+        # which are flat mappings of strings.
+        import yaml
+        with open(path) as f:
+            _update(data, yaml.safe_load(f) or {})
+    _update(data, _parse_settings(args))
+    return ''
+
+
+def relation_ids(state, args):
+    args = [arg for arg in args if not arg.startswith('--format')]
+    name = args[0] if args else os.environ.get('JUJU_RELATION')
+    return _json([rid for rid, relation in state['relations'].items()
+                  if relation['name'] == name])
+
+
+def relation_list(state, args):
+    rid, relation = _relation(state, _option(args, '-r', '--relation'))
+    return _json(relation['joined'])
+
+
+def config_get(state, args):
+    _flag(args, '--all', '-a')
+    args = [arg for arg in args if not arg.startswith('--format')]
+    if args:
+        return _json(state['config'].get(args[0]))
+    return _json(state['config'])
+
+
+def unit_get(state, args):
+    args = [arg for arg in args if not arg.startswith('--format')]
+    return _json(state['address'])
+
+
+def network_get(state, args):
+    if _flag(args, '--primary-address'):
+        return state['address'] + '\n'
+    # The YAML network-get prints is parsed by yaml.safe_load(), which also
+    # accepts JSON.
+    return _json({
+        'bind-addresses': [{
+            'macaddress': '00:16:3e:00:00:01',
+            'interfacename': 'eth0',
+            'addresses': [{'hostname': '', 'address': state['address'],
+                           'cidr': state['address'] + '/24'}]}],
+        'egress-subnets': [state['address'] + '/32'],
+        'ingress-addresses': [state['address']],
+    })
+
+
+def is_leader(state, args):
+    return _json(state['leader'])
+
+
+def leader_get(state, args):
+    args = [arg for arg in args if not arg.startswith('--format')]
+    key = args[0] if args else '-'
+    data = state['leader_data']
+    return _json(data if key == '-' else data.get(key))
+
+
+def leader_set(state, args):
+    if not state['leader']:
+        raise ToolError('cannot write leadership settings: not the leader')
+    _update(state['leader_data'], _parse_settings(args))
+    return ''
+
+
+def status_set(state, args):
+    application = _flag(args, '--application')
+    status = {'status': args[0], 'message': ' '.join(args[1:])}
+    state['application_status' if application else 'status'] = status
+    return ''
+
+
+def status_get(state, args):
+    return _json(dict(state['status'], **{'status-data': {}}))
+
+
+def application_version_set(state, args):
+    state['workload_version'] = args[0] if args else ''
+    return ''
+
+
+def open_port(state, args):
+    if args[0] not in state['ports']:
+        state['ports'].append(args[0])
+    return ''
+
+
+def close_port(state, args):
+    if args[0] in state['ports']:
+        state['ports'].remove(args[0])
+    return ''
+
+
+def opened_ports(state, args):
+    return _json(state['ports'])
+
+
+def goal_state(state, args):
+    relations = {}
+    for relation in state['relations'].values():
+        units = relations.setdefault(relation['name'], {})
+        units[relation['app']] = {'status': 'joined'}
+        for unit in relation['units']:
+            units[unit] = {'status': 'joined'}
+    app = state['unit'].split('/')[0]
+    units = {unit: {'status': 'active'} for unit in
+             [state['unit']] + [
+                 unit for relation in state['relations'].values()
+                 if relation['app'] == app for unit in relation['units']]}
+    return _json({'units': units, 'relations': relations})
+
+
+def storage_list(state, args):
+    return _json([])
+
+
+def dpkg_query(state, args):
+    packages = [arg for arg in args if not arg.startswith('-') and
+                '$' not in arg]
+    lines = []
+    missing = False
+    for package in packages:
+        version = state['packages'].get(package)
+        if version is None:
+            missing = True
+            continue
+        lines.append('ii \t{}\t{}\tamd64\t{}'.format(
+            package, version, package))
+    if missing:
+        raise ToolError('\n'.join(lines), code=1)
+    return '\n'.join(lines) + '\n'
+
+
+def apt_cache(state, args):
+    if args[:1] != ['show']:
+        return ''
+    records = []
+    for package in args[1:]:
+        version = state['packages'].get(package)
+        if version is not None:
+            records.append('Package: {}\nVersion: {}\nArchitecture: amd64\n'
+                           .format(package, version))
+    if not records:
+        raise ToolError('E: No packages found', code=100)
+    return '\n'.join(records) + '\n'
+
+
+def env(state, args):
+    """Serve charmhelpers' get_system_env(), which reads /etc/environment
+    through env(1), from the hook's environment, so that the PATH of the
+    fake commands also applies to APT; run env(1) for anything else."""
+    if '/etc/environment' not in ' '.join(args):
+        os.execv(REAL_ENV, [REAL_ENV] + args)
+    return ''.join('{}={}\n'.format(key, value)
+                   for key, value in os.environ.items() if '\n' not in value)
+
+
+def juju_log(state, args):
+    level = _option(args, '-l', '--log-level') or 'INFO'
+    with open(os.path.join(state['workdir'], 'juju-log.log'), 'a') as f:
+        f.write('{} {}\n'.format(level, ' '.join(args)))
+    return ''
+
+
+def ok(state, args):
+    return ''
+
+
+TOOLS = {
+    'relation-get': relation_get,
+    'relation-set': relation_set,
+    'relation-ids': relation_ids,
+    'relation-list': relation_list,
+    'config-get': config_get,
+    'unit-get': unit_get,
+    'network-get': network_get,
+    'is-leader': is_leader,
+    'leader-get': leader_get,
+    'leader-set': leader_set,
+    'status-set': status_set,
+    'status-get': status_get,
+    'application-version-set': application_version_set,
+    'open-port': open_port,
+    'close-port': close_port,
+    'opened-ports': opened_ports,
+    'goal-state': goal_state,
+    'storage-list': storage_list,
+    'juju-log': juju_log,
+    'juju-reboot': ok,
+    'dpkg-query': dpkg_query,
+    'env': env,
+    'apt-cache': apt_cache,
+}
+
+
+def run(name, args, state):
+    """Run the fake command name.
+
+    :param name: command name
+    :type name: str
+    :param args: command line arguments
+    :type args: List[str]
+    :param state: model state, updated in place by commands in WRITERS
+    :type state: Dict[str, Any]
+    :returns: standard output
+    :rtype: str
+    :raises: ToolError
+    """
+    if name in TOOLS:
+        return TOOLS[name](state, list(args))
+    for rule in state['commands'].get(name, []):
+        if rule.get('match', '') in ' '.join(args):
+            if rule.get('returncode', 0):
+                raise ToolError(rule.get('stdout', ''),
+                                code=rule['returncode'])
+            return rule.get('stdout', '')
+    return ''
+
+
+def main(argv):
+    name = os.path.basename(argv[0])
+    workdir = os.path.dirname(os.path.dirname(os.path.abspath(argv[0])))
+    with open(os.path.join(workdir, 'commands.log'), 'a') as log:
+        log.write(name + '\n')
+    path = os.path.join(workdir, 'state.json')
+    with open(path, 'r+' if name in WRITERS else 'r') as f:
+        if name in WRITERS:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        state = json.load(f)
+        state['workdir'] = workdir
+        try:
+            output = run(name, argv[1:], state)
+        except ToolError as e:
+            if str(e):
+                sys.stderr.write('{}\n'.format(e))
+            return e.code
+        if name in WRITERS:
+            del state['workdir']
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+    sys.stdout.write(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replay glance hooks offline against a model fixture and time them.
+
+    tests/benchmark/replay.py tests/benchmark/models/large.yaml \\
+        --output large.json
+
+The hooks of a copy of the charm are run one after another, as the unit
+agent would, with fake Juju hook tools on PATH which serve the relation,
+config and leader data of the model fixture (see models/).  Package and
+service management commands are faked as well, so no packages are installed
+and no services restarted, but hooks still render their config files under
+/etc.  Run the harness as root in a disposable Ubuntu container or VM where
+the charm's packages (glance, haproxy, apache2, memcached and
+openstack-release) are already installed, so that the users and directories
+the hooks expect exist.  The unit's address is the machine's own unless the
+model fixture sets one.
+
+The wall time, the number of each faked command run and the peak RSS of
+every hook are reported, along with the number of subprocesses the charm
+ran according to its hook profile (see charmhelpers.core.profiling).
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARM_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+HOOK_TOOL = os.path.join(BENCH_DIR, 'hook_tool.py')
+
+JUJU_VERSION = '3.6.0'
+
+# Hook tools served from the model state by hook_tool.py.
+HOOK_TOOLS = [
+    'application-version-set', 'close-port', 'config-get', 'goal-state',
+    'is-leader', 'juju-log', 'juju-reboot', 'leader-get', 'leader-set',
+    'network-get', 'open-port', 'opened-ports', 'relation-get',
+    'relation-ids', 'relation-list', 'relation-set', 'status-get',
+    'status-set', 'storage-list', 'unit-get',
+]
+# Commands which would change the machine or need the network; these
+# succeed without doing anything unless the model fixture says otherwise.
+SYSTEM_COMMANDS = [
+    'a2dismod', 'a2dissite', 'a2enmod', 'a2ensite', 'add-apt-repository',
+    'apt-cache', 'apt-get', 'apt-key', 'apt-mark', 'ceph', 'dpkg-query', 'env',
+    'glance-manage', 'mount', 'rbd', 'service', 'snap', 'systemctl', 'umount',
+    'update-rc.d',
+]
+
+# Files of the charm the hooks don't need.
+CHARM_IGNORE = shutil.ignore_patterns(
+    '.git', '.tox', '.stestr', '__pycache__', '*.pyc', '.unit-state.db*',
+    '.jinja-cache', '.hook-profile.jsonl*', 'unit_tests', 'tests')
+
+
+def build_state(model):
+    """Expand a model fixture into the state served by hook_tool.py.
+
+    :param model: model fixture, see models/
+    :type model: Dict[str, Any]
+    :returns: model state
+    :rtype: Dict[str, Any]
+    """
+    unit = model['unit']
+    address = model.get('address') or local_address()
+    state = {
+        'unit': unit,
+        'address': address,
+        'leader': model.get('leader', True),
+        'config': _charm_config_defaults(),
+        'leader_data': dict(model.get('leader-data', {})),
+        'packages': dict(model.get('packages', {})),
+        'commands': dict(model.get('commands', {})),
+        'relations': collections.OrderedDict(),
+        'status': {'status': 'unknown', 'message': ''},
+        'ports': [],
+    }
+    state['config'].update(model.get('config', {}))
+    ids = collections.Counter()
+    for name, relations in model.get('relations', {}).items():
+        if isinstance(relations, dict):
+            relations = [relations]
+        for relation in relations:
+            rid = '{}:{}'.format(name, sum(ids.values()) + 1)
+            ids[name] += 1
+            units = collections.OrderedDict()
+            i = 0
+            while len(units) < relation.get('units', 1):
+                remote = '{}/{}'.format(relation['app'], i)
+                i += 1
+                if remote == unit:
+                    continue
+                units[remote] = {
+                    key: str(value).replace('{n}', str(i - 1))
+                    for key, value in relation.get('data', {}).items()}
+            state['relations'][rid] = {
+                'name': name,
+                'app': relation['app'],
+                'units': units,
+                'joined': list(units),
+                'app_data': dict(relation.get('app-data', {})),
+                'local': {'private-address': address},
+                'local_app': {},
+            }
+    return state
+
+
+def local_address():
+    """Return the address of this machine's default route.
+
+    The unit's address has to be one of the machine's own, as the charm
+    looks up the network it is on.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        # Nothing is sent.
+        s.connect(('192.0.2.1', 9))
+        return s.getsockname()[0]
+
+
+def _charm_config_defaults():
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    return {key: option.get('default') for key, option in options.items()}
+
+
+class Replay(object):
+    """Runs the hooks of a copy of the charm against a model state."""
+
+    def __init__(self, state, workdir):
+        self.state = state
+        self.workdir = workdir
+        self.charm_dir = os.path.join(workdir, 'charm')
+        self.bin_dir = os.path.join(workdir, 'bin')
+        self.state_file = os.path.join(workdir, 'state.json')
+        self.log_file = os.path.join(workdir, 'commands.log')
+        self.juju_log_file = os.path.join(workdir, 'juju-log.log')
+        self.profile_file = os.path.join(workdir, 'hook-profile.jsonl')
+        self.results = []
+        shutil.copytree(CHARM_DIR, self.charm_dir, symlinks=True,
+                        ignore=CHARM_IGNORE)
+        os.mkdir(self.bin_dir)
+        for name in HOOK_TOOLS + SYSTEM_COMMANDS + list(state['commands']):
+            if not os.path.exists(os.path.join(self.bin_dir, name)):
+                os.symlink(HOOK_TOOL, os.path.join(self.bin_dir, name))
+        self._save_state()
+
+    def _save_state(self):
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f)
+
+    def _load_state(self):
+        with open(self.state_file) as f:
+            self.state = json.load(f)
+
+    def _env(self, hook, rid=None, remote_unit=None):
+        env = dict(os.environ)
+        env.update({
+            'PATH': os.pathsep.join([
+                self.bin_dir, os.path.dirname(sys.executable),
+                os.environ.get('PATH', '')]),
+            'CHARM_DIR': self.charm_dir,
+            'JUJU_CHARM_DIR': self.charm_dir,
+            'JUJU_UNIT_NAME': self.state['unit'],
+            'JUJU_HOOK_NAME': hook,
+            'JUJU_MODEL_NAME': 'benchmark',
+            'JUJU_VERSION': JUJU_VERSION,
+            'JUJU_AVAILABILITY_ZONE': 'zone1',
+            'CHARM_HOOK_PROFILE': '1',
+            'CHARM_HOOK_PROFILE_FILE': self.profile_file,
+            'UNIT_STATE_DB': os.path.join(self.workdir, 'unit-state.db'),
+        })
+        for key in ('JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT',
+                    'JUJU_REMOTE_APP'):
+            env.pop(key, None)
+        if rid:
+            relation = self.state['relations'][rid]
+            env.update({'JUJU_RELATION': relation['name'],
+                        'JUJU_RELATION_ID': rid,
+                        'JUJU_REMOTE_APP': relation['app']})
+            if remote_unit:
+                env['JUJU_REMOTE_UNIT'] = remote_unit
+        return env
+
+    def run_hook(self, hook, rid=None, remote_unit=None):
+        """Run hook, if the charm has it, and record its result.
+
+        :returns: the result, or None if the charm doesn't have the hook
+        :rtype: Optional[Dict[str, Any]]
+        """
+        path = os.path.join(self.charm_dir, 'hooks', hook)
+        if not os.path.exists(path):
+            return None
+        self._save_state()
+        open(self.log_file, 'w').close()
+        open(self.juju_log_file, 'w').close()
+        profiles = self._profile_count()
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            [path], cwd=self.charm_dir,
+            env=self._env(hook, rid, remote_unit),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.stdout.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - start
+        proc.stdout.close()
+        self._load_state()
+        with open(self.log_file) as f:
+            commands = collections.Counter(f.read().split())
+        result = {
+            'hook': hook,
+            'relation': rid,
+            'remote_unit': remote_unit,
+            'returncode': os.waitstatus_to_exitcode(status),
+            'wall': wall,
+            'commands': dict(commands),
+            'subprocesses': self._profiled_subprocesses(profiles),
+            # KiB on Linux
+            'max_rss': rusage.ru_maxrss,
+        }
+        if result['returncode']:
+            with open(self.juju_log_file) as f:
+                juju_log = f.read()
+            result['output'] = '{}{}'.format(
+                juju_log[-2000:], output.decode('UTF-8', 'replace')[-4000:])
+        self.results.append(result)
+        return result
+
+    def _profile_count(self):
+        try:
+            with open(self.profile_file) as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    def _profiled_subprocesses(self, previous):
+        """Return the number of subprocesses in the profile of the hook just
+        run, or None if it didn't write one."""
+        try:
+            with open(self.profile_file) as f:
+                lines = f.readlines()[previous:]
+        except FileNotFoundError:
+            return None
+        if not lines:
+            return None
+        spans = json.loads(lines[-1])['spans'].get('subprocess', {})
+        return sum(span['count'] for span in spans.values())
+
+    def relation_storm(self, name, hooks=('joined', 'changed'), join=True,
+                       limit=None):
+        """Run the hooks of every remote unit of the name relations.
+
+        :param name: relation endpoint
+        :param hooks: relation hooks to run for each remote unit
+        :param join: remote units join one at a time, rather than all
+                     being present from the start
+        :param limit: only run the hooks of the first limit units of each
+                      relation
+        """
+        for rid, relation in list(self.state['relations'].items()):
+            if relation['name'] != name:
+                continue
+            units = list(relation['units'])[:limit]
+            if join:
+                relation['joined'] = [
+                    unit for unit in relation['joined'] if unit not in units]
+            for unit in units:
+                if join:
+                    self.state['relations'][rid]['joined'].append(unit)
+                for hook in hooks:
+                    self.run_hook('{}-relation-{}'.format(name, hook),
+                                  rid=rid, remote_unit=unit)
+
+    def run_scenario(self, scenario):
+        """Run the steps of a model fixture's scenario.
+
+        A step is either the name of a hook, or a mapping with a relation
+        key, and optionally hooks, join and limit, for relation_storm().
+        """
+        for step in scenario:
+            if isinstance(step, str):
+                self.run_hook(step)
+            else:
+                step = dict(step)
+                self.relation_storm(step.pop('relation'), **step)
+
+
+def summarize(results):
+    """Aggregate results by hook.
+
+    :returns: {hook: {'runs', 'failures', 'wall', 'mean', 'max',
+                      'commands', 'subprocesses', 'max_rss'}}
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    summary = collections.OrderedDict()
+    for result in results:
+        hook = summary.setdefault(result['hook'], {
+            'runs': 0, 'failures': 0, 'wall': 0.0, 'max': 0.0,
+            'commands': 0, 'subprocesses': 0, 'max_rss': 0})
+        hook['runs'] += 1
+        hook['failures'] += bool(result['returncode'])
+        hook['wall'] += result['wall']
+        hook['max'] = max(hook['max'], result['wall'])
+        hook['commands'] += sum(result['commands'].values())
+        hook['subprocesses'] += result['subprocesses'] or 0
+        hook['max_rss'] = max(hook['max_rss'], result['max_rss'])
+    for hook in summary.values():
+        hook['mean'] = hook['wall'] / hook['runs']
+    return summary
+
+
+def format_summary(summary):
+    lines = ['{:<42} {:>5} {:>5} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'hook', 'runs', 'fail', 'mean(s)', 'max(s)', 'commands',
+        'subprocs', 'rss(MiB)')]
+    for name, hook in summary.items():
+        lines.append(
+            '{:<42} {:>5} {:>5} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f} '
+            '{:>9.1f}'.format(
+                name, hook['runs'], hook['failures'], hook['mean'],
+                hook['max'], hook['commands'] / hook['runs'],
+                hook['subprocesses'] / hook['runs'], hook['max_rss'] / 1024))
+    lines.append('total: {} hooks in {:.2f}s'.format(
+        sum(hook['runs'] for hook in summary.values()),
+        sum(hook['wall'] for hook in summary.values())))
+    return '\n'.join(lines)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Replay glance hooks against a model fixture.')
+    parser.add_argument('model', help='model fixture (YAML)')
+    parser.add_argument('--output', '-o',
+                        help='write every hook result to this JSON file')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working directory')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    with open(args.model) as f:
+        model = yaml.safe_load(f)
+    workdir = tempfile.mkdtemp(prefix='glance-bench-')
+    try:
+        replay = Replay(build_state(model), workdir)
+        replay.run_scenario(model['scenario'])
+    finally:
+        if args.keep:
+            print('Working directory: {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir)
+    summary = summarize(replay.results)
+    print(format_summary(summary))
+    for result in replay.results:
+        if result['returncode']:
+            print('\n{} ({} {}) failed:\n{}'.format(
+                result['hook'], result['relation'], result['remote_unit'],
+                result['output']))
+            break
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'summary': summary,
+                       'results': replay.results}, f, indent=2)
+    return 1 if any(result['returncode'] for result in replay.results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
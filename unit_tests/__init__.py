@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import os
+import shutil
 import sys
+import tempfile
 from unittest.mock import patch
 
 sys.path.append('actions')
@@ -30,3 +34,8 @@ patch(
     return_value={
         'DISTRIB_CODENAME': 'jammy'
     }).start()
+
+# Keep the unit state database that kv() opens out of the working tree.
+_unit_state_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _unit_state_dir, ignore_errors=True)
+os.environ['UNIT_STATE_DB'] = os.path.join(_unit_state_dir, '.unit-state.db')
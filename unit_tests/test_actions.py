@@ -46,6 +46,43 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class HookProfileTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookProfileTestCase, self).setUp(
+            actions, ["action_get", "action_set", "read_profiles"])
+        self.params = {'profiles': 100, 'top': 10}
+        self.action_get.side_effect = self.params.get
+
+    def test_hook_profile(self):
+        self.read_profiles.return_value = [
+            {'hook': 'config-changed', 'wall': 40.0, 'error': None,
+             'spans': {'subprocess': {'relation-get': {'count': 300,
+                                                       'seconds': 30.0}},
+                       'template': {'/etc/glance/glance-api.conf': {
+                           'count': 1, 'seconds': 0.5}}}},
+            {'hook': 'update-status', 'wall': 2.0, 'error': 'OSError',
+             'spans': {}},
+        ]
+        actions.hook_profile([])
+        self.read_profiles.assert_called_once_with(limit=100)
+        report = self.action_set.call_args[0][0]['report']
+        lines = report.splitlines()
+        self.assertEqual(lines[0], '2 hook profiles, 42.00s in total')
+        self.assertEqual(lines[3].split(),
+                         ['config-changed', '1', '0', '40.00', '40.00'])
+        self.assertEqual(lines[4].split(),
+                         ['update-status', '1', '1', '2.00', '2.00'])
+        self.assertIn('subprocess relation-get 300 30.00 0.100',
+                      ' '.join(report.split()))
+
+    def test_hook_profile_no_profiles(self):
+        self.read_profiles.return_value = []
+        with self.assertRaises(Exception):
+            actions.hook_profile([])
+        self.assertFalse(self.action_set.called)
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
@@ -25,14 +25,15 @@ mock_apt = MagicMock()
 sys.modules['apt'] = mock_apt
 mock_apt.apt_pkg = MagicMock()
 
-with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec, \
-        patch('charmhelpers.contrib.openstack.utils.'
-              'os_requires_version') as mock_os, \
+import charmhelpers.contrib.hardening.harden as harden  # noqa
+
+# The hardening framework is imported when a hardened hook first runs.
+harden._DISABLE_HARDENING_FOR_UNIT_TEST = True
+
+with patch('charmhelpers.contrib.openstack.utils.'
+           'os_requires_version') as mock_os, \
         patch('glance_utils.register_configs'), \
         patch('glance_utils.restart_map'):
-    mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
-                            lambda *args, **kwargs: f(*args, **kwargs))
-
     mock_os.side_effect = (lambda *dargs, **dkwargs: lambda f:
                            lambda *args, **kwargs: f(*args, **kwargs))
     import openstack_upgrade
@@ -0,0 +1,95 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from charmhelpers.contrib.openstack import context
+from charmhelpers.core import hookenv
+
+
+class CountingContext(context.OSContextGenerator):
+    interfaces = ['counting']
+    calls = 0
+
+    def __init__(self, name='default'):
+        self.name = name
+
+    def __call__(self):
+        CountingContext.calls += 1
+        self.missing_data = ['password'] if self.name == 'missing' else []
+        return {'name': self.name, 'calls': CountingContext.calls}
+
+
+class ContextMemoTests(unittest.TestCase):
+
+    def setUp(self):
+        CountingContext.calls = 0
+        context.flush_context_memo()
+
+    def test_not_memoized_outside_scope(self):
+        self.assertEqual(CountingContext()()['calls'], 1)
+        self.assertEqual(CountingContext()()['calls'], 2)
+
+    def test_hit_within_scope(self):
+        with context.context_memo_scope():
+            first = CountingContext()()
+            second = CountingContext()()
+        self.assertEqual(first, second)
+        self.assertEqual(CountingContext.calls, 1)
+
+    def test_hit_returns_copy(self):
+        with context.context_memo_scope():
+            CountingContext()()['name'] = 'changed'
+            self.assertEqual(CountingContext()()['name'], 'default')
+
+    def test_miss_on_other_arguments(self):
+        with context.context_memo_scope():
+            CountingContext('a')()
+            CountingContext('b')()
+            CountingContext(name='a')()
+        self.assertEqual(CountingContext.calls, 3)
+
+    def test_hit_restores_missing_data(self):
+        with context.context_memo_scope():
+            CountingContext('missing')()
+            ctxt = CountingContext('missing')
+            ctxt()
+        self.assertEqual(ctxt.missing_data, ['password'])
+        self.assertEqual(CountingContext.calls, 1)
+
+    def test_nested_scopes_share_memo(self):
+        with context.context_memo_scope():
+            CountingContext()()
+            with context.context_memo_scope():
+                CountingContext()()
+            CountingContext()()
+        self.assertEqual(CountingContext.calls, 1)
+
+    def test_memo_dropped_when_scope_exits(self):
+        with context.context_memo_scope():
+            CountingContext()()
+        with context.context_memo_scope():
+            self.assertEqual(CountingContext()()['calls'], 2)
+
+    def test_invalidated_by_data_changed(self):
+        with context.context_memo_scope():
+            CountingContext()()
+            hookenv.data_changed()
+            self.assertEqual(CountingContext()()['calls'], 2)
+
+    def test_invalidated_by_flush_context_memo(self):
+        with context.context_memo_scope():
+            CountingContext()()
+            context.flush_context_memo()
+            self.assertEqual(CountingContext()()['calls'], 2)
@@ -0,0 +1,255 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest.mock import call, patch
+
+from charmhelpers.core import unitdata
+from charmhelpers.fetch import ubuntu
+
+DPKG_STATUS = """\
+Package: glance-common
+Status: install ok installed
+Priority: optional
+Architecture: all
+Version: 2:28.0.0-0ubuntu1
+Description: OpenStack Image Registry and Delivery Service - common files
+ Multi-line description which mentions
+ Package: not-a-package
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 2.39-0ubuntu8
+
+Package: haproxy
+Status: install ok half-installed
+Architecture: amd64
+Version: 2.8.5-1ubuntu3
+
+Package: python-dbus
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1.2.16-1
+
+Package: memcached
+Status: hold ok installed
+Architecture: amd64
+Version: 1.6.24-1build3
+"""
+
+
+class DpkgStatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.status = os.path.join(tmpdir, 'status')
+        self.write_status(DPKG_STATUS)
+        for name, new in (('DPKG_STATUS', self.status),
+                          ('_dpkg_status', {'stat': None, 'packages': {}})):
+            _patch = patch.object(ubuntu, name, new)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def write_status(self, content):
+        with open(self.status, 'w') as f:
+            f.write(content)
+
+
+class InstalledPackagesTests(DpkgStatusTestCase):
+
+    def test_parse(self):
+        self.assertEqual(ubuntu._installed_packages(), {
+            'glance-common': '2:28.0.0-0ubuntu1',
+            'glance-common:all': '2:28.0.0-0ubuntu1',
+            'libc6': '2.39-0ubuntu8',
+            'libc6:amd64': '2.39-0ubuntu8',
+            'memcached': '1.6.24-1build3',
+            'memcached:amd64': '1.6.24-1build3',
+        })
+
+    def test_half_installed_and_config_files_missing(self):
+        self.assertEqual(
+            ubuntu._missing_packages(['haproxy', 'python-dbus', 'libc6']),
+            ['haproxy', 'python-dbus'])
+
+    def test_no_status(self):
+        os.remove(self.status)
+        self.assertEqual(ubuntu._installed_packages(), {})
+
+    @patch('builtins.open', wraps=open)
+    def test_reread_only_when_changed(self, _open):
+        ubuntu._installed_packages()
+        ubuntu._installed_packages()
+        self.assertEqual(_open.call_count, 1)
+        self.write_status(DPKG_STATUS + '\nPackage: uuid\n'
+                          'Status: install ok installed\n')
+        _open.reset_mock()
+        self.assertIn('uuid', ubuntu._installed_packages())
+        self.assertEqual(_open.call_count, 1)
+
+
+@patch.object(ubuntu, 'log')
+@patch.object(ubuntu, '_run_apt_command')
+class AptInstallTests(DpkgStatusTestCase):
+
+    def test_all_installed(self, _run_apt_command, log):
+        ubuntu.apt_install(['glance-common', 'libc6:amd64'], fatal=True)
+        ubuntu.apt_install('memcached')
+        self.assertFalse(_run_apt_command.called)
+
+    def test_one_missing(self, _run_apt_command, log):
+        ubuntu.apt_install(['glance-common', 'haproxy'], fatal=True)
+        _run_apt_command.assert_called_once_with(
+            ['apt-get', '--assume-yes',
+             '--option=Dpkg::Options::=--force-confold', 'install',
+             'glance-common', 'haproxy'], True, quiet=False)
+
+    def test_version_or_release_not_skipped(self, _run_apt_command, log):
+        ubuntu.apt_install('libc6=2.39-0ubuntu8')
+        ubuntu.apt_install('memcached/noble-updates')
+        self.assertEqual(_run_apt_command.call_count, 2)
+
+    def test_upgrade(self, _run_apt_command, log):
+        ubuntu.apt_install(['glance-common'], upgrade=True)
+        _run_apt_command.assert_called_once_with(
+            ['apt-get', '--assume-yes',
+             '--option=Dpkg::Options::=--force-confold', 'install',
+             'glance-common'], False, quiet=False)
+
+    def test_reinstall(self, _run_apt_command, log):
+        ubuntu.apt_install(['glance-common'], options=['--reinstall'])
+        _run_apt_command.assert_called_once_with(
+            ['apt-get', '--assume-yes', '--reinstall', 'install',
+             'glance-common'], False, quiet=False)
+
+
+@patch.object(ubuntu, 'log')
+@patch.object(ubuntu, '_run_apt_command', return_value=None)
+class AptUpdateTests(unittest.TestCase):
+
+    UPDATE = ['apt-get', 'update', '--error-on=any']
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.sources = os.path.join(tmpdir, 'sources.list')
+        self.parts = os.path.join(tmpdir, 'sources.list.d')
+        self.lists = os.path.join(tmpdir, 'lists')
+        os.mkdir(self.parts)
+        os.mkdir(self.lists)
+        self.write(self.sources, 'deb http://archive.ubuntu.com/ubuntu '
+                                 'noble main\n')
+        self.db = unitdata.Storage(':memory:')
+        for name, new in (('APT_SOURCES_LIST', self.sources),
+                          ('APT_SOURCES_PARTS', self.parts),
+                          ('APT_LISTS_DIR', self.lists)):
+            _patch = patch.object(ubuntu, name, new)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        _patch = patch.object(ubuntu.unitdata, 'kv', return_value=self.db)
+        _patch.start()
+        self.addCleanup(_patch.stop)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def touch_lists(self):
+        """Change the lists directory, as apt-get update does."""
+        path = os.path.join(self.lists, 'Release')
+        self.write(path, '')
+        os.remove(path)
+
+    def test_sources_fingerprint(self, _run_apt_command, log):
+        self.write(os.path.join(self.parts, 'cloud-archive.list'), 'deb a')
+        self.write(os.path.join(self.parts, 'ubuntu.sources'), 'Types: deb')
+        self.write(os.path.join(self.parts, 'old.list.save'), 'deb b')
+        fingerprint = ubuntu._sources_fingerprint()
+        self.assertEqual(sorted(fingerprint), [
+            self.sources,
+            os.path.join(self.parts, 'cloud-archive.list'),
+            os.path.join(self.parts, 'ubuntu.sources')])
+        self.write(os.path.join(self.parts, 'cloud-archive.list'), 'deb c')
+        changed = ubuntu._sources_fingerprint()
+        self.assertEqual(
+            [path for path in fingerprint if fingerprint[path] !=
+             changed[path]],
+            [os.path.join(self.parts, 'cloud-archive.list')])
+
+    def test_without_max_age(self, _run_apt_command, log):
+        ubuntu.apt_update()
+        ubuntu.apt_update()
+        self.assertEqual(_run_apt_command.call_args_list,
+                         [call(['apt-get', 'update'], False)] * 2)
+        self.assertIsNone(self.db.get(ubuntu.APT_UPDATE_KEY))
+
+    def test_skipped_when_fresh(self, _run_apt_command, log):
+        _run_apt_command.return_value = 0
+        ubuntu.apt_update(max_age=3600)
+        ubuntu.apt_update(max_age=3600)
+        _run_apt_command.assert_called_once_with(self.UPDATE, False)
+
+    def test_updated_when_stale(self, _run_apt_command, log):
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        with patch.object(ubuntu.time, 'time',
+                          return_value=time.time() + 3600):
+            ubuntu.apt_update(fatal=True, max_age=3600)
+        self.assertEqual(_run_apt_command.call_args_list,
+                         [call(self.UPDATE, True)] * 2)
+
+    def test_updated_when_lists_changed(self, _run_apt_command, log):
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        self.touch_lists()
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        self.assertEqual(_run_apt_command.call_args_list,
+                         [call(self.UPDATE, True)] * 2)
+
+    def test_not_recorded_after_failure(self, _run_apt_command, log):
+        _run_apt_command.return_value = 100
+        ubuntu.apt_update(max_age=3600)
+        ubuntu.apt_update(max_age=3600)
+        self.assertEqual(_run_apt_command.call_args_list,
+                         [call(self.UPDATE, False)] * 2)
+        self.assertIsNone(self.db.get(ubuntu.APT_UPDATE_KEY))
+
+    def test_changed_source_updated_alone(self, _run_apt_command, log):
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        cloud_archive = os.path.join(self.parts, 'cloud-archive.list')
+        self.write(cloud_archive, 'deb a')
+        _run_apt_command.reset_mock()
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        _run_apt_command.assert_called_once_with(
+            self.UPDATE + ['-o', 'Dir::Etc::sourcelist=' + cloud_archive,
+                           '-o', 'Dir::Etc::sourceparts=-',
+                           '-o', 'APT::Get::List-Cleanup=0'], True)
+        _run_apt_command.reset_mock()
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        self.assertFalse(_run_apt_command.called)
+
+    def test_removed_source_updates_all(self, _run_apt_command, log):
+        cloud_archive = os.path.join(self.parts, 'cloud-archive.list')
+        self.write(cloud_archive, 'deb a')
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        os.remove(cloud_archive)
+        ubuntu.apt_update(fatal=True, max_age=3600)
+        self.assertEqual(_run_apt_command.call_args_list,
+                         [call(self.UPDATE, True)] * 2)
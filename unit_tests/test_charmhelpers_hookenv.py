@@ -0,0 +1,228 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+
+
+def clear_cache():
+    hookenv.cache.clear()
+    hookenv._cache_index.clear()
+    hookenv._cache_entry_args.clear()
+
+
+class FakeRelations(object):
+    """relation-get, relation-set, relation-ids and relation-list over
+    in-memory relation data: {rid: {unit: {key: value}}}."""
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def check_output(self, cmd, **kwargs):
+        self.calls.append(cmd[0])
+        args = [arg for arg in cmd[1:] if not arg.startswith('--format')]
+        if cmd[0] == 'relation-ids':
+            return json.dumps(sorted(self.data)).encode('UTF-8')
+        rid = args[args.index('-r') + 1]
+        if cmd[0] == 'relation-list':
+            return json.dumps(sorted(
+                unit for unit in self.data[rid]
+                if unit != 'glance/0')).encode('UTF-8')
+        if cmd[0] == 'relation-get':
+            return json.dumps(self.data[rid][args[-1]]).encode('UTF-8')
+        if cmd[0] == 'relation-set':
+            return '--file'
+        raise AssertionError(cmd)
+
+    def check_call(self, cmd, **kwargs):
+        self.calls.append(cmd[0])
+        rid = cmd[cmd.index('-r') + 1]
+        for setting in cmd[cmd.index('-r') + 2:]:
+            key, value = setting.split('=', 1)
+            self.data[rid]['glance/0'][key] = value
+
+
+class RelationSetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.relations = FakeRelations({
+            'cluster:1': {'glance/0': {'a': '1'}, 'glance/1': {'b': '2'}}})
+        for name in ('check_output', 'check_call'):
+            _patch = patch.object(hookenv.subprocess, name,
+                                  getattr(self.relations, name))
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        for name, value in (('local_unit', 'glance/0'),
+                            ('relation_types', ['cluster']),
+                            ('_relation_set_accepts_file', False)):
+            _patch = patch.object(hookenv, name, return_value=value)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        clear_cache()
+        hookenv.flush_relation_snapshots()
+
+    def test_relation_get_after_write(self):
+        self.assertEqual(
+            hookenv.relation_get('a', unit='glance/0', rid='cluster:1'), '1')
+        hookenv.relation_set(relation_id='cluster:1', a='3')
+        self.assertEqual(
+            hookenv.relation_get('a', unit='glance/0', rid='cluster:1'), '3')
+
+    def test_cached_readers_after_write(self):
+        self.assertEqual(hookenv.relations()['cluster']['cluster:1'],
+                         {'glance/0': {'a': '1'}, 'glance/1': {'b': '2'}})
+        self.assertEqual(
+            hookenv.relation_for_unit('glance/0', 'cluster:1'),
+            {'a': '1', '__unit__': 'glance/0'})
+        hookenv.relation_set(relation_id='cluster:1', a='3')
+        self.assertEqual(hookenv.relations()['cluster']['cluster:1'],
+                         {'glance/0': {'a': '3'}, 'glance/1': {'b': '2'}})
+        self.assertEqual(
+            hookenv.relation_for_unit('glance/0', 'cluster:1'),
+            {'a': '3', '__unit__': 'glance/0'})
+
+    def test_remote_data_still_cached_after_write(self):
+        hookenv.relation_get(unit='glance/1', rid='cluster:1')
+        hookenv.relation_set(relation_id='cluster:1', a='3')
+        self.relations.calls = []
+        self.assertEqual(
+            hookenv.relation_get('b', unit='glance/1', rid='cluster:1'), '2')
+        self.assertEqual(self.relations.calls, [])
+
+
+class CacheKeyTests(unittest.TestCase):
+
+    def test_hashable(self):
+        self.assertEqual(hookenv._cache_key(('a', 1), {'b': None}),
+                         (('a', 1), (('b', None),)))
+
+    def test_kwargs_order(self):
+        self.assertEqual(hookenv._cache_key((), {'a': 1, 'b': 2}),
+                         hookenv._cache_key((), {'b': 2, 'a': 1}))
+
+    def test_unhashable(self):
+        key = hookenv._cache_key((['a'],), {'b': {'c': 1}})
+        self.assertEqual(key, '[[["a"]], {"b": {"c": 1}}]')
+        self.assertEqual(key, hookenv._cache_key((['a'],), {'b': {'c': 1}}))
+
+
+class CachedTests(unittest.TestCase):
+
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+        self.calls = []
+        self.name = '{}.relation_get'.format(__name__)
+        hookenv._cache_stats.pop(self.name, None)
+
+        @hookenv.cached
+        def relation_get(attribute=None, unit=None, rid=None):
+            self.calls.append((attribute, unit, rid))
+            return len(self.calls)
+
+        @hookenv.cached
+        def related_units(rid=None):
+            self.calls.append(rid)
+            return len(self.calls)
+
+        self.relation_get = relation_get
+        self.related_units = related_units
+
+    def test_cached(self):
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 1)
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 1)
+        self.assertEqual(self.relation_get('b', 'glance/1', 'cluster:1'), 2)
+        self.assertEqual(self.relation_get(['a'], rid='cluster:1'), 3)
+        self.assertEqual(self.relation_get(['a'], rid='cluster:1'), 3)
+
+    def test_flush_unit(self):
+        self.relation_get('a', 'glance/1', 'cluster:1')
+        self.relation_get('a', 'glance/10', 'cluster:1')
+        self.relation_get('a', 'glance/2', 'cluster:1')
+        hookenv.flush_unit('glance/1')
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 4)
+        self.assertEqual(self.relation_get('a', 'glance/10', 'cluster:1'), 2)
+        self.assertEqual(self.relation_get('a', 'glance/2', 'cluster:1'), 3)
+
+    def test_flush_relation(self):
+        self.relation_get('a', 'glance/1', 'cluster:1')
+        self.relation_get('a', 'glance/1', 'cluster:12')
+        self.related_units('cluster:1')
+        self.related_units('cluster:12')
+        hookenv.flush_relation('cluster:1')
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 5)
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:12'), 2)
+        self.assertEqual(self.related_units('cluster:1'), 6)
+        self.assertEqual(self.related_units('cluster:12'), 4)
+
+    def test_flush_unit_snapshots(self):
+        for key in (('cluster:1', 'glance/1', None),
+                    ('cluster:1', 'glance/10', None)):
+            hookenv._relation_snapshots[key] = {}
+        self.addCleanup(hookenv.flush_relation_snapshots)
+        hookenv.flush_unit('glance/1')
+        self.assertEqual(list(hookenv._relation_snapshots),
+                         [('cluster:1', 'glance/10', None)])
+
+    def test_flush_substring(self):
+        self.relation_get('a', 'glance/1', 'cluster:1')
+        self.relation_get('private-address', rid='cluster:2')
+        self.related_units('identity:3')
+        hookenv.flush('cluster')
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 4)
+        self.assertEqual(
+            self.relation_get('private-address', rid='cluster:2'), 5)
+        self.assertEqual(self.related_units('identity:3'), 3)
+        hookenv.flush('private')
+        self.assertEqual(
+            self.relation_get('private-address', rid='cluster:2'), 6)
+
+    def test_flush_keeps_index_consistent(self):
+        self.relation_get('a', 'glance/1', 'cluster:1')
+        self.relation_get('a', 'glance/2', 'cluster:1')
+        self.relation_get(['a'], 'glance/2')
+        hookenv.flush_unit('glance/1')
+        self.assertNotIn('glance/1', hookenv._cache_index)
+        self.assertEqual(len(hookenv._cache_index['a']), 1)
+        self.assertEqual(len(hookenv._cache_index['cluster:1']), 1)
+        hookenv.flush('glance/2')
+        self.assertEqual(hookenv._cache_index, {})
+        self.assertEqual(hookenv._cache_entry_args, {})
+
+    def test_function_flush(self):
+        self.relation_get('a', 'glance/1', 'cluster:1')
+        self.relation_get()
+        self.related_units('cluster:1')
+        self.relation_get.flush()
+        self.assertEqual(self.relation_get('a', 'glance/1', 'cluster:1'), 4)
+        self.assertEqual(self.relation_get(), 5)
+        self.assertEqual(self.related_units('cluster:1'), 3)
+        self.relation_get.flush()
+        self.related_units.flush()
+        self.assertEqual(hookenv._cache_index, {})
+        self.assertEqual(hookenv._cache_entry_args, {})
+
+    def test_cache_info(self):
+        self.assertNotIn(self.name, hookenv.cache_info())
+        self.relation_get('a')
+        self.relation_get('a')
+        self.relation_get('a')
+        self.relation_get('b')
+        self.assertEqual(hookenv.cache_info()[self.name],
+                         {'hits': 2, 'misses': 2})
@@ -0,0 +1,227 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import call, patch, MagicMock
+
+from charmhelpers.core import host, unitdata
+
+RESTART_MAP = {
+    '/etc/memcached.conf': ['memcached'],
+    '/etc/glance/glance-api.conf': ['glance-api'],
+    '/etc/apache2/ports.conf': ['apache2'],
+    '/etc/haproxy/haproxy.cfg': ['haproxy'],
+}
+DEPENDENCIES = {
+    'glance-api': ['memcached'],
+    'apache2': ['glance-api'],
+    'haproxy': ['glance-api', 'apache2'],
+}
+
+
+class RestartGroupsTests(unittest.TestCase):
+
+    def test_dependency_order(self):
+        self.assertEqual(
+            host._restart_groups(
+                ['haproxy', 'apache2', 'glance-api', 'memcached'],
+                DEPENDENCIES),
+            [['memcached'], ['glance-api'], ['apache2'], ['haproxy']])
+
+    def test_independent_services_grouped(self):
+        self.assertEqual(
+            host._restart_groups(
+                ['haproxy', 'memcached', 'glance-api'],
+                {'haproxy': ['glance-api']}),
+            [['memcached', 'glance-api'], ['haproxy']])
+
+    def test_dependencies_not_restarted_ignored(self):
+        self.assertEqual(
+            host._restart_groups(['haproxy', 'apache2'], DEPENDENCIES),
+            [['apache2'], ['haproxy']])
+
+    def test_self_dependency_ignored(self):
+        self.assertEqual(
+            host._restart_groups(['a'], {'a': ['a']}), [['a']])
+
+    @patch.object(host, 'log')
+    def test_cycle(self, log):
+        self.assertEqual(
+            host._restart_groups(['c', 'b', 'a'],
+                                 {'a': ['b'], 'b': ['a'], 'c': []}),
+            [['c'], ['b'], ['a']])
+
+
+class RestartDependenciesTests(unittest.TestCase):
+
+    def setUp(self):
+        # Every file in RESTART_MAP has changed.
+        digests = self.patch_host('_FileDigests')
+        digests.return_value.path_hash.side_effect = lambda path: 'new'
+        self.service = self.patch_host('service')
+        self.patch_host('log')
+        self.checksums = {path: 'old' for path in RESTART_MAP}
+
+    def patch_host(self, attr):
+        _patch = patch.object(host, attr)
+        self.addCleanup(_patch.stop)
+        return _patch.start()
+
+    def restart(self, **kwargs):
+        host._post_restart_on_change_helper(
+            self.checksums, RESTART_MAP, **kwargs)
+
+    def test_without_dependencies(self):
+        self.restart()
+        self.assertEqual(self.service.call_args_list,
+                         [call('restart', svc) for svc in
+                          ['memcached', 'glance-api', 'apache2', 'haproxy']])
+
+    def test_dependency_order(self):
+        post = MagicMock()
+        self.service.side_effect = lambda action, svc: post('restart', svc)
+        self.restart(restart_dependencies=DEPENDENCIES,
+                     post_svc_restart_f=lambda svc: post('ready', svc))
+        self.assertEqual(post.call_args_list, [
+            call('restart', 'memcached'), call('ready', 'memcached'),
+            call('restart', 'glance-api'), call('ready', 'glance-api'),
+            call('restart', 'apache2'), call('ready', 'apache2'),
+            call('restart', 'haproxy'), call('ready', 'haproxy')])
+
+    def test_dependencies_callable_only_called_on_restart(self):
+        dependencies = MagicMock(return_value=DEPENDENCIES)
+        self.checksums = {path: 'new' for path in RESTART_MAP}
+        self.restart(restart_dependencies=dependencies)
+        self.assertFalse(dependencies.called)
+        self.assertFalse(self.service.called)
+
+    @patch.object(host, 'ThreadPoolExecutor', wraps=ThreadPoolExecutor)
+    def test_group_restarted_concurrently(self, executor):
+        # The services of a group must be restarting at the same time to
+        # pass the barrier.
+        barrier = threading.Barrier(2, timeout=10)
+        self.service.side_effect = lambda action, svc: barrier.wait()
+        self.restart(restart_dependencies={'apache2': ['glance-api'],
+                                           'haproxy': ['glance-api']})
+        self.assertEqual(executor.call_args_list,
+                         [call(max_workers=2), call(max_workers=2)])
+        self.assertEqual(
+            sorted(self.service.call_args_list[:2]),
+            [call('restart', 'glance-api'), call('restart', 'memcached')])
+        self.assertEqual(
+            sorted(self.service.call_args_list[2:]),
+            [call('restart', 'apache2'), call('restart', 'haproxy')])
+
+    def test_failed_group_stops_later_groups(self):
+        def _service(action, svc):
+            if svc == 'glance-api':
+                raise subprocess.CalledProcessError(1, 'systemctl')
+        self.service.side_effect = _service
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.restart(restart_dependencies={'apache2': ['memcached'],
+                                               'haproxy': ['apache2']})
+        restarted = [c[0][1] for c in self.service.call_args_list]
+        # glance-api failed in the first group, alongside memcached.
+        self.assertEqual(sorted(restarted), ['glance-api', 'memcached'])
+
+    def test_can_restart_now_f(self):
+        self.restart(restart_dependencies=DEPENDENCIES,
+                     can_restart_now_f=lambda svc, files: svc != 'apache2')
+        self.assertEqual(self.service.call_args_list,
+                         [call('restart', svc) for svc in
+                          ['memcached', 'glance-api', 'haproxy']])
+
+
+class FileDigestsTests(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'glance-api.conf')
+        self.db = unitdata.Storage(':memory:')
+        _patch = patch.object(host.unitdata, 'kv', return_value=self.db)
+        _patch.start()
+        self.addCleanup(_patch.stop)
+        _patch = patch.object(host, 'file_hash', wraps=host.file_hash)
+        self.file_hash = _patch.start()
+        self.addCleanup(_patch.stop)
+
+    def write(self, content, age=0):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        if age:
+            mtime = time.time() - age
+            os.utime(self.path, (mtime, mtime))
+
+    def digest(self):
+        digests = host._FileDigests()
+        digest = digests.file_hash(self.path)
+        digests.save()
+        return digest
+
+    def test_unchanged_file_not_rehashed(self):
+        # The ctime of the file just written can't be set back.
+        self.write('workers = 4', age=60)
+        with patch.object(host, 'RACY_MTIME_WINDOW', 0):
+            first = self.digest()
+        self.assertEqual(self.digest(), first)
+        self.assertEqual(self.file_hash.call_count, 1)
+
+    def test_changed_file_rehashed(self):
+        self.write('workers = 4', age=60)
+        first = self.digest()
+        self.write('workers = 16', age=60)
+        self.assertNotEqual(self.digest(), first)
+        self.assertEqual(self.file_hash.call_count, 2)
+
+    def test_racy_file_rehashed(self):
+        self.write('workers = 4')
+        self.digest()
+        self.digest()
+        self.assertEqual(self.file_hash.call_count, 2)
+        self.assertTrue(
+            self.db.get(host.RESTART_ON_CHANGE_STATS_KEY)[self.path]['racy'])
+
+    def test_same_size_rewrite_within_window(self):
+        # A filesystem with coarse timestamps may not change the stat of a
+        # file rewritten with the same size right after it was hashed.
+        self.write('workers = 4')
+        st = os.stat(self.path)
+        first = self.digest()
+        self.write('workers = 8')
+        with patch.object(host.os, 'stat', return_value=st):
+            self.assertNotEqual(self.digest(), first)
+        self.assertEqual(self.digest(), host.file_hash(self.path, 'blake2b'))
+
+    def test_missing_file(self):
+        self.assertIsNone(self.digest())
+        self.assertIsNone(self.db.get(host.RESTART_ON_CHANGE_STATS_KEY))
+
+    def test_restart_on_change_saves_once(self):
+        self.write('workers = 4', age=60)
+        with patch.object(self.db, 'flush', wraps=self.db.flush) as flush:
+            host.restart_on_change_helper(
+                lambda: self.write('workers = 8'), {self.path: []})
+        flush.assert_called_once_with()
+        self.assertEqual(
+            self.db.get(host.RESTART_ON_CHANGE_STATS_KEY)[self.path]['digest'],
+            host.file_hash(self.path, 'blake2b'))
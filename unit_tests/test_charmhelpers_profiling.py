@@ -0,0 +1,55 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from charmhelpers.core import profiling
+
+
+class CacheUsageTests(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'profile.jsonl')
+        for name, kwargs in (
+                ('profile_file', {'return_value': self.path}),
+                ('profiling_requested', {'return_value': True}),
+                ('local_unit', {'return_value': 'glance/0'}),
+                ('cache_info', {'return_value': {
+                    'charmhelpers.core.hookenv.config': {
+                        'hits': 7, 'misses': 1}}}),
+                ('atexit', {}),
+                ('log', {})):
+            _patch = patch.object(profiling, name, **kwargs)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        self.addCleanup(profiling.stop_profiling)
+
+    def test_recorded_at_hook_exit(self):
+        for _ in range(2):
+            profiling.start_profiling('config-changed')
+            profile = profiling.stop_profiling()
+        self.assertEqual(profile['cache'], {
+            'charmhelpers.core.hookenv.config': {'hits': 7, 'misses': 1}})
+        summary = profiling.summarize_profiles(profiling.read_profiles())
+        self.assertEqual(summary['cache'], {
+            'charmhelpers.core.hookenv.config': {'hits': 14, 'misses': 2}})
+        self.assertIn('charmhelpers.core.hookenv.config',
+                      profiling.format_summary(summary))
@@ -0,0 +1,420 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from unittest.mock import ANY, patch
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import unitdata
+
+CHARM_TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'templates')
+# haproxy.cfg as rendered by the charmhelpers template before it gained the
+# http mode, server limit and tuning settings.
+HAPROXY_CFG = """\
+global
+    # NOTE: on startup haproxy chroot's to /var/lib/haproxy.
+    #
+    # Unfortunately the program will open some files prior to the call to
+    # chroot never to reopen them, and some after. So looking at the on-disk
+    # layout of haproxy resources you will find some resources relative to /
+    # such as the admin socket, and some relative to /var/lib/haproxy such as
+    # the log socket.
+    #
+    # The logging socket is (re-)opened after the chroot and must be relative
+    # to /var/lib/haproxy.
+    log /dev/log local0
+    log /dev/log local1 notice
+    maxconn 20000
+    user haproxy
+    group haproxy
+    spread-checks 0
+    # The admin socket is opened prior to the chroot never to be reopened, so
+    # it lives outside the chroot directory in the filesystem.
+    stats socket /var/run/haproxy/admin.sock mode 600 level admin
+    stats timeout 2m
+
+defaults
+    log global
+    mode tcp
+    option tcplog
+    option dontlognull
+    retries 3
+    timeout queue 9000
+    timeout connect 9000
+    timeout client 90000
+    timeout server 90000
+
+listen stats
+    bind 127.0.0.1:8888
+    mode http
+    stats enable
+    stats hide-version
+    stats realm Haproxy\\ Statistics
+    stats uri /
+    stats auth admin:secret
+
+frontend tcp-in_glance_api
+    bind *:9292
+    acl net_10.5.0.10 dst 10.5.0.10/255.255.255.0
+    use_backend glance_api_10.5.0.10 if net_10.5.0.10
+    default_backend glance_api_10.5.0.10
+
+backend glance_api_10.5.0.10
+    balance leastconn
+    option httpchk GET /healthcheck
+    http-check expect status 200
+    server glance-0 10.5.0.10:9282 check
+    server glance-1 10.5.0.11:9282 check
+""" + '    \n'
+
+
+class SettingsContext(object):
+    interfaces = []
+
+    def __init__(self):
+        self.settings = {'workers': 4}
+
+    def __call__(self):
+        return dict(self.settings)
+
+
+class TemplatingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templates = os.path.join(self.tmpdir, 'templates')
+        os.mkdir(self.templates)
+        self.db = unitdata.Storage(':memory:')
+        for name, kwargs in (('kv', {'return_value': self.db}),
+                             ('charm_dir', {'return_value': None}),
+                             ('log', {})):
+            _patch = patch.object(templating, name, **kwargs)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+
+class WriteTests(TemplatingTestCase):
+
+    def setUp(self):
+        super(WriteTests, self).setUp()
+        self.write(os.path.join(self.templates, 'glance-api.conf'),
+                   'workers = {{ workers }}')
+        self.write(os.path.join(self.templates, 'glance-cache.conf'),
+                   'cache = {{ workers }}')
+        self.api_conf = os.path.join(self.tmpdir, 'glance-api.conf')
+        self.cache_conf = os.path.join(self.tmpdir, 'glance-cache.conf')
+        self.ctxt = SettingsContext()
+        self.configs = self.renderer()
+
+    def renderer(self):
+        configs = templating.OSConfigRenderer(self.templates, 'caracal')
+        configs.register(self.api_conf, [self.ctxt])
+        configs.register(self.cache_conf, [self.ctxt])
+        return configs
+
+    def test_written(self):
+        self.configs.write(self.api_conf)
+        self.assertEqual(self.read(self.api_conf), 'workers = 4')
+        self.assertEqual(self.configs.write_decisions,
+                         {self.api_conf: 'written'})
+
+    def test_skipped_when_fingerprint_matches(self):
+        self.configs.write_all()
+        configs = self.renderer()
+        with patch.object(configs, '_render') as _render:
+            configs.write_all()
+        self.assertFalse(_render.called)
+        self.assertEqual(configs.write_decisions,
+                         {self.api_conf: 'skipped',
+                          self.cache_conf: 'skipped'})
+
+    def test_rendered_when_context_changed(self):
+        self.configs.write(self.api_conf)
+        self.ctxt.settings['workers'] = 8
+        self.configs.write(self.api_conf)
+        self.assertEqual(self.read(self.api_conf), 'workers = 8')
+        self.assertEqual(self.configs.write_decisions,
+                         {self.api_conf: 'written'})
+
+    def test_rendered_when_file_changed(self):
+        self.configs.write(self.api_conf)
+        self.write(self.api_conf, 'workers = 1')
+        self.configs.write(self.api_conf)
+        self.assertEqual(self.read(self.api_conf), 'workers = 4')
+        self.assertEqual(self.configs.write_decisions,
+                         {self.api_conf: 'written'})
+
+    def test_rendered_when_file_missing(self):
+        self.configs.write(self.api_conf)
+        os.remove(self.api_conf)
+        self.configs.write(self.api_conf)
+        self.assertEqual(self.read(self.api_conf), 'workers = 4')
+
+    def test_unchanged_when_rendered_same(self):
+        self.write(self.api_conf, 'workers = 4')
+        ino = os.stat(self.api_conf).st_ino
+        self.configs.write(self.api_conf)
+        self.assertEqual(os.stat(self.api_conf).st_ino, ino)
+        self.assertEqual(self.configs.write_decisions,
+                         {self.api_conf: 'unchanged'})
+
+    def test_write_all_saves_fingerprints_once(self):
+        with patch.object(self.db, 'set', wraps=self.db.set) as set_, \
+                patch.object(self.db, 'flush') as flush:
+            self.configs.write_all()
+            set_.assert_called_once_with('templating-fingerprints', ANY)
+            self.assertEqual(
+                sorted(self.db.get('templating-fingerprints')),
+                [self.api_conf, self.cache_conf])
+            set_.reset_mock()
+            self.renderer().write_all()
+            self.assertFalse(set_.called)
+        # Committed with the rest of the hook's unit state.
+        self.assertFalse(flush.called)
+
+    def test_rendered_without_fingerprint_for_mixed_keys(self):
+        self.configs.write(self.api_conf)
+        self.ctxt.settings['ports'] = {9292: 'api', 'admin': 9393}
+        self.configs.write(self.api_conf)
+        self.assertEqual(self.read(self.api_conf), 'workers = 4')
+        self.assertEqual(self.configs.write_decisions,
+                         {self.api_conf: 'unchanged'})
+        self.assertNotIn(self.api_conf,
+                         self.db.get('templating-fingerprints'))
+        with patch.object(self.configs, '_render',
+                          wraps=self.configs._render) as _render:
+            self.configs.write(self.api_conf)
+        self.assertTrue(_render.called)
+
+    def test_write_all_saves_fingerprints_on_failure(self):
+        self.configs.register(os.path.join(self.tmpdir, 'missing.conf'),
+                              [self.ctxt])
+        with self.assertRaises(Exception):
+            self.configs.write_all()
+        self.assertEqual(sorted(self.db.get('templating-fingerprints')),
+                         [self.api_conf, self.cache_conf])
+
+
+class WriteAtomicTests(TemplatingTestCase):
+
+    def setUp(self):
+        super(WriteAtomicTests, self).setUp()
+        self.etc = os.path.join(self.tmpdir, 'etc')
+        os.mkdir(self.etc)
+        self.path = os.path.join(self.etc, 'glance-api.conf')
+
+    def test_new_file_honours_umask(self):
+        umask = os.umask(0o027)
+        self.addCleanup(os.umask, umask)
+        self.assertTrue(templating.OSConfigRenderer._write_atomic(
+            self.path, b'new'))
+        self.assertEqual(self.read(self.path), 'new')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+    def test_replaced_keeping_owner_and_mode(self):
+        self.write(self.path, 'old')
+        os.chmod(self.path, 0o640)
+        st = os.stat(self.path)
+        with patch.object(templating.os, 'chown') as chown:
+            self.assertTrue(templating.OSConfigRenderer._write_atomic(
+                self.path, b'new'))
+        tmp = chown.call_args[0][0]
+        chown.assert_called_once_with(tmp, st.st_uid, st.st_gid)
+        self.assertEqual(os.path.dirname(tmp), self.etc)
+        self.assertEqual(self.read(self.path), 'new')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertNotEqual(os.stat(self.path).st_ino, st.st_ino)
+        self.assertEqual(os.listdir(self.etc), ['glance-api.conf'])
+
+    def test_symlink_target_replaced(self):
+        target = os.path.join(self.etc, 'target.conf')
+        self.write(target, 'old')
+        os.symlink(target, self.path)
+        templating.OSConfigRenderer._write_atomic(self.path, b'new')
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self.read(target), 'new')
+
+    def test_same_content_not_replaced(self):
+        self.write(self.path, 'same')
+        ino = os.stat(self.path).st_ino
+        self.assertFalse(templating.OSConfigRenderer._write_atomic(
+            self.path, b'same'))
+        self.assertEqual(os.stat(self.path).st_ino, ino)
+
+    def test_failure_leaves_file(self):
+        self.write(self.path, 'old')
+        with patch.object(templating.os, 'rename', side_effect=OSError):
+            with self.assertRaises(OSError):
+                templating.OSConfigRenderer._write_atomic(self.path, b'new')
+        self.assertEqual(self.read(self.path), 'old')
+        self.assertEqual(os.listdir(self.etc), ['glance-api.conf'])
+
+
+class BytecodeCacheTests(TemplatingTestCase):
+
+    TEMPLATE = ('{% for k, v in settings | dictsort %}'
+                '{{ k }} = {{ v }}\n{% endfor %}'
+                '{% include "section" %}')
+
+    def setUp(self):
+        super(BytecodeCacheTests, self).setUp()
+        self.charm_dir = os.path.join(self.tmpdir, 'charm')
+        os.mkdir(self.charm_dir)
+        self.write(os.path.join(self.charm_dir, 'revision'), '42\n')
+        templating.charm_dir.return_value = self.charm_dir
+        self.write(os.path.join(self.templates, 'glance-api.conf'),
+                   self.TEMPLATE)
+        self.write(os.path.join(self.templates, 'section'),
+                   '[{{ section }}]')
+        self.cache = os.path.join(self.charm_dir, '.jinja-cache')
+        self.ctxt = SettingsContext()
+        self.ctxt.settings = {'settings': {'workers': 4, 'debug': False},
+                              'section': 'paste_deploy'}
+
+    def render(self, release='caracal'):
+        configs = templating.OSConfigRenderer(self.templates, release)
+        configs.register('/etc/glance/glance-api.conf',
+                         [self.ctxt])
+        return configs.render('/etc/glance/glance-api.conf')
+
+    def test_cache_dir(self):
+        self.assertEqual(templating.get_bytecode_cache_dir('caracal'),
+                         os.path.join(self.cache, '42-caracal'))
+        os.remove(os.path.join(self.charm_dir, 'revision'))
+        self.assertEqual(templating.get_bytecode_cache_dir('caracal'),
+                         os.path.join(self.cache, 'unknown-caracal'))
+
+    def test_cache_hit_renders_as_cold(self):
+        cold = self.render()
+        cached = os.listdir(os.path.join(self.cache, '42-caracal'))
+        self.assertEqual(len(cached), 2)
+        with patch.object(templating._jinja2().Environment, 'compile',
+                          autospec=True) as compile_:
+            self.assertEqual(self.render(), cold)
+        self.assertFalse(compile_.called)
+        self.assertEqual(cold, 'debug = False\nworkers = 4\n[paste_deploy]')
+
+    def test_edited_template_recompiled(self):
+        self.render()
+        self.write(os.path.join(self.templates, 'section'),
+                   '[{{ section | upper }}]')
+        os.utime(os.path.join(self.templates, 'section'),
+                 (0, os.stat(self.templates).st_mtime + 10))
+        self.assertTrue(self.render().endswith('[PASTE_DEPLOY]'))
+
+    def test_stale_caches_pruned(self):
+        for name in ('41-bobcat', '41-caracal', '42-bobcat'):
+            os.makedirs(os.path.join(self.cache, name))
+        self.render()
+        self.assertEqual(os.listdir(self.cache), ['42-caracal'])
+
+    def test_flush(self):
+        self.render()
+        templating.flush_bytecode_cache()
+        self.assertFalse(os.path.exists(self.cache))
+        self.render()
+        self.assertEqual(os.listdir(self.cache), ['42-caracal'])
+
+
+class HAProxyTemplateTests(TemplatingTestCase):
+
+    def setUp(self):
+        super(HAProxyTemplateTests, self).setUp()
+        self.ctxt = SettingsContext()
+        self.ctxt.settings = {
+            'local_host': '127.0.0.1',
+            'stat_port': '8888',
+            'stat_password': 'secret',
+            'service_ports': {'glance_api': [9292, 9282]},
+            'default_backend': '10.5.0.10',
+            'frontends': {'10.5.0.10': {
+                'network': '10.5.0.10/255.255.255.0',
+                'backends': {'glance-0': '10.5.0.10',
+                             'glance-1': '10.5.0.11'}}},
+            'backend_options': {'glance_api': [{
+                'option': 'httpchk GET /healthcheck',
+                'http-check': 'expect status 200'}]},
+            'https': False,
+            'ipv6_enabled': False,
+        }
+
+    def render(self, **settings):
+        self.ctxt.settings.update(settings)
+        configs = templating.OSConfigRenderer(CHARM_TEMPLATES, 'caracal')
+        configs.register('/etc/haproxy/haproxy.cfg', [self.ctxt])
+        return configs.render('/etc/haproxy/haproxy.cfg')
+
+    def test_charmhelpers_template_used(self):
+        self.assertFalse(os.path.exists(
+            os.path.join(CHARM_TEMPLATES, 'haproxy.cfg')))
+
+    def test_tcp_mode_unchanged(self):
+        self.assertEqual(self.render(), HAPROXY_CFG)
+        self.assertEqual(
+            self.render(haproxy_http_mode=False, haproxy_http_reuse='safe',
+                        server_maxconn=None, server_maxqueue=None,
+                        haproxy_maxconn=20000, haproxy_tune_bufsize=None),
+            HAPROXY_CFG)
+
+    def test_https_unchanged(self):
+        self.assertEqual(
+            self.render(https=True),
+            HAPROXY_CFG.replace(':9282 check', ':9282 check check-ssl '
+                                'verify none'))
+
+    def test_tuning(self):
+        cfg = self.render(haproxy_maxconn=40000, haproxy_nbthread=4,
+                          haproxy_cpu_map='auto:1/1-4 28-31',
+                          haproxy_tune_bufsize=65536)
+        self.assertIn('    maxconn 40000\n'
+                      '    nbthread 4\n'
+                      '    cpu-map auto:1/1-4 28-31\n'
+                      '    tune.bufsize 65536\n'
+                      '    user haproxy\n', cfg)
+
+    def test_server_limits(self):
+        cfg = self.render(server_maxconn=32, server_maxqueue=64)
+        self.assertIn('    server glance-0 10.5.0.10:9282 check maxconn 32 '
+                      'maxqueue 64\n', cfg)
+        cfg = self.render(https=True, server_maxqueue=None)
+        self.assertIn('    server glance-0 10.5.0.10:9282 check check-ssl '
+                      'verify none maxconn 32\n', cfg)
+
+    def test_http_mode(self):
+        cfg = self.render(haproxy_http_mode=True, haproxy_http_reuse='safe')
+        self.assertIn('    use_backend glance_api_10.5.0.10 if '
+                      'net_10.5.0.10\n'
+                      '    mode http\n'
+                      '    option httplog\n'
+                      '    option http-keep-alive\n'
+                      '    default_backend glance_api_10.5.0.10\n', cfg)
+        self.assertIn('    balance leastconn\n'
+                      '    mode http\n'
+                      '    option http-keep-alive\n'
+                      '    http-reuse safe\n'
+                      '    option httpchk GET /healthcheck\n', cfg)
@@ -0,0 +1,250 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from charmhelpers.core import unitdata
+
+
+class StorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:', keep_revisions=True,
+                                   read_cache=True)
+        self.addCleanup(self.db.close)
+
+    def revisions(self):
+        """Return [(key, revision, value)] of the recorded revisions."""
+        self.db.cursor.execute(
+            'select key, revision, data from kv_revisions '
+            'order by revision, key')
+        return [(key, revision, json.loads(data))
+                for key, revision, data in self.db.cursor.fetchall()]
+
+    def test_set(self):
+        self.db.set('a', 1)
+        self.assertEqual(self.db.get('a'), 1)
+        self.db.set('a', {'b': [2]})
+        self.assertEqual(self.db.get('a'), {'b': [2]})
+
+    def test_changed_rows(self):
+        self.assertEqual(self.db._write_kv([('a', '1'), ('b', '2')]), 2)
+        self.assertEqual(self.db._write_kv([('a', '1'), ('b', '3')]), 1)
+        self.assertEqual(self.db._write_kv([('a', '1')]), 0)
+
+    def test_update(self):
+        self.db.set('p.a', 1)
+        self.db.update({'a': 2, 'b': 3}, prefix='p.')
+        self.assertEqual(self.db.getrange('p.', strip=True),
+                         {'a': 2, 'b': 3})
+
+    def test_update_many_keys(self):
+        mapping = {str(i): i for i in range(unitdata._MAX_VARIABLES * 2 + 1)}
+        with self.db.hook_scope('config-changed'):
+            self.db.update(mapping)
+        self.assertEqual(self.db.getrange(''), mapping)
+        self.assertEqual(len(self.revisions()), len(mapping))
+
+    def test_revisions(self):
+        with self.db.hook_scope('install') as revision:
+            self.db.set('a', 1)
+            self.db.set('a', 2)
+            self.db.update({'b': 1, 'c': 1})
+        with self.db.hook_scope('config-changed'):
+            self.db.set('a', 2)
+            self.db.update({'b': 1, 'c': 2})
+            self.db.unset('b')
+            self.db.unset('missing')
+        self.assertEqual(self.revisions(), [
+            ('a', revision, 2), ('b', revision, 1), ('c', revision, 1),
+            ('b', revision + 1, 'DELETED'), ('c', revision + 1, 2)])
+        self.assertEqual(
+            [(rev, value, hook) for rev, _, value, hook, _ in
+             self.db.gethistory('b', deserialize=True)],
+            [(revision, 1, 'install'), (revision + 1, 'DELETED',
+                                        'config-changed')])
+
+    def test_no_revisions_outside_hook_scope(self):
+        self.db.set('a', 1)
+        self.db.update({'b': 1})
+        self.db.unset('a')
+        self.assertEqual(self.revisions(), [])
+
+    def test_unsetrange_revisions(self):
+        self.db.update({'a': 1, 'b': 1, 'p.c': 1})
+        with self.db.hook_scope('stop') as revision:
+            self.db.unsetrange(['a', 'b'])
+            self.db.unsetrange(prefix='p.')
+        self.assertEqual(self.revisions(), [
+            ('a', revision, 'DELETED'), ('b', revision, 'DELETED'),
+            ('p.%', revision, 'DELETED')])
+
+    def test_read_cache_after_set_and_unset(self):
+        self.db.set('a', 1)
+        self.assertEqual(self.db.get('a'), 1)
+        self.db.set('a', 2)
+        self.assertEqual(self.db.get('a'), 2)
+        self.db.update({'a': 3})
+        self.assertEqual(self.db.get('a'), 3)
+        self.db.unset('a')
+        self.assertIsNone(self.db.get('a'))
+        self.db.update({'p_a': 1, 'pxb': 1})
+        self.db.unsetrange(['p_a'])
+        self.assertIsNone(self.db.get('p_a'))
+        self.assertEqual(self.db.get('pxb'), 1)
+        # like matches _ as any character.
+        self.db.unsetrange(prefix='p_')
+        self.assertIsNone(self.db.get('pxb'))
+
+    def test_read_cache_after_rollback(self):
+        self.db.set('a', 1)
+        self.db.flush()
+        self.db.set('a', 2)
+        self.db.flush(False)
+        self.assertEqual(self.db.get('a'), 1)
+        self.db.set('a', 2)
+        self.assertEqual(self.db.get('a'), 2)
+
+    def test_read_cache_served_from_memory(self):
+        self.db.set('a', 1)
+        self.db.get('a')
+        with patch.object(self.db, 'cursor') as cursor:
+            self.assertEqual(self.db.get('a'), 1)
+            self.db.set('a', 1)
+        self.assertFalse(cursor.execute.called)
+
+
+@patch.object(unitdata, '_HAVE_UPSERT', False)
+class StorageWithoutUpsertTests(StorageTests):
+    """The same, with SQLite older than 3.24."""
+
+
+class CompactTests(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, '.unit-state.db')
+        self.db = self.open()
+
+    def open(self, **kwargs):
+        db = unitdata.Storage(self.path, keep_revisions=True, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def run_hooks(self, db, count):
+        """Run count hooks, each changing 'config.workers'; returns the
+        revision of the last."""
+        for _ in range(count):
+            with db.hook_scope('config-changed') as revision:
+                db.update({'workers': revision}, prefix='config.')
+        return revision
+
+    def hooks(self, db):
+        db.cursor.execute('select version from hooks order by version')
+        return [version for version, in db.cursor.fetchall()]
+
+    def history(self, db):
+        return [revision for revision, _, _, _, _ in
+                db.gethistory('config.workers')]
+
+    def age_hooks(self, db, versions, days):
+        date = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        db.cursor.executemany('update hooks set date = ? where version = ?',
+                              [(date.isoformat(), v) for v in versions])
+        db.flush()
+
+    def test_prune_by_count(self):
+        db = self.open(history_max_revisions=3, history_max_age=None)
+        last = self.run_hooks(db, 5)
+        db.compact()
+        db.flush()
+        self.assertEqual(self.hooks(db), [last - 2, last - 1, last])
+        self.assertEqual(self.history(db), [last - 2, last - 1, last])
+        self.assertEqual(db.get('config.workers'), last)
+
+    def test_prune_by_age(self):
+        db = self.open(history_max_revisions=None,
+                       history_max_age=datetime.timedelta(days=30))
+        last = self.run_hooks(db, 5)
+        # Dates need not be in version order, the cutoff is the latest old
+        # hook.
+        self.age_hooks(db, [last - 4, last - 2], days=31)
+        db.compact()
+        db.flush()
+        self.assertEqual(self.hooks(db), [last - 1, last])
+        self.assertEqual(self.history(db), [last - 1, last])
+
+    def test_larger_cutoff_wins(self):
+        db = self.open(history_max_revisions=4,
+                       history_max_age=datetime.timedelta(days=30))
+        last = self.run_hooks(db, 5)
+        db.compact()
+        self.assertEqual(len(self.hooks(db)), 4)
+        self.age_hooks(db, [last - 2], days=31)
+        db.compact()
+        self.assertEqual(self.hooks(db), [last - 1, last])
+
+    def test_no_limits(self):
+        db = self.open(history_max_revisions=None, history_max_age=None)
+        self.run_hooks(db, 5)
+        self.age_hooks(db, self.hooks(db), days=365)
+        db.compact()
+        self.assertEqual(len(self.hooks(db)), 5)
+
+    def test_compacted_by_hook_scope(self):
+        db = self.open(history_max_revisions=2, history_max_age=None)
+        with patch.object(unitdata, 'HISTORY_COMPACT_INTERVAL', 4):
+            last = self.run_hooks(db, 4)
+        # Compacted when the fourth hook started, keeping it and the one
+        # before.
+        self.assertEqual(self.hooks(db), [last - 1, last])
+        # The compaction is committed with the hook.
+        self.assertEqual(self.hooks(self.open()), [last - 1, last])
+
+    def test_revisions_not_reused(self):
+        db = self.open(history_max_revisions=0, history_max_age=None)
+        last = self.run_hooks(db, 3)
+        db.compact()
+        db.flush()
+        self.assertEqual(self.hooks(db), [])
+        db = self.open()
+        self.assertEqual(self.run_hooks(db, 1), last + 1)
+        self.assertEqual(self.history(db), [last + 1])
+
+    def test_delta_after_compaction(self):
+        db = self.open(history_max_revisions=0, history_max_age=None)
+        with db.hook_scope('install'):
+            db.update({'workers': 4, 'debug': False}, prefix='config.')
+        db.compact()
+        db.flush()
+        db = self.open()
+        with db.hook_scope('config-changed'):
+            config = {'workers': 8, 'debug': False, 'verbose': True}
+            delta = db.delta(config, 'config.')
+            db.update(config, prefix='config.')
+        self.assertEqual(delta, {
+            'workers': unitdata.Delta(4, 8),
+            'verbose': unitdata.Delta(None, True)})
+        self.assertEqual(
+            [(value, hook) for _, _, value, hook, _ in
+             db.gethistory('config.workers', deserialize=True)],
+            [(8, 'config-changed')])
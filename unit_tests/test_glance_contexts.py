@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, mock_open
 
 import glance_contexts as contexts
 from test_utils import (
@@ -75,6 +75,67 @@ class TestGlanceContexts(CharmTestCase):
                              "/var/lib/glance/images/",
                           'image_size_cap': 1099511627776})
 
+    @patch.object(contexts.GlanceServerTuningContext, 'somaxconn')
+    def test_glance_server_tuning_context(self, somaxconn):
+        somaxconn.return_value = 4096
+        self.config.side_effect = self.test_config.get
+        self.assertEqual(contexts.GlanceServerTuningContext()(),
+                         {'backlog': 4096})
+        self.assertFalse(self.juju_log.called)
+
+        self.test_config.set('listen-backlog', 8192)
+        self.test_config.set('max-header-line', 32768)
+        self.test_config.set('client-socket-timeout', 0)
+        self.test_config.set('tcp-keepidle', 60)
+        self.assertEqual(contexts.GlanceServerTuningContext()(), {
+            'backlog': 8192,
+            'max_header_line': 32768,
+            'client_socket_timeout': 0,
+            'tcp_keepidle': 60})
+        self.juju_log.assert_called_once_with(
+            'listen-backlog 8192 exceeds net.core.somaxconn 4096, the '
+            'kernel will silently truncate it', level=contexts.WARNING)
+
+    def test_glance_server_tuning_context_invalid(self):
+        self.config.side_effect = self.test_config.get
+        ctxt = contexts.GlanceServerTuningContext()
+        self.test_config.set('listen-backlog', 0)
+        self.assertRaises(ValueError, ctxt.validate)
+        self.assertEqual(ctxt(), {})
+        self.test_config.set('listen-backlog', 1024)
+        self.test_config.set('tcp-keepidle', -1)
+        self.assertRaises(ValueError, ctxt.validate)
+
+    def test_glance_server_tuning_somaxconn(self):
+        with patch('builtins.open', mock_open(read_data='4096\n')) as _open:
+            self.assertEqual(
+                contexts.GlanceServerTuningContext.somaxconn(), 4096)
+            _open.assert_called_once_with('/proc/sys/net/core/somaxconn')
+            _open.side_effect = IOError
+            self.assertIsNone(contexts.GlanceServerTuningContext.somaxconn())
+
+    def test_database_pool_context_defaults(self):
+        config = {'database-connection-recycle-time': 3600}
+        self.config.side_effect = lambda x: config.get(x)
+        # The oslo.db per worker defaults apply.
+        self.assertEqual(contexts.DatabasePoolContext()(), {
+            'database_connection_recycle_time': 3600})
+
+    def test_database_pool_context(self):
+        config = {
+            'database-max-pool-size': 20,
+            'database-max-overflow': 0,
+            'database-pool-timeout': 60,
+            'database-connection-recycle-time': 600,
+            'database-max-retries': 5}
+        self.config.side_effect = lambda x: config.get(x)
+        self.assertEqual(contexts.DatabasePoolContext()(), {
+            'database_max_pool_size': 20,
+            'database_max_overflow': 0,
+            'database_pool_timeout': 60,
+            'database_connection_recycle_time': 600,
+            'database_max_retries': 5})
+
     def test_glance_image_import_context(self):
         config = {
             'image-conversion': True,
@@ -112,6 +173,48 @@ class TestGlanceContexts(CharmTestCase):
         self.assertEqual(contexts.ObjectStoreContext()(),
                          {'swift_store': True})
 
+    def test_swift_tuning_not_related(self):
+        self.relation_ids.return_value = []
+        self.assertEqual(contexts.SwiftStoreTuningContext()(), {})
+
+    def test_swift_tuning(self):
+        self.relation_ids.return_value = ['object-store:0']
+        conf_dict = {
+            'swift-store-large-object-size': 10240,
+            'swift-store-large-object-chunk-size': 1024,
+            'swift-store-multi-tenant': False,
+            'swift-buffer-on-upload': False,
+            'swift-store-multiple-containers-seed': 3,
+        }
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        self.assertEqual(contexts.SwiftStoreTuningContext()(), {
+            'swift_store_large_object_size': 10240,
+            'swift_store_large_object_chunk_size': 1024,
+            'swift_store_multi_tenant': 'false',
+            'swift_store_multiple_containers_seed': 3,
+        })
+
+        conf_dict['swift-buffer-on-upload'] = True
+        ctxt = contexts.SwiftStoreTuningContext()()
+        self.assertEqual(ctxt['swift_buffer_on_upload'], 'true')
+        self.assertEqual(ctxt['swift_upload_buffer_dir'],
+                         contexts.SWIFT_UPLOAD_BUFFER_DIR)
+
+    def test_swift_tuning_invalid(self):
+        self.relation_ids.return_value = ['object-store:0']
+        conf_dict = {
+            'swift-store-large-object-size': 100,
+            'swift-store-large-object-chunk-size': 200,
+        }
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        ctxt = contexts.SwiftStoreTuningContext()
+        self.assertEqual(ctxt(), {})
+        self.assertRaises(ValueError, ctxt.validate)
+        conf_dict['swift-store-large-object-size'] = 5120
+        ctxt.validate()
+        conf_dict['swift-store-multiple-containers-seed'] = 33
+        self.assertRaises(ValueError, ctxt.validate)
+
     def test_cinder_not_related(self):
         self.relation_ids.return_value = []
         self.assertEqual(contexts.CinderStoreContext()(), {})
@@ -194,6 +297,50 @@ class TestGlanceContexts(CharmTestCase):
              'rbd_user': service,
              'expose_image_locations': True})
 
+    def test_ceph_client_tuning_defaults(self):
+        conf_dict = {
+            'rbd-store-chunk-size': 8,
+            'rbd-thin-provisioning': False,
+            'rbd-cache-writethrough-until-flush': True,
+        }
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        self.assertEqual(
+            contexts.CephClientTuningContext()(),
+            {'rbd_store_chunk_size': 8,
+             'rbd_client_cache_settings': {
+                 'rbd cache writethrough until flush': 'true'}})
+
+    def test_ceph_client_tuning(self):
+        conf_dict = {
+            'rbd-store-chunk-size': 64,
+            'rbd-thin-provisioning': True,
+            'rbd-objecter-inflight-ops': 8192,
+            'rbd-objecter-inflight-op-bytes': 1073741824,
+            'rbd-cache-size': 268435456,
+            'rbd-cache-writethrough-until-flush': False,
+        }
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        self.assertEqual(
+            contexts.CephClientTuningContext()(),
+            {'rbd_store_chunk_size': 64,
+             'rbd_thin_provisioning': 'true',
+             'rbd_client_cache_settings': {
+                 'objecter inflight ops': 8192,
+                 'objecter inflight op bytes': 1073741824,
+                 'rbd cache': 'true',
+                 'rbd cache size': 268435456,
+                 'rbd cache writethrough until flush': 'false'}})
+
+    def test_ceph_client_tuning_invalid(self):
+        conf_dict = {'rbd-store-chunk-size': 12}
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        ctxt = contexts.CephClientTuningContext()
+        self.assertEqual(ctxt(), {})
+        self.assertRaises(ValueError, ctxt.validate)
+        conf_dict = {'rbd-store-chunk-size': 8,
+                     'rbd-cache-size': -1}
+        self.assertRaises(ValueError, ctxt.validate)
+
     def test_external_s3_not_configured(self):
         config = {
             's3-store-host': '',
@@ -241,14 +388,24 @@ class TestGlanceContexts(CharmTestCase):
             's3-store-host': host_name,
             's3-store-access-key': access_key,
             's3-store-secret-key': secret_key,
-            's3-store-bucket': bucket}
+            's3-store-bucket': bucket,
+            's3-store-create-bucket-on-put': False,
+            's3-store-bucket-url-format': 'auto',
+            's3-store-large-object-size': 100,
+            's3-store-large-object-chunk-size': 10,
+            's3-store-thread-pools': 10}
         self.config.side_effect = lambda x: config[x]
         expected_ctx = {
             'expose_image_locations': False,
             's3_store_host': host_name,
             's3_store_access_key': access_key,
             's3_store_secret_key': secret_key,
-            's3_store_bucket': bucket
+            's3_store_bucket': bucket,
+            's3_store_create_bucket_on_put': 'false',
+            's3_store_bucket_url_format': 'auto',
+            's3_store_large_object_size': 100,
+            's3_store_large_object_chunk_size': 10,
+            's3_store_thread_pools': 10,
         }
 
         self.os_release.return_value = 'train'
@@ -257,6 +414,30 @@ class TestGlanceContexts(CharmTestCase):
         self.os_release.return_value = 'ussuri'
         self.assertEqual(contexts.ExternalS3Context()(), expected_ctx)
 
+    def test_external_s3_tuning_invalid(self):
+        config = {
+            's3-store-host': 'http://my-object-storage.example.com:8080',
+            's3-store-access-key': 'my-access-key',
+            's3-store-secret-key': 'my-secret-key',
+            's3-store-bucket': 'my-bucket',
+            's3-store-bucket-url-format': 'auto',
+            's3-store-large-object-size': 1024,
+            's3-store-large-object-chunk-size': 64,
+            's3-store-thread-pools': 32}
+        self.config.side_effect = lambda x: config.get(x)
+        self.os_release.return_value = 'ussuri'
+        ctxt = contexts.ExternalS3Context()
+        ctxt.validate()
+        config['s3-store-bucket-url-format'] = 'subdomain'
+        self.assertRaises(ValueError, ctxt.validate)
+        self.assertEqual(ctxt(), {})
+        config['s3-store-bucket-url-format'] = 'path'
+        config['s3-store-large-object-chunk-size'] = 4
+        self.assertRaises(ValueError, ctxt.validate)
+        config['s3-store-large-object-chunk-size'] = 5
+        config['s3-store-thread-pools'] = 0
+        self.assertRaises(ValueError, ctxt.validate)
+
     def test_multistore_below_mitaka(self):
         self.os_release.return_value = 'liberty'
         self.relation_ids.return_value = ['random_rid']
@@ -471,6 +652,31 @@ class TestGlanceContexts(CharmTestCase):
                 'default_store_backend': 'ceph',
             })
 
+    def test_multi_backend_with_ceph_tuning(self):
+        self.maxDiff = None
+        self.relation_ids.return_value = []
+        self.is_relation_made.return_value = True
+        service = 'glance'
+        self.service_name.return_value = service
+        conf_dict = {
+            'rbd-pool-name': 'mypool',
+            'rbd-store-chunk-size': 32,
+            'rbd-thin-provisioning': True,
+        }
+        self.config.side_effect = lambda x: conf_dict.get(x)
+        self.assertEqual(
+            contexts.MultiBackendContext()()['enabled_backend_configs'],
+            {
+                'ceph': {
+                    "rbd_store_chunk_size": 32,
+                    "rbd_store_pool": 'mypool',
+                    "rbd_store_user": service,
+                    "rados_connect_timeout": 0,
+                    "rbd_store_ceph_conf": "/etc/ceph/ceph.conf",
+                    "rbd_thin_provisioning": "true",
+                }
+            })
+
     def test_multi_backend_with_ceph_and_swift(self):
         # return relation_ids only for swift but not for cinder
         def _relation_ids(*args, **kwargs):
@@ -582,6 +788,11 @@ class TestGlanceContexts(CharmTestCase):
             's3-store-access-key': s3_access_key,
             's3-store-secret-key': s3_secret_key,
             's3-store-bucket': s3_bucket,
+            's3-store-create-bucket-on-put': True,
+            's3-store-bucket-url-format': 'path',
+            's3-store-large-object-size': 1024,
+            's3-store-large-object-chunk-size': 64,
+            's3-store-thread-pools': 32,
         }
         self.config.side_effect = lambda x: conf_dict.get(x)
         self.assertEqual(
@@ -597,6 +808,11 @@ class TestGlanceContexts(CharmTestCase):
                         "s3_store_access_key": s3_access_key,
                         "s3_store_secret_key": s3_secret_key,
                         "s3_store_bucket": s3_bucket,
+                        "s3_store_create_bucket_on_put": "true",
+                        "s3_store_bucket_url_format": "path",
+                        "s3_store_large_object_size": 1024,
+                        "s3_store_large_object_chunk_size": 64,
+                        "s3_store_thread_pools": 32,
                     }
                 },
                 'enabled_backends': 'local:file, s3:s3',
@@ -648,9 +864,15 @@ class TestGlanceContexts(CharmTestCase):
         self.assertEqual(ctxt(), {'bind_host': '0.0.0.0',
                                   'registry_host': '0.0.0.0'})
 
+    @patch.object(contexts.os, 'sched_getaffinity')
+    @patch.object(contexts, 'lsb_release')
     @patch('charmhelpers.contrib.hahelpers.cluster.https')
     @patch('glance_contexts.https')
-    def test_ctxt(self, mock_https, mock_ch_https):
+    def test_ctxt(self, mock_https, mock_ch_https, lsb_release,
+                  sched_getaffinity):
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'jammy'}
+        sched_getaffinity.return_value = set(range(8))
+        self.config.side_effect = self.test_config.get
         bind_port = 9282
         for https_mode in [False, True]:
             mock_https.return_value = https_mode
@@ -670,5 +892,204 @@ class TestGlanceContexts(CharmTestCase):
                     ]
                 },
                 "https": https_mode,
+                "server_maxconn": None,
+                "server_maxqueue": None,
+                "haproxy_maxconn": 20000,
+                "haproxy_tune_bufsize": None,
+                "haproxy_nbthread": 2,
             }
             self.assertEqual(expected, haproxy_context())
+
+    @patch.object(contexts, 'GlanceWSGIWorkerConfigContext')
+    @patch('charmhelpers.contrib.hahelpers.cluster.https')
+    @patch('glance_contexts.https')
+    def test_ctxt_http_mode(self, mock_https, mock_ch_https, wsgi_ctxt):
+        mock_https.return_value = False
+        mock_ch_https.return_value = False
+        wsgi_ctxt.return_value.return_value = {'processes': 4, 'threads': 8}
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('haproxy-mode', 'http')
+        ctxt = contexts.HAProxyContext()()
+        self.assertTrue(ctxt['haproxy_http_mode'])
+        self.assertEqual(ctxt['haproxy_http_reuse'], 'safe')
+        self.assertEqual(ctxt['server_maxconn'], 32)
+
+        self.test_config.set('haproxy-server-maxconn', 100)
+        self.assertEqual(contexts.HAProxyContext()()['server_maxconn'], 100)
+
+        mock_https.return_value = True
+        mock_ch_https.return_value = True
+        self.assertNotIn('haproxy_http_mode', contexts.HAProxyContext()())
+
+    @patch.object(contexts.os, 'sched_getaffinity')
+    @patch.object(contexts, 'lsb_release')
+    @patch('charmhelpers.contrib.hahelpers.cluster.https')
+    @patch('glance_contexts.https')
+    def test_ctxt_threads(self, mock_https, mock_ch_https, lsb_release,
+                          sched_getaffinity):
+        mock_https.return_value = False
+        mock_ch_https.return_value = False
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'jammy'}
+        sched_getaffinity.return_value = set(range(32))
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('haproxy-cpu-pinning', True)
+        ctxt = contexts.HAProxyContext()()
+        self.assertEqual(ctxt['haproxy_nbthread'], 4)
+        self.assertEqual(ctxt['haproxy_cpu_map'], 'auto:1/1-4 28-31')
+        sched_getaffinity.assert_called_with(0)
+
+        # Only the cpus the unit may use, e.g. in a container.
+        sched_getaffinity.return_value = {1, 3, 4, 6, 7, 9, 12, 13, 17}
+        ctxt = contexts.HAProxyContext()()
+        self.assertEqual(ctxt['haproxy_nbthread'], 2)
+        self.assertEqual(ctxt['haproxy_cpu_map'], 'auto:1/1-2 13 17')
+        self.test_config.set('haproxy-nbthread', 4)
+        ctxt = contexts.HAProxyContext()()
+        self.assertEqual(ctxt['haproxy_cpu_map'], 'auto:1/1-4 9 12-13 17')
+
+        self.test_config.set('haproxy-nbthread', 2)
+        sched_getaffinity.return_value = {0, 1}
+        ctxt = contexts.HAProxyContext()()
+        self.assertEqual(ctxt['haproxy_nbthread'], 2)
+        self.assertNotIn('haproxy_cpu_map', ctxt)
+
+        # haproxy 1.8 only runs threads when configured.
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'bionic'}
+        ctxt = contexts.HAProxyContext()()
+        self.assertEqual(ctxt['haproxy_nbthread'], 2)
+        self.test_config.set('haproxy-nbthread', None)
+        ctxt = contexts.HAProxyContext()()
+        self.assertNotIn('haproxy_nbthread', ctxt)
+        self.assertNotIn('haproxy_cpu_map', ctxt)
+
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'xenial'}
+        self.test_config.set('haproxy-nbthread', 2)
+        ctxt = contexts.HAProxyContext()()
+        self.assertNotIn('haproxy_nbthread', ctxt)
+
+    def test_cpu_ranges(self):
+        cpu_ranges = contexts.HAProxyContext.cpu_ranges
+        self.assertEqual(cpu_ranges([5]), '5')
+        self.assertEqual(cpu_ranges([0, 1, 2, 3]), '0-3')
+        self.assertEqual(cpu_ranges([0, 2, 3, 4, 7, 9, 10]), '0 2-4 7 9-10')
+
+    def test_ctxt_invalid(self):
+        self.config.side_effect = self.test_config.get
+        ctxt = contexts.HAProxyContext()
+        self.test_config.set('haproxy-mode', 'udp')
+        self.assertRaises(ValueError, ctxt.validate)
+        self.test_config.set('haproxy-mode', 'http')
+        self.test_config.set('haproxy-http-reuse', 'sometimes')
+        self.assertRaises(ValueError, ctxt.validate)
+        self.test_config.set('haproxy-http-reuse', 'always')
+        self.test_config.set('haproxy-server-maxconn', -1)
+        self.assertRaises(ValueError, ctxt.validate)
+        self.test_config.set('haproxy-server-maxconn', None)
+        self.test_config.set('haproxy-maxconn', 0)
+        self.assertRaises(ValueError, ctxt.validate)
+
+    def test_image_cache_disabled(self):
+        config = {'image-cache-enabled': False}
+        self.config.side_effect = lambda x: config.get(x)
+        self.assertEqual(contexts.GlanceImageCacheContext()(), {})
+
+    def test_image_cache_absolute_size(self):
+        config = {
+            'image-cache-enabled': True,
+            'image-cache-max-size': '20G',
+            'image-cache-stall-time': 3600,
+            'image-cache-prefetcher-interval': 120,
+            'image-cache-pruner-schedule': '*:0/30',
+            'image-cache-cleaner-schedule': 'daily'}
+        self.config.side_effect = lambda x: config.get(x)
+        self.os_release.return_value = 'yoga'
+        self.assertEqual(contexts.GlanceImageCacheContext()(), {
+            'image_cache_enabled': True,
+            'image_cache_dir': '/var/lib/glance/image-cache/',
+            'image_cache_max_size': 20 * 1024 ** 3,
+            'image_cache_stall_time': 3600,
+            'image_cache_prefetcher_interval': 120,
+            'image_cache_pruner_schedule': '*:0/30',
+            'image_cache_cleaner_schedule': 'daily'})
+
+    @patch.object(contexts.os, 'statvfs')
+    @patch.object(contexts.os.path, 'exists')
+    def test_image_cache_percentage_size(self, exists, statvfs):
+        config = {
+            'image-cache-enabled': True,
+            'image-cache-max-size': '25%',
+            'image-cache-pruner-schedule': '*:0/30',
+            'image-cache-cleaner-schedule': 'daily'}
+        self.config.side_effect = lambda x: config.get(x)
+        self.os_release.return_value = 'yoga'
+        exists.side_effect = lambda p: p == '/var/lib/glance'
+        statvfs.return_value = MagicMock(f_blocks=1000, f_frsize=4096)
+        ctxt = contexts.GlanceImageCacheContext()()
+        self.assertEqual(ctxt['image_cache_max_size'], 1024000)
+        statvfs.assert_called_with('/var/lib/glance')
+
+    def test_image_cache_invalid(self):
+        config = {
+            'image-cache-enabled': True,
+            'image-cache-max-size': '150%',
+            'image-cache-pruner-schedule': '*:0/30',
+            'image-cache-cleaner-schedule': 'daily'}
+        self.config.side_effect = lambda x: config.get(x)
+        self.os_release.return_value = 'yoga'
+        ctxt = contexts.GlanceImageCacheContext()
+        self.assertEqual(ctxt(), {})
+        self.assertRaises(ValueError, ctxt.validate)
+        config['image-cache-max-size'] = '10Q'
+        self.assertRaises(ValueError, ctxt.validate)
+        config['image-cache-max-size'] = '10G'
+        ctxt.validate()
+        self.os_release.return_value = 'train'
+        self.assertRaises(ValueError, ctxt.validate)
+
+    @patch('charmhelpers.contrib.openstack.context.config')
+    @patch('charmhelpers.contrib.openstack.context._calculate_workers')
+    @patch.object(contexts, 'determine_api_port')
+    def test_glance_wsgi_worker_context(self, determine_api_port,
+                                        _calculate_workers, ch_config):
+        ch_config.return_value = None
+        _calculate_workers.return_value = 4
+        determine_api_port.return_value = 9272
+        self.config.side_effect = self.test_config.get
+        self.os_release.return_value = 'yoga'
+        self.assertEqual(contexts.GlanceWSGIWorkerConfigContext()(), {})
+
+        self.test_config.set('wsgi-server', 'mod_wsgi')
+        self.test_config.set('wsgi-threads', 8)
+        self.test_config.set('wsgi-listen-backlog', 4096)
+        ctxt = contexts.GlanceWSGIWorkerConfigContext()()
+        self.assertEqual(ctxt['wsgi_server'], 'mod_wsgi')
+        self.assertEqual(ctxt['service_name'], 'glance-api')
+        self.assertEqual(ctxt['script'], '/usr/bin/glance-wsgi-api')
+        self.assertEqual(ctxt['user'], 'glance')
+        self.assertEqual(ctxt['port'], 9272)
+        self.assertEqual(ctxt['bind_address'], '0.0.0.0')
+        self.assertEqual(ctxt['processes'], 4)
+        self.assertEqual(ctxt['threads'], 8)
+        self.assertEqual(ctxt['listen_backlog'], 4096)
+        self.assertEqual(ctxt['buffer_size'], 65535)
+        self.assertIsNone(ctxt['post_buffering'])
+
+        self.test_config.set('wsgi-processes', 2)
+        ctxt = contexts.GlanceWSGIWorkerConfigContext()()
+        self.assertEqual(ctxt['processes'], 2)
+
+    def test_glance_wsgi_worker_context_invalid(self):
+        self.config.side_effect = self.test_config.get
+        self.os_release.return_value = 'train'
+        self.test_config.set('wsgi-server', 'uwsgi')
+        ctxt = contexts.GlanceWSGIWorkerConfigContext()
+        self.assertRaises(ValueError, ctxt.validate)
+        self.assertEqual(ctxt(), {})
+
+        self.os_release.return_value = 'yoga'
+        ctxt.validate()
+        self.test_config.set('wsgi-threads', -1)
+        self.assertRaises(ValueError, ctxt.validate)
+
+        self.test_config.set('wsgi-server', 'gunicorn')
+        self.assertRaises(ValueError, ctxt.validate)
@@ -28,6 +28,7 @@ mock_apt.apt_pkg = MagicMock()
 os.environ['JUJU_UNIT_NAME'] = 'glance'
 
 import glance_utils as utils  # noqa
+import charmhelpers.contrib.hardening.harden as harden  # noqa
 
 _reg = utils.register_configs
 _map = utils.restart_map
@@ -36,17 +37,17 @@ utils.register_configs = MagicMock()
 utils.restart_map = MagicMock()
 
 
-with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
-    mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
-                            lambda *args, **kwargs: f(*args, **kwargs))
-    with patch('charmhelpers.contrib.openstack.'
-               'utils.os_requires_version') as mock_os:
-        mock_os.side_effect = (lambda *dargs, **dkwargs: lambda f:
-                               lambda *args, **kwargs: f(*args, **kwargs))
-        with patch('glance_utils.register_configs') as register_configs:
-            with patch('glance_utils.restart_map') as restart_map:
-                import glance_relations as relations
-                importlib.reload(relations)
+# The hardening framework is imported when a hardened hook first runs.
+harden._DISABLE_HARDENING_FOR_UNIT_TEST = True
+
+with patch('charmhelpers.contrib.openstack.'
+           'utils.os_requires_version') as mock_os:
+    mock_os.side_effect = (lambda *dargs, **dkwargs: lambda f:
+                           lambda *args, **kwargs: f(*args, **kwargs))
+    with patch('glance_utils.register_configs') as register_configs:
+        with patch('glance_utils.restart_map') as restart_map:
+            import glance_relations as relations
+            importlib.reload(relations)
 
 relations.hooks._config_save = False
 
@@ -86,6 +87,8 @@ TO_PATCH = [
     'is_clustered',
     # charmhelpers.contrib.hahelpers.cluster_utils
     'is_elected_leader',
+    # charmhelpers.core.unitdata
+    'kv',
     # glance_utils
     'restart_map',
     'register_configs',
@@ -99,6 +102,15 @@ TO_PATCH = [
     'remove_old_packages',
     'services',
     'backup_deprecated_configurations',
+    'configure_image_cache',
+    'configure_swift_upload_buffer',
+    'configure_storage',
+    'configure_sysctl',
+    'configure_wsgi_server',
+    'flush_bytecode_cache',
+    'release_storage',
+    # glance_status
+    'invalidate_status_assessment',
     # other
     'call',
     'check_call',
@@ -110,6 +122,7 @@ TO_PATCH = [
     'get_relation_ip',
     'is_db_maintenance_mode',
     'send_application_name',
+    'storage_get',
 ]
 
 
@@ -120,6 +133,8 @@ class GlanceRelationTests(CharmTestCase):
         self.config.side_effect = self.test_config.get
         self.restart_on_change.return_value = None
         self.os_release.return_value = 'icehouse'
+        # No storage is attached unless a test says so.
+        self.configure_storage.return_value = False
 
     def test_install_hook(self):
         repo = 'cloud:precise-grizzly'
@@ -131,8 +146,11 @@ class GlanceRelationTests(CharmTestCase):
         self.determine_packages.return_value = _packages
         relations.install_hook()
         self.configure_installation_source.assert_called_with(repo)
-        self.apt_update.assert_called_with(fatal=True)
-        self.apt_install.assert_called_with(_packages, fatal=True)
+        self.apt_update.assert_called_with(fatal=True, max_age=3600)
+        self.apt_install.assert_has_calls([
+            call(['openstack-release'], fatal=False, quiet=True,
+                 upgrade=True),
+            call(_packages, fatal=True)])
         self.assertTrue(self.execd_preinstall.called)
 
     def test_install_hook_precise_distro(self):
@@ -361,6 +379,7 @@ class GlanceRelationTests(CharmTestCase):
         for c in [call('/etc/glance/glance.conf')]:
             self.assertNotIn(c, configs.write.call_args_list)
 
+    @patch.object(relations, 'api_service_name')
     @patch.object(relations, 'get_ceph_request')
     @patch.object(relations, 'send_request_if_needed')
     @patch.object(relations, 'is_request_complete')
@@ -368,7 +387,9 @@ class GlanceRelationTests(CharmTestCase):
     def test_ceph_changed_key_and_relation_data(self, configs,
                                                 mock_request_complete,
                                                 mock_send_request_if_needed,
-                                                mock_service):
+                                                mock_service,
+                                                api_service_name):
+        api_service_name.return_value = 'glance-api'
         configs.complete_contexts = MagicMock()
         configs.complete_contexts.return_value = ['ceph']
         configs.write = MagicMock()
@@ -381,6 +402,29 @@ class GlanceRelationTests(CharmTestCase):
                          configs.write.call_args_list)
         self.service_restart.assert_called_with('glance-api')
 
+    @patch('glance_utils.os_release')
+    @patch('glance_utils.config')
+    @patch.object(relations, 'is_unit_paused_set')
+    @patch.object(relations, 'get_ceph_request')
+    @patch.object(relations, 'send_request_if_needed')
+    @patch.object(relations, 'is_request_complete')
+    @patch.object(relations, 'CONFIGS')
+    def test_ceph_changed_wsgi_server(self, configs, mock_request_complete,
+                                      mock_send_request_if_needed,
+                                      mock_get_ceph_request,
+                                      is_unit_paused_set, utils_config,
+                                      utils_os_release):
+        # The glance-api service is masked when a WSGI server runs it.
+        self.test_config.set('wsgi-server', 'uwsgi')
+        utils_config.side_effect = self.test_config.get
+        utils_os_release.return_value = 'caracal'
+        configs.complete_contexts.return_value = ['ceph']
+        self.ensure_ceph_keyring.return_value = True
+        mock_request_complete.return_value = True
+        is_unit_paused_set.return_value = False
+        relations.ceph_changed()
+        self.service_restart.assert_called_once_with('glance-api-uwsgi')
+
     @patch.object(relations, 'CONFIGS')
     def test_ceph_broken(self, configs):
         self.service_name.return_value = 'glance'
@@ -506,6 +550,10 @@ class GlanceRelationTests(CharmTestCase):
         self.open_port.assert_called_with(9292)
         self.assertTrue(configure_https.called)
         self.assertTrue(mock_update_policy.called)
+        self.configure_image_cache.assert_called_once_with(relations.CONFIGS)
+        self.configure_swift_upload_buffer.assert_called_once_with()
+        self.configure_wsgi_server.assert_called_once_with(relations.CONFIGS)
+        self.configure_sysctl.assert_called_once_with()
 
     @patch.object(relations, 'update_image_location_policy')
     @patch.object(relations, 'status_set')
@@ -567,6 +615,9 @@ class GlanceRelationTests(CharmTestCase):
         self.remove_old_packages.return_value = False
         self.filter_installed_packages.return_value = ['test']
         relations.upgrade_charm()
+        self.flush_bytecode_cache.assert_called_once_with()
+        self.kv.return_value.vacuum.assert_called_once_with()
+        self.apt_update.assert_called_once_with(max_age=3600)
         self.apt_install.assert_called_with(['test'], fatal=True)
         self.assertTrue(configs.write_all.called)
         self.assertTrue(self.reinstall_paste_ini.called)
@@ -602,6 +653,55 @@ class GlanceRelationTests(CharmTestCase):
             'ha_changed: hacluster subordinate is not fully clustered.'
         )
 
+    @patch.object(relations, 'assess_status')
+    @patch.object(relations, 'resolve_CONFIGS')
+    @patch.object(relations, 'hooks')
+    def test_main(self, hooks, resolve_CONFIGS, assess_status):
+        calls = MagicMock()
+        self.invalidate_status_assessment.side_effect = (
+            lambda: calls('invalidate'))
+        hooks.execute.side_effect = lambda args: calls('execute', args)
+        assess_status.side_effect = lambda configs: calls('assess')
+        self.kv.return_value.flush.side_effect = lambda: calls('flush')
+        relations.main(['hooks/config-changed'])
+        self.assertEqual(calls.call_args_list, [
+            call('invalidate'), call('execute', ['hooks/config-changed']),
+            call('assess'), call('flush')])
+
+    @patch('glance_utils.os_release')
+    @patch('glance_utils.config')
+    @patch.object(relations, 'is_unit_paused_set')
+    def test_storage_attached(self, is_unit_paused_set, utils_config,
+                              utils_os_release):
+        utils_config.side_effect = self.test_config.get
+        utils_os_release.return_value = 'caracal'
+        is_unit_paused_set.return_value = False
+        self.configure_storage.return_value = True
+        relations.storage_attached()
+        self.service_restart.assert_called_once_with('glance-api')
+
+        # The glance-api service is masked when a WSGI server runs it.
+        self.service_restart.reset_mock()
+        self.test_config.set('wsgi-server', 'mod_wsgi')
+        relations.storage_attached()
+        self.service_restart.assert_called_once_with('apache2')
+
+        self.service_restart.reset_mock()
+        self.configure_storage.return_value = False
+        relations.storage_attached()
+        self.assertFalse(self.service_restart.called)
+
+        self.configure_storage.return_value = True
+        is_unit_paused_set.return_value = True
+        relations.storage_attached()
+        self.assertFalse(self.service_restart.called)
+
+    def test_storage_detaching(self):
+        self.storage_get.return_value = '/dev/vdb'
+        relations.storage_detaching()
+        self.storage_get.assert_called_once_with('location')
+        self.release_storage.assert_called_once_with('/dev/vdb')
+
     @patch.object(relations, 'canonical_url')
     @patch.object(relations, 'keystone_joined')
     @patch.object(relations, 'CONFIGS')
@@ -0,0 +1,135 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+from unittest.mock import patch, MagicMock
+
+import glance_status as status
+
+from test_utils import (
+    CharmTestCase,
+    SimpleKV,
+)
+
+TO_PATCH = [
+    'config',
+    'log',
+    'kv',
+    'service_running',
+    'socket',
+    'start_profiling',
+    'time',
+]
+
+
+class TestGlanceStatus(CharmTestCase):
+
+    def setUp(self):
+        super(TestGlanceStatus, self).setUp(status, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.db = SimpleKV()
+        self.kv.return_value = self.db
+        self.time.time.return_value = 1000.0
+        self.running = {'glance-api': True, 'haproxy': True}
+        self.service_running.side_effect = lambda svc: self.running[svc]
+        self.listening = {9292: True, 9282: True}
+
+        def create_connection(address, timeout):
+            if not self.listening.get(address[1]):
+                raise ConnectionRefusedError
+            return MagicMock()
+        self.socket.create_connection.side_effect = create_connection
+
+    def test_record_status_assessment(self):
+        status.record_status_assessment(['glance-api', 'haproxy'])
+        self.assertEqual(
+            self.db.get(status.STATUS_ASSESSMENT_KEY),
+            {'config': status.config_fingerprint(),
+             'services': {'glance-api': True, 'haproxy': True},
+             'ports': {},
+             'timestamp': 1000.0})
+        self.assertTrue(self.db.flushed)
+
+    def test_record_status_assessment_ports(self):
+        self.listening[9282] = False
+        status.record_status_assessment(['glance-api'], [9282, 9292])
+        self.assertEqual(
+            self.db.get(status.STATUS_ASSESSMENT_KEY)['ports'],
+            {'9282': False, '9292': True})
+
+    def test_invalidate_status_assessment(self):
+        status.record_status_assessment(['glance-api'])
+        self.db.flushed = False
+        status.invalidate_status_assessment()
+        self.assertIsNone(self.db.get(status.STATUS_ASSESSMENT_KEY))
+        self.assertTrue(self.db.flushed)
+        self.assertFalse(status.status_assessment_current())
+
+    def test_invalidate_status_assessment_no_record(self):
+        status.invalidate_status_assessment()
+        self.assertFalse(self.db.flushed)
+
+    def test_status_assessment_current(self):
+        status.record_status_assessment(['glance-api', 'haproxy'])
+        self.time.time.return_value = 1300.0
+        self.assertTrue(status.status_assessment_current())
+
+    def test_status_assessment_current_no_record(self):
+        self.assertFalse(status.status_assessment_current())
+
+    def test_status_assessment_current_expired(self):
+        status.record_status_assessment(['glance-api'])
+        self.time.time.return_value = (
+            1001.0 + status.STATUS_ASSESSMENT_MAX_AGE)
+        self.assertFalse(status.status_assessment_current())
+
+    def test_status_assessment_current_config_changed(self):
+        status.record_status_assessment(['glance-api'])
+        self.test_config.set('debug', True)
+        self.assertFalse(status.status_assessment_current())
+
+    def test_status_assessment_current_service_stopped(self):
+        status.record_status_assessment(['glance-api', 'haproxy'])
+        self.running['haproxy'] = False
+        self.assertFalse(status.status_assessment_current())
+
+    def test_status_assessment_current_service_started(self):
+        self.running['haproxy'] = False
+        status.record_status_assessment(['glance-api', 'haproxy'])
+        self.running['haproxy'] = True
+        self.assertFalse(status.status_assessment_current())
+
+    def test_status_assessment_current_port_closed(self):
+        status.record_status_assessment(['glance-api'], [9282, 9292])
+        self.assertTrue(status.status_assessment_current())
+        self.listening[9292] = False
+        self.assertFalse(status.status_assessment_current())
+
+    @patch.object(status, 'status_assessment_current')
+    def test_main_fast_path(self, status_assessment_current):
+        status_assessment_current.return_value = True
+        relations = MagicMock()
+        with patch.dict(sys.modules, {'glance_relations': relations}):
+            status.main(['hooks/update-status'])
+        self.assertFalse(relations.main.called)
+        self.start_profiling.assert_called_once_with('update-status')
+
+    @patch.object(status, 'status_assessment_current')
+    def test_main_full_assessment(self, status_assessment_current):
+        status_assessment_current.return_value = False
+        relations = MagicMock()
+        with patch.dict(sys.modules, {'glance_relations': relations}):
+            status.main(['hooks/update-status'])
+        relations.main.assert_called_once_with(['hooks/update-status'])
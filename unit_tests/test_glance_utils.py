@@ -246,6 +246,469 @@ class TestGlanceUtils(CharmTestCase):
         del ex_map[utils.MEMCACHED_CONF]
         self.assertEqual(ex_map, utils.restart_map())
 
+    @patch.object(utils.os.path, 'isdir')
+    def test_restart_map_mod_wsgi(self, isdir):
+        isdir.return_value = True
+        self.enable_memcache.return_value = False
+        self.service_name.return_value = 'glance'
+        self.os_release.return_value = 'yoga'
+        self.test_config.set('wsgi-server', 'mod_wsgi')
+
+        ex_map = OrderedDict([
+            (utils.GLANCE_API_CONF, ['apache2']),
+            (utils.GLANCE_SWIFT_CONF, ['apache2']),
+            (utils.GLANCE_POLICY_FILE, ['apache2']),
+            (utils.GLANCE_AUDIT_MAP, ['apache2']),
+            (utils.GLANCE_API_PASTE, ['apache2']),
+            (utils.ceph_config_file(), ['apache2']),
+            (utils.HAPROXY_CONF, ['haproxy']),
+            (utils.HTTPS_APACHE_CONF, ['apache2']),
+            (utils.HTTPS_APACHE_24_CONF, ['apache2']),
+            (utils.APACHE_PORTS_CONF, ['apache2']),
+            (utils.WSGI_GLANCE_API_CONF, ['apache2']),
+            ('{}/*'.format(utils.APACHE_SSL_DIR), ['apache2']),
+        ])
+        self.assertEqual(ex_map, utils.restart_map())
+        self.assertEqual(['apache2', 'haproxy'], sorted(utils.services()))
+
+    def test_restart_map_uwsgi(self):
+        self.enable_memcache.return_value = False
+        self.service_name.return_value = 'glance'
+        self.os_release.return_value = 'yoga'
+        self.test_config.set('wsgi-server', 'uwsgi')
+
+        restart_map = utils.restart_map()
+        self.assertEqual(['glance-api-uwsgi'],
+                         restart_map[utils.GLANCE_API_CONF])
+        self.assertEqual(['glance-api-uwsgi'],
+                         restart_map[utils.GLANCE_API_UWSGI_INI])
+        self.assertNotIn(utils.GLANCE_API_UWSGI_SERVICE, restart_map)
+        self.assertNotIn(utils.WSGI_GLANCE_API_CONF, restart_map)
+
+    def test_determine_wsgi_server(self):
+        self.os_release.return_value = 'yoga'
+        self.assertIsNone(utils.determine_wsgi_server())
+        self.test_config.set('wsgi-server', 'uwsgi')
+        self.assertEqual('uwsgi', utils.determine_wsgi_server())
+        self.assertEqual('glance-api-uwsgi', utils.api_service_name())
+        self.os_release.return_value = 'train'
+        self.assertIsNone(utils.determine_wsgi_server())
+        self.assertEqual('glance-api', utils.api_service_name())
+
+    @patch.object(utils, 'api_service_name')
+    def test_restart_dependencies(self, api_service_name):
+        api_service_name.return_value = 'glance-api'
+        self.assertEqual(utils.restart_dependencies(), {
+            'glance-api': ['memcached'],
+            'glance-registry': ['memcached'],
+            'haproxy': ['glance-api', 'apache2'],
+            'apache2': ['glance-api'],
+        })
+        api_service_name.return_value = 'apache2'
+        self.assertEqual(utils.restart_dependencies(), {
+            'apache2': ['memcached'],
+            'glance-registry': ['memcached'],
+            'haproxy': ['apache2'],
+        })
+
+    @patch.object(utils, 'https')
+    @patch.object(utils, 'determine_apache_port')
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'api_service_name')
+    def test_readiness_probes(self, api_service_name, determine_api_port,
+                              determine_apache_port, https):
+        api_service_name.return_value = 'glance-api'
+        determine_api_port.return_value = 9272
+        determine_apache_port.return_value = 9282
+        https.return_value = False
+        self.assertEqual(utils.readiness_probes(), {
+            'glance-api': [('http', 9272)],
+            'haproxy': [('tcp', 9292)],
+            'memcached': [('tcp', 11211)],
+        })
+        https.return_value = True
+        self.assertEqual(utils.readiness_probes()['apache2'],
+                         [('tcp', 9282)])
+
+    @patch.object(utils.socket, 'create_connection')
+    def test_probe_ready_tcp(self, create_connection):
+        self.assertTrue(utils._probe_ready('tcp', 9292))
+        create_connection.assert_called_once_with(('localhost', 9292),
+                                                  timeout=5)
+        create_connection.side_effect = ConnectionRefusedError
+        self.assertFalse(utils._probe_ready('tcp', 9292))
+
+    @patch.object(utils.urllib.request, 'build_opener')
+    def test_probe_ready_http(self, build_opener):
+        opener = build_opener.return_value
+        self.assertTrue(utils._probe_ready('http', 9272))
+        opener.open.assert_called_once_with(
+            'http://localhost:9272/healthcheck', timeout=5)
+        opener.open.side_effect = utils.urllib.error.HTTPError(
+            'url', 401, 'Unauthorized', {}, None)
+        self.assertTrue(utils._probe_ready('http', 9272))
+        opener.open.side_effect = utils.urllib.error.HTTPError(
+            'url', 503, 'Unavailable', {}, None)
+        self.assertFalse(utils._probe_ready('http', 9272))
+        opener.open.side_effect = ConnectionRefusedError
+        self.assertFalse(utils._probe_ready('http', 9272))
+
+    @patch.object(utils, 'time')
+    @patch.object(utils, '_probe_ready')
+    @patch.object(utils, 'readiness_probes')
+    def test_wait_for_service_ready(self, readiness_probes, _probe_ready,
+                                    mock_time):
+        readiness_probes.return_value = {'glance-api': [('http', 9272)]}
+        mock_time.time.side_effect = [100, 101, 102]
+        _probe_ready.side_effect = [False, True]
+        self.assertTrue(utils.wait_for_service_ready('glance-api'))
+        mock_time.sleep.assert_called_once_with(1)
+        _probe_ready.assert_called_with('http', 9272)
+
+        self.assertTrue(utils.wait_for_service_ready('apache2'))
+
+        _probe_ready.reset_mock()
+        _probe_ready.side_effect = None
+        _probe_ready.return_value = False
+        mock_time.time.side_effect = [100, 130, 161]
+        self.assertFalse(utils.wait_for_service_ready('glance-api'))
+        self.log.assert_called_with(
+            'glance-api not ready on port 9272 after 60s', level='WARNING')
+
+        _probe_ready.reset_mock()
+        self.test_config.set('restart-readiness-timeout', 0)
+        self.assertTrue(utils.wait_for_service_ready('glance-api'))
+        self.assertFalse(_probe_ready.called)
+
+    @patch.object(utils, 'time')
+    @patch.object(utils, 'status_set')
+    @patch.object(utils, 'hook_name')
+    @patch.object(utils, 'local_unit')
+    @patch.object(utils, 'peer_units')
+    def test_stagger_restarts(self, peer_units, local_unit, hook_name,
+                              status_set, mock_time):
+        self.test_config.set('restart-stagger-wait', 30)
+        hook_name.return_value = 'config-changed'
+        peer_units.return_value = ['glance/1', 'glance/10', 'glance/3']
+        local_unit.return_value = 'glance/4'
+        utils.stagger_restarts()
+        mock_time.sleep.assert_called_once_with(60)
+        status_set.assert_called_once_with(
+            'maintenance', 'Waiting 60 seconds for peers to restart services')
+
+        mock_time.sleep.reset_mock()
+        local_unit.return_value = 'glance/0'
+        utils.stagger_restarts()
+        self.assertFalse(mock_time.sleep.called)
+
+        local_unit.return_value = 'glance/4'
+        hook_name.return_value = 'shared-db-relation-changed'
+        utils.stagger_restarts()
+        self.assertFalse(mock_time.sleep.called)
+
+        hook_name.return_value = 'upgrade-charm'
+        utils.stagger_restarts()
+        mock_time.sleep.assert_called_once_with(60)
+
+        mock_time.sleep.reset_mock()
+        self.test_config.set('restart-stagger-wait', 0)
+        utils.stagger_restarts()
+        self.assertFalse(mock_time.sleep.called)
+
+    @patch.object(utils, 'time')
+    @patch.object(utils, 'status_set')
+    @patch.object(utils, 'hook_name')
+    @patch.object(utils, 'local_unit')
+    @patch.object(utils, 'peer_units')
+    def test_stagger_restarts_by_default(self, peer_units, local_unit,
+                                         hook_name, status_set, mock_time):
+        hook_name.return_value = 'config-changed'
+        peer_units.return_value = ['glance/0', 'glance/1']
+        local_unit.return_value = 'glance/2'
+        utils.stagger_restarts()
+        mock_time.sleep.assert_called_once_with(20)
+
+    def test_register_configs_mod_wsgi(self):
+        self.os_release.return_value = 'yoga'
+        self.relation_ids.return_value = False
+        self.test_config.set('wsgi-server', 'mod_wsgi')
+        configs = utils.register_configs()
+        configs.register.assert_any_call(
+            utils.WSGI_GLANCE_API_CONF,
+            utils.CONFIG_FILES[utils.WSGI_GLANCE_API_CONF]['hook_contexts'])
+        registered = [c[0][0] for c in configs.register.call_args_list]
+        self.assertNotIn(utils.GLANCE_API_UWSGI_INI, registered)
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_enable')
+    @patch.object(utils, 'service_pause')
+    @patch.object(utils, 'service')
+    @patch.object(utils, 'filter_installed_packages')
+    @patch.object(utils.os.path, 'exists')
+    def test_configure_wsgi_server_uwsgi(self, exists,
+                                         filter_installed_packages, service,
+                                         service_pause, service_enable,
+                                         is_unit_paused_set):
+        exists.return_value = False
+        filter_installed_packages.side_effect = lambda pkgs: pkgs
+        is_unit_paused_set.return_value = False
+        self.os_release.return_value = 'yoga'
+        self.test_config.set('wsgi-server', 'uwsgi')
+        configs = MagicMock()
+        utils.configure_wsgi_server(configs)
+        self.apt_install.assert_called_once_with(
+            ['uwsgi-core', 'uwsgi-plugin-python3'], fatal=True)
+        configs.write.assert_has_calls([
+            call(utils.GLANCE_API_UWSGI_INI),
+            call(utils.GLANCE_API_UWSGI_SERVICE)])
+        service_pause.assert_called_once_with('glance-api')
+        service.assert_called_once_with('daemon-reload')
+        service_enable.assert_called_once_with('glance-api-uwsgi')
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_resume')
+    @patch.object(utils, 'service_reload')
+    @patch.object(utils, 'service')
+    @patch.object(utils.os, 'remove')
+    @patch.object(utils.os.path, 'exists')
+    def test_configure_wsgi_server_eventlet(self, exists, remove, service,
+                                            service_reload, service_resume,
+                                            is_unit_paused_set):
+        exists.side_effect = lambda f: f == utils.WSGI_GLANCE_API_CONF
+        is_unit_paused_set.return_value = False
+        self.os_release.return_value = 'yoga'
+        configs = MagicMock()
+        utils.configure_wsgi_server(configs)
+        self.assertFalse(configs.write.called)
+        self.assertFalse(self.apt_install.called)
+        remove.assert_called_once_with(utils.WSGI_GLANCE_API_CONF)
+        service_reload.assert_called_once_with('apache2',
+                                               restart_on_failure=True)
+        service.assert_called_once_with('daemon-reload')
+        service_resume.assert_called_once_with('glance-api')
+
+    @patch.object(utils, 'sysctl_create')
+    @patch.object(utils.glance_contexts.GlanceServerTuningContext,
+                  'somaxconn')
+    def test_configure_sysctl(self, somaxconn, sysctl_create):
+        somaxconn.return_value = 4096
+        self.test_config.set('raise-somaxconn', True)
+        utils.configure_sysctl()
+        self.assertFalse(sysctl_create.called)
+        self.test_config.set('wsgi-listen-backlog', 16384)
+        utils.configure_sysctl()
+        sysctl_create.assert_called_once_with(
+            {'net.core.somaxconn': 16384}, utils.SYSCTL_CONF, ignore=True)
+
+    @patch.object(utils, 'sysctl_create')
+    @patch.object(utils.os, 'remove')
+    @patch.object(utils.os.path, 'exists')
+    def test_configure_sysctl_disabled(self, exists, remove, sysctl_create):
+        exists.return_value = True
+        utils.configure_sysctl()
+        remove.assert_called_once_with(utils.SYSCTL_CONF)
+        self.assertFalse(sysctl_create.called)
+
+    def test_register_configs_image_cache(self):
+        self.os_release.return_value = 'yoga'
+        self.relation_ids.return_value = False
+        self.test_config.set('image-cache-enabled', True)
+        configs = utils.register_configs()
+        calls = [call(conf, utils.CONFIG_FILES[conf]['hook_contexts'])
+                 for conf in utils.IMAGE_CACHE_UNITS]
+        configs.register.assert_has_calls(calls, any_order=True)
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'service_enable')
+    @patch.object(utils, 'service')
+    @patch.object(utils.glance_contexts, 'GlanceImageCacheContext')
+    def test_configure_image_cache_enabled(self, ctxt, service,
+                                           service_enable, service_restart,
+                                           is_unit_paused_set):
+        ctxt.return_value.return_value = {'image_cache_enabled': True}
+        is_unit_paused_set.return_value = False
+        configs = MagicMock()
+        utils.configure_image_cache(configs)
+        configs.write.assert_has_calls(
+            [call(f) for f in utils.IMAGE_CACHE_UNITS])
+        service.assert_called_once_with('daemon-reload')
+        service_enable.assert_has_calls(
+            [call('glance-cache-pruner.timer'),
+             call('glance-cache-cleaner.timer')])
+        service_restart.assert_has_calls(
+            [call('glance-cache-pruner.timer'),
+             call('glance-cache-cleaner.timer')])
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch.object(utils, 'service')
+    @patch.object(utils.glance_contexts, 'GlanceImageCacheContext')
+    def test_configure_image_cache_disabled(self, ctxt, service, exists,
+                                            remove):
+        ctxt.return_value.return_value = {}
+        exists.return_value = True
+        configs = MagicMock()
+        utils.configure_image_cache(configs)
+        self.assertFalse(configs.write.called)
+        self.service_stop.assert_has_calls(
+            [call('glance-cache-pruner.timer'),
+             call('glance-cache-cleaner.timer')])
+        remove.assert_has_calls([call(f) for f in utils.IMAGE_CACHE_UNITS])
+        service.assert_called_with('daemon-reload')
+
+        service.reset_mock()
+        exists.return_value = False
+        utils.configure_image_cache(configs)
+        self.assertFalse(service.called)
+
+    @patch.object(utils, 'mkdir')
+    def test_configure_swift_upload_buffer(self, mkdir):
+        utils.configure_swift_upload_buffer()
+        self.assertFalse(mkdir.called)
+        self.test_config.set('swift-buffer-on-upload', True)
+        utils.configure_swift_upload_buffer()
+        mkdir.assert_called_once_with(
+            '/var/lib/glance/swift-upload-buffer/', owner='glance',
+            group='glance', perms=0o750)
+
+    def test_storage_mountpoints(self):
+        self.test_config.set('filesystem-store-datadir', '/srv/images/')
+        self.assertEqual(utils.storage_mountpoints(), OrderedDict([
+            ('image-cache', '/var/lib/glance/image-cache'),
+            ('image-staging', '/var/lib/glance/staging'),
+            ('image-store', '/srv/images'),
+        ]))
+        self.test_config.set('filesystem-store-datadir', '')
+        self.assertNotIn('image-store', utils.storage_mountpoints())
+
+    @patch.object(utils, 'place_data_on_storage')
+    @patch.object(utils, 'storage_get')
+    @patch.object(utils, 'storage_list')
+    @patch.object(utils, 'filesystem_mounted')
+    @patch.object(utils, 'user_exists')
+    def test_configure_storage(self, user_exists, filesystem_mounted,
+                               storage_list, storage_get,
+                               place_data_on_storage):
+        user_exists.return_value = True
+        filesystem_mounted.side_effect = (
+            lambda m: m == '/var/lib/glance/image-cache')
+        storage_list.side_effect = lambda n: {
+            'image-cache': ['image-cache/0'],
+            'image-staging': ['image-staging/1'],
+        }.get(n, [])
+        storage_get.return_value = '/dev/nvme1n1'
+        place_data_on_storage.return_value = True
+        self.assertTrue(utils.configure_storage())
+        place_data_on_storage.assert_called_once_with(
+            '/dev/nvme1n1', '/var/lib/glance/staging')
+        storage_get.assert_called_once_with('location', 'image-staging/1')
+
+        user_exists.return_value = False
+        place_data_on_storage.reset_mock()
+        self.assertFalse(utils.configure_storage())
+        self.assertFalse(place_data_on_storage.called)
+
+    @patch('os.rmdir')
+    @patch('tempfile.mkdtemp')
+    @patch.object(utils, 'copy_files')
+    @patch.object(utils, 'umount')
+    @patch.object(utils, 'mount')
+    @patch.object(utils, 'make_filesystem')
+    @patch.object(utils, '_has_filesystem')
+    @patch('os.listdir')
+    def test_place_data_on_storage(self, listdir, has_filesystem,
+                                   make_filesystem, mount, umount,
+                                   copy_files, mkdtemp, rmdir):
+        has_filesystem.return_value = False
+        listdir.return_value = ['cached-image']
+        mount.return_value = True
+        mkdtemp.return_value = '/tmp/glance-storage-x'
+        self.assertTrue(utils.place_data_on_storage('/dev/vdb', '/srv/x'))
+        make_filesystem.assert_called_once_with('/dev/vdb', fstype='ext4')
+        mount.assert_has_calls([
+            call('/dev/vdb', '/tmp/glance-storage-x', options='noatime'),
+            call('/dev/vdb', '/srv/x', options='noatime', persist=True,
+                 filesystem='ext4'),
+        ])
+        copy_files.assert_called_once_with('/srv/x', '/tmp/glance-storage-x',
+                                           symlinks=True)
+        umount.assert_called_once_with('/tmp/glance-storage-x')
+        rmdir.assert_called_once_with('/tmp/glance-storage-x')
+
+        make_filesystem.reset_mock()
+        mount.reset_mock()
+        mkdtemp.reset_mock()
+        has_filesystem.return_value = True
+        listdir.return_value = []
+        self.assertTrue(utils.place_data_on_storage('/dev/vdb', '/srv/x'))
+        self.assertFalse(make_filesystem.called)
+        self.assertFalse(mkdtemp.called)
+        mount.assert_called_once_with('/dev/vdb', '/srv/x',
+                                      options='noatime', persist=True,
+                                      filesystem='ext4')
+
+    @patch('os.rmdir')
+    @patch('tempfile.mkdtemp')
+    @patch.object(utils, 'copy_files')
+    @patch.object(utils, 'umount')
+    @patch.object(utils, 'mount')
+    @patch.object(utils, '_has_filesystem')
+    @patch('os.listdir')
+    def test_place_data_on_storage_migration_fails(self, listdir,
+                                                   has_filesystem, mount,
+                                                   umount, copy_files,
+                                                   mkdtemp, rmdir):
+        has_filesystem.return_value = True
+        listdir.return_value = ['cached-image']
+        mkdtemp.return_value = '/tmp/glance-storage-x'
+        mount.return_value = False
+        self.assertFalse(utils.place_data_on_storage('/dev/vdb', '/srv/x'))
+        self.assertFalse(copy_files.called)
+        rmdir.assert_called_once_with('/tmp/glance-storage-x')
+
+        mount.return_value = True
+        rmdir.reset_mock()
+        copy_files.side_effect = OSError
+        self.assertRaises(OSError, utils.place_data_on_storage,
+                          '/dev/vdb', '/srv/x')
+        umount.assert_called_once_with('/tmp/glance-storage-x')
+        rmdir.assert_called_once_with('/tmp/glance-storage-x')
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'api_service_name')
+    @patch.object(utils, 'umount')
+    @patch.object(utils, 'mounts')
+    def test_release_storage(self, mounts, umount, api_service_name,
+                             is_unit_paused_set):
+        mounts.return_value = [
+            ['/', '/dev/vda1'],
+            ['/var/lib/glance/staging', '/dev/vdb'],
+            ['/var/lib/glance/image-cache', '/dev/vdc'],
+        ]
+        api_service_name.return_value = 'glance-api'
+        is_unit_paused_set.return_value = False
+        manager = MagicMock()
+        manager.attach_mock(self.service_stop, 'service_stop')
+        manager.attach_mock(umount, 'umount')
+        manager.attach_mock(self.service_start, 'service_start')
+        utils.release_storage('/dev/vdb')
+        self.assertEqual(manager.mock_calls, [
+            call.service_stop('glance-api'),
+            call.umount('/var/lib/glance/staging', persist=True),
+            call.service_start('glance-api')])
+
+        manager.reset_mock()
+        is_unit_paused_set.return_value = True
+        utils.release_storage('/dev/vdb')
+        self.assertEqual(manager.mock_calls, [
+            call.service_stop('glance-api'),
+            call.umount('/var/lib/glance/staging', persist=True)])
+
+        manager.reset_mock()
+        utils.release_storage('/dev/vdd')
+        self.assertEqual(manager.mock_calls, [])
+
     @patch.object(utils, 'token_cache_pkgs')
     def test_determine_packages(self, token_cache_pkgs):
         self.config.side_effect = None
@@ -321,7 +784,17 @@ class TestGlanceUtils(CharmTestCase):
         configs.set_release.assert_called_with(openstack_release='havana')
         self.assertFalse(migrate.called)
 
-    def test_assess_status(self):
+    @patch.object(utils, 'readiness_probes')
+    @patch.object(utils, 'record_status_assessment')
+    @patch.object(utils, 'get_managed_services_and_ports')
+    @patch.object(utils, 'services')
+    def test_assess_status(self, services, get_managed_services_and_ports,
+                           record_status_assessment, readiness_probes):
+        readiness_probes.return_value = {
+            's1': [('http', 9282), ('tcp', 9281)],
+            'memcached': [('tcp', 11211)]}
+        services.return_value = ['s1', 'haproxy']
+        get_managed_services_and_ports.return_value = (['s1'], [])
         with patch.object(utils, 'assess_status_func') as asf:
             callee = MagicMock()
             asf.return_value = callee
@@ -331,6 +804,8 @@ class TestGlanceUtils(CharmTestCase):
             self.os_application_version_set.assert_called_with(
                 utils.VERSION_PACKAGE
             )
+        record_status_assessment.assert_called_once_with(
+            ['s1'], [9281, 9282])
 
     @patch.object(utils, 'get_managed_services_and_ports')
     @patch.object(utils, 'get_optional_interfaces')
@@ -0,0 +1,79 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import unittest
+
+HOOKS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hooks')
+
+# Subsystems which only some hooks use, and so must not be imported when a
+# hook starts.
+DEFERRED_MODULES = [
+    'charmhelpers.contrib.charmsupport.nrpe',
+    'charmhelpers.contrib.hardening.harden',
+    'charmhelpers.contrib.hardware.pci',
+    'charmhelpers.contrib.openstack.cert_utils',
+    'charmhelpers.contrib.storage.linux.ceph',
+    'distutils',
+    'jinja2',
+    'psutil',
+]
+
+
+def import_times(module):
+    """Import module in a fresh interpreter under python -X importtime.
+
+    :param module: name of a module in hooks/
+    :type module: str
+    :returns: {imported module: cumulative import time in us}
+    :rtype: Dict[str, int]
+    """
+    env = dict(os.environ, JUJU_UNIT_NAME='glance/0')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {}'.format(module)],
+        cwd=HOOKS_DIR, env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+class ImportTimeTests(unittest.TestCase):
+
+    def assertNotImported(self, times, modules):
+        imported = [m for m in modules
+                    if any(name == m or name.startswith(m + '.')
+                           for name in times)]
+        self.assertEqual(imported, [])
+
+    def test_hook_startup_defers_subsystems(self):
+        times = import_times('glance_relations')
+        self.assertIn('glance_relations', times)
+        self.assertNotImported(times, DEFERRED_MODULES)
+
+    def test_update_status_startup(self):
+        times = import_times('glance_status')
+        self.assertIn('glance_status', times)
+        self.assertNotImported(
+            times, DEFERRED_MODULES + ['charmhelpers.contrib.openstack',
+                                       'glance_utils'])